@@ -0,0 +1,959 @@
+"""
+Benchmarks for the document processing stages.
+
+Each command times one stage on a folder of sample images and, where a
+reference is available, checks the results against it so that speed-ups
+can be verified not to change the output.
+
+Usage:
+    python scripts/benchmark.py split <images_folder> [--reference split_manifest.jsonl]
+    python scripts/benchmark.py formats <images_folder>
+    python scripts/benchmark.py deskew [--pages 30] [--scale 0.25]
+    python scripts/benchmark.py doctype <images_folder> [--labels labels.json]
+    python scripts/benchmark.py enhance [<images_folder>] [--pages 3]
+    python scripts/benchmark.py background <images_folder> [--mask-scale 0.25]
+    python scripts/benchmark.py background-outputs <images_folder>
+    python scripts/benchmark.py segment [<images_folder>] [--pages 10]
+    python scripts/benchmark.py ocr [<images_folder>] [--pages 5]
+    python scripts/benchmark.py transcribe <segments_folder> [--batch-size 1 --batch-size 8]
+    python scripts/benchmark.py visual-tokens <segments_folder> [--max-pixels 501760]
+    python scripts/benchmark.py precision <segments_folder> [--precision bf16 --precision int8] [--threads 8]
+    python scripts/benchmark.py decoding <segments_folder> [--limit 16]
+    python scripts/benchmark.py prefill <segments_folder> [--limit 16]
+    python scripts/benchmark.py lmstudio <segments_folder> --model <name> [--in-flight 1 --in-flight 4]
+"""
+
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+import cv2
+import numpy as np
+import srsly
+import typer
+from PIL import Image, ImageDraw, ImageFont
+from rich.console import Console
+from rich.table import Table
+
+from utils.files import get_image_files
+
+console = Console()
+app = typer.Typer()
+
+
+@app.callback()
+def main():
+    """Benchmark the document processing stages"""
+
+
+def time_call(fn, *args, **kwargs) -> tuple[float, object]:
+    """Run fn once and return (elapsed milliseconds, result)"""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return (time.perf_counter() - start) * 1000, result
+
+
+def load_reference_decisions(manifest_path: Path) -> dict:
+    """Map source path -> (should_split, split_point) from an earlier split manifest"""
+    decisions = {}
+    for entry in srsly.read_jsonl(manifest_path):
+        debug = entry.get("details", {}).get("debug")
+        if not debug or "source" not in entry:
+            continue
+        decisions[entry["source"]] = (bool(debug.get("should_split")), debug.get("split_point"))
+    return decisions
+
+
+@app.command("split")
+def benchmark_split(
+    images_folder: Path = typer.Argument(..., help="Folder of page images to analyse"),
+    reference: Optional[Path] = typer.Option(
+        None,
+        "--reference", "-r",
+        help="Split manifest from an earlier run to compare decisions against"
+    ),
+    edge_scale: float = typer.Option(1.0, "--edge-scale", help="Scale of the copy used for edge detection"),
+    coarse_factor: int = typer.Option(1, "--coarse-factor", help="Reduction factor for coarse-to-fine detection")
+):
+    """Time split detection per page and compare decisions with a reference run"""
+    import split
+
+    reference_decisions = load_reference_decisions(reference) if reference else {}
+    files = sorted(get_image_files(images_folder))
+    if not files:
+        console.print(f"[red]No images found in {images_folder}")
+        raise typer.Exit(1)
+
+    timings = []
+    compared = 0
+    mismatches = []
+    for file_path in files:
+        image = Image.open(file_path).convert("RGB")
+        elapsed, (should_split, split_point, _, _) = time_call(
+            split.detect_split_point, image, file_path=file_path,
+            edge_scale=edge_scale, coarse_factor=coarse_factor
+        )
+        timings.append(elapsed)
+
+        rel_path = str(file_path.relative_to(images_folder))
+        if rel_path in reference_decisions:
+            compared += 1
+            expected = reference_decisions[rel_path]
+            if expected != (bool(should_split), split_point):
+                mismatches.append((rel_path, expected, (bool(should_split), split_point)))
+
+    table = Table(title="Split detection")
+    table.add_column("Pages", justify="right")
+    table.add_column("Mean ms/page", justify="right")
+    table.add_column("Median ms/page", justify="right")
+    table.add_column("Max ms/page", justify="right")
+    table.add_row(
+        str(len(timings)),
+        f"{np.mean(timings):.1f}",
+        f"{np.median(timings):.1f}",
+        f"{np.max(timings):.1f}"
+    )
+    console.print(table)
+
+    if reference:
+        console.print(f"Compared with reference: {compared} pages, {len(mismatches)} mismatches")
+        for rel_path, expected, actual in mismatches:
+            console.print(f"[yellow]{rel_path}: reference {expected}, now {actual}")
+
+
+
+@app.command("formats")
+def benchmark_formats(
+    images_folder: Path = typer.Argument(..., help="Folder of page images to encode"),
+    limit: int = typer.Option(10, "--limit", help="Number of images to use")
+):
+    """Time encode and decode of each intermediate format and report size on disk"""
+    from utils.image_io import INTERMEDIATE_FORMATS, load_image, save_intermediate
+
+    files = sorted(get_image_files(images_folder))[:limit]
+    if not files:
+        console.print(f"[red]No images found in {images_folder}")
+        raise typer.Exit(1)
+    images = [load_image(file_path, "RGB") for file_path in files]
+    megapixels = sum(image.width * image.height for image in images) / 1e6
+
+    table = Table(title=f"Intermediate formats ({len(images)} images, {megapixels:.1f} MP)")
+    table.add_column("Format")
+    table.add_column("Encode ms/image", justify="right")
+    table.add_column("Decode ms/image", justify="right")
+    table.add_column("MB/image", justify="right")
+    table.add_column("Max pixel error", justify="right")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for fmt in INTERMEDIATE_FORMATS:
+            encode_ms, decode_ms, sizes, max_error = [], [], [], 0
+            for i, image in enumerate(images):
+                elapsed, out_path = time_call(save_intermediate, image, Path(tmp) / f"{fmt}_{i}", fmt)
+                encode_ms.append(elapsed)
+                sizes.append(out_path.stat().st_size)
+                # Force the full decode; PIL opens lazily
+                elapsed, decoded = time_call(lambda: np.asarray(load_image(out_path, "RGB")))
+                decode_ms.append(elapsed)
+                diff = np.abs(decoded.astype(np.int16) - np.asarray(image, dtype=np.int16))
+                max_error = max(max_error, int(diff.max()))
+            table.add_row(
+                fmt,
+                f"{np.mean(encode_ms):.1f}",
+                f"{np.mean(decode_ms):.1f}",
+                f"{np.mean(sizes) / 1e6:.2f}",
+                str(max_error)
+            )
+    console.print(table)
+
+
+
+def make_synthetic_page(rng: np.random.Generator, skew: float, ruled: bool = False, size: tuple[int, int] = (2400, 3400)) -> Image.Image:
+    """A paper-coloured page of random text lines, rotated so that skew (degrees) straightens it"""
+    width, height = size
+    words = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt".split()
+    font = ImageFont.load_default(size=44)
+    paper = np.full((height, width, 3), (236, 228, 210), dtype=np.int16)
+    paper += rng.integers(-8, 8, size=paper.shape, dtype=np.int16)
+    page = Image.fromarray(paper.astype(np.uint8))
+    draw = ImageDraw.Draw(page)
+
+    y = 200
+    while y < height - 250:
+        if ruled:
+            draw.line([(150, y + 52), (width - 150, y + 52)], fill=(120, 140, 200), width=3)
+        # Some rows stay empty, others end early like paragraph ends
+        x = 200
+        if rng.random() < 0.85:
+            while x < width - 400 and rng.random() > 0.04:
+                word = words[rng.integers(len(words))]
+                draw.text((x, y), word, fill=(40, 35, 30), font=font)
+                x += int(draw.textlength(word, font=font)) + int(rng.integers(20, 36))
+        y += int(rng.choice([70, 75, 80]))
+
+    # Rotating by -skew makes lines slope by +skew, which skew then undoes
+    M = cv2.getRotationMatrix2D((width / 2, height / 2), -skew, 1.0)
+    skewed = cv2.warpAffine(np.array(page), M, (width, height), borderValue=(236, 228, 210))
+    return Image.fromarray(skewed)
+
+
+@app.command("deskew")
+def benchmark_deskew(
+    pages: int = typer.Option(30, "--pages", help="Number of synthetic pages"),
+    max_skew: float = typer.Option(2.0, "--max-skew", help="Largest synthetic skew in degrees"),
+    scale: float = typer.Option(0.25, "--scale", help="Scale of the copy the engines estimate on"),
+    engines: Optional[list[str]] = typer.Option(None, "--engine", "-e", help="Engines to compare (default: all)"),
+    seed: int = typer.Option(0, "--seed", help="Random seed for the synthetic pages")
+):
+    """Compare deskew engines for angle error and time per page on synthetic skewed pages"""
+    from rotate import estimate_skew
+    from utils.deskew import ENGINES, get_engine
+
+    rng = np.random.default_rng(seed)
+    engines = engines or list(ENGINES)
+    with tempfile.TemporaryDirectory() as tmp:
+        # Every third page is ruled; the rest only have text to go by
+        truth = {}
+        for i in range(pages):
+            skew = float(rng.uniform(-max_skew, max_skew))
+            page_path = Path(tmp) / f"page_{i:03d}.jpg"
+            make_synthetic_page(rng, skew, ruled=(i % 3 == 0)).save(page_path, quality=92)
+            truth[page_path] = skew
+
+        table = Table(title=f"Deskew engines ({pages} synthetic pages, skew within {max_skew} deg, scale {scale})")
+        table.add_column("Engine")
+        table.add_column("Mean error deg", justify="right")
+        table.add_column("P95 error deg", justify="right")
+        table.add_column("Max error deg", justify="right")
+        table.add_column("No estimate", justify="right")
+        table.add_column("ms/page", justify="right")
+
+        failures = {}
+        for name in engines:
+            engine = get_engine(name)
+            errors, timings, missing = [], [], 0
+            try:
+                for page_path, skew in truth.items():
+                    # min_angle=0 makes every page go through refinement
+                    elapsed, (angle, _) = time_call(
+                        estimate_skew, page_path, scale, 0.0, engine, max(max_skew, 0.5) + 0.5
+                    )
+                    timings.append(elapsed)
+                    if angle is None:
+                        missing += 1
+                        angle = 0.0
+                    errors.append(abs(angle - skew))
+            except Exception as e:
+                failures[name] = f"{type(e).__name__}: {e}"
+                table.add_row(name, "-", "-", "-", "-", "[red]failed")
+                continue
+            table.add_row(
+                name,
+                f"{np.mean(errors):.3f}",
+                f"{np.percentile(errors, 95):.3f}",
+                f"{np.max(errors):.3f}",
+                str(missing),
+                f"{np.mean(timings):.1f}"
+            )
+    console.print(table)
+    for name, error in failures.items():
+        console.print(f"[yellow]{name} could not run: {error}")
+
+
+@app.command("enhance")
+def benchmark_enhance(
+    images_folder: Optional[Path] = typer.Argument(None, help="Folder of page images (default: synthetic 40-megapixel scans)"),
+    pages: int = typer.Option(3, "--pages", help="Number of pages to enhance"),
+    workers: Optional[int] = typer.Option(None, "--workers", help="Threads for the fused engine (default: CPU count)")
+):
+    """Compare time, allocated memory and output of the reference and fused enhancement engines"""
+    import tracemalloc
+    from enhance import DocumentEnhancer, FusedEnhancer
+
+    if images_folder:
+        images = [np.array(Image.open(file_path).convert("RGB")) for file_path in sorted(get_image_files(images_folder))[:pages]]
+    else:
+        rng = np.random.default_rng(0)
+        images = [np.array(make_synthetic_page(rng, 0.0, ruled=(i % 2 == 0), size=(5200, 7700))) for i in range(pages)]
+    if not images:
+        console.print(f"[red]No images found in {images_folder}")
+        raise typer.Exit(1)
+    megapixels = np.mean([image.shape[0] * image.shape[1] for image in images]) / 1e6
+
+    table = Table(title=f"Enhancement engines ({len(images)} pages, {megapixels:.1f} MP)")
+    table.add_column("Engine")
+    table.add_column("ms/page", justify="right")
+    table.add_column("Peak MB first page", justify="right")
+    table.add_column("Peak MB later pages", justify="right")
+    table.add_column("Max diff vs reference", justify="right")
+
+    # Alternate the two parameter sets so both CLAHE settings are exercised
+    settings = [("handwritten", 0.5), ("typescript", 0.0)]
+    reference_outputs = []
+    for name, enhancer in (("reference", DocumentEnhancer()), ("fused", FusedEnhancer(workers=workers))):
+        timings, peaks, max_diff = [], [], 0
+        for i, image in enumerate(images):
+            doc_type, is_yellowed = settings[i % 2]
+            tracemalloc.start()
+            enhancer.enhance(image, doc_type, is_yellowed)
+            peaks.append(tracemalloc.get_traced_memory()[1] / 1e6)
+            tracemalloc.stop()
+
+            # Timed separately, as tracing slows allocation down
+            elapsed, output = time_call(enhancer.enhance, image, doc_type, is_yellowed)
+            timings.append(elapsed)
+            if name == "reference":
+                reference_outputs.append(output)
+            else:
+                max_diff = max(max_diff, int(np.abs(output.astype(np.int16) - reference_outputs[i]).max()))
+        table.add_row(
+            name,
+            f"{np.mean(timings):.0f}",
+            f"{peaks[0]:.0f}",
+            f"{np.mean(peaks[1:]):.0f}" if len(peaks) > 1 else "-",
+            "-" if name == "reference" else str(max_diff)
+        )
+    console.print(table)
+
+
+@app.command("background")
+def benchmark_background(
+    images_folder: Path = typer.Argument(..., help="Folder of page images on a dark background"),
+    mask_scale: float = typer.Option(0.25, "--mask-scale", help="Scale of the copy the mask is computed on"),
+    tolerance: int = typer.Option(8, "--tolerance", help="Crop box difference in pixels to report")
+):
+    """Time background removal with a reduced mask against the full-resolution mask and compare crop boxes"""
+    from remove_background import BlackBackgroundRemoverMulti
+
+    files = sorted(get_image_files(images_folder))
+    if not files:
+        console.print(f"[red]No images found in {images_folder}")
+        raise typer.Exit(1)
+
+    full, reduced = BlackBackgroundRemoverMulti(1.0), BlackBackgroundRemoverMulti(mask_scale)
+    full_ms, reduced_ms, box_diffs, outliers = [], [], [], []
+    for file_path in files:
+        img_array = np.array(Image.open(file_path).convert("RGB"))
+        elapsed, (_, full_params) = time_call(full.remove_background, img_array)
+        full_ms.append(elapsed)
+        elapsed, (_, reduced_params) = time_call(reduced.remove_background, img_array)
+        reduced_ms.append(elapsed)
+
+        full_box, reduced_box = full_params.get("crop_bbox"), reduced_params.get("crop_bbox")
+        if full_box and reduced_box:
+            diff = int(np.max(np.abs(np.subtract(full_box, reduced_box))))
+            box_diffs.append(diff)
+            if diff > tolerance:
+                outliers.append((file_path.relative_to(images_folder), full_box, reduced_box))
+        elif full_params["method"] != reduced_params["method"]:
+            outliers.append((file_path.relative_to(images_folder), full_params["method"], reduced_params["method"]))
+
+    megapixels = np.mean([np.prod(Image.open(file_path).size) for file_path in files]) / 1e6
+    table = Table(title=f"Background removal ({len(files)} pages, {megapixels:.1f} MP, mask scale {mask_scale})")
+    table.add_column("Full mask ms/page", justify="right")
+    table.add_column("Reduced mask ms/page", justify="right")
+    table.add_column("Speed-up", justify="right")
+    table.add_column("Median box diff px", justify="right")
+    table.add_column(f"Pages over {tolerance} px", justify="right")
+    table.add_row(
+        f"{np.mean(full_ms):.0f}",
+        f"{np.mean(reduced_ms):.0f}",
+        f"{np.mean(full_ms) / np.mean(reduced_ms):.1f}x",
+        f"{np.median(box_diffs):.0f}" if box_diffs else "-",
+        str(len(outliers))
+    )
+    console.print(table)
+    for rel_path, expected, actual in outliers:
+        console.print(f"[yellow]{rel_path}: full {expected}, reduced {actual}")
+
+
+@app.command("background-outputs")
+def benchmark_background_outputs(
+    images_folder: Path = typer.Argument(..., help="Folder of page images on a dark background"),
+    limit: int = typer.Option(5, "--limit", help="Number of images to use")
+):
+    """Report bytes, encode and decode time of each way remove_background can write its pages"""
+    from remove_background import remove_background_from_image
+    from utils.image_io import flatten_alpha, load_image, save_background_removed
+
+    files = sorted(get_image_files(images_folder))[:limit]
+    if not files:
+        console.print(f"[red]No images found in {images_folder}")
+        raise typer.Exit(1)
+    pages = [remove_background_from_image(load_image(file_path, "RGB"))[0] for file_path in files]
+    # Downstream stages end up with the page flattened onto white
+    references = [np.asarray(flatten_alpha(page), dtype=np.int16) for page in pages]
+    megapixels = np.mean([page.width * page.height for page in pages]) / 1e6
+
+    modes = [
+        ("rgba", "png"), ("rgba", "webp"), ("rgba", "webp-lossy"),
+        ("flat", "jpeg"), ("flat", "webp-lossy"),
+        ("mask", "jpeg"), ("mask1", "jpeg"), ("mask1", "webp-lossy")
+    ]
+    table = Table(title=f"Background-removed page outputs ({len(pages)} pages, {megapixels:.1f} MP)")
+    table.add_column("Output")
+    table.add_column("Format")
+    table.add_column("Encode ms/page", justify="right")
+    table.add_column("Decode ms/page", justify="right")
+    table.add_column("MB/page", justify="right")
+    table.add_column("Max error after flattening", justify="right")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for output, fmt in modes:
+            encode_ms, decode_ms, sizes, max_error = [], [], [], 0
+            for i, page in enumerate(pages):
+                elapsed, written = time_call(save_background_removed, page, Path(tmp) / f"{output}_{fmt}_{i}", fmt, output)
+                encode_ms.append(elapsed)
+                sizes.append(sum(path.stat().st_size for path in written))
+                # Load the way convert_to_word does, including any mask file
+                elapsed, decoded = time_call(lambda: np.asarray(flatten_alpha(load_image(written[0]))))
+                decode_ms.append(elapsed)
+                max_error = max(max_error, int(np.abs(decoded.astype(np.int16) - references[i]).max()))
+                for path in written:
+                    path.unlink()
+            table.add_row(
+                output,
+                fmt,
+                f"{np.mean(encode_ms):.0f}",
+                f"{np.mean(decode_ms):.0f}",
+                f"{np.mean(sizes) / 1e6:.2f}",
+                str(max_error)
+            )
+    console.print(table)
+
+
+def match_boundaries(boundaries: list[int], reference: list[int], tolerance: int) -> int:
+    """Number of boundaries within tolerance pixels of a reference boundary"""
+    if not boundaries or not reference:
+        return 0
+    reference = np.asarray(reference)
+    return sum(int(np.abs(reference - boundary).min() <= tolerance) for boundary in boundaries)
+
+
+@app.command("segment")
+def benchmark_segment(
+    images_folder: Optional[Path] = typer.Argument(None, help="Folder of page images (default: synthetic pages)"),
+    pages: int = typer.Option(10, "--pages", help="Number of pages to segment"),
+    tolerance: int = typer.Option(40, "--tolerance", help="Pixels two cut lines may differ by and still agree"),
+    seed: int = typer.Option(0, "--seed", help="Random seed for the synthetic pages")
+):
+    """Compare the projection segmentation engine with the Tesseract engine: time, segment count and cut lines"""
+    from segment import adaptive_segment_image
+    from utils import ocr
+    from utils.page_layout import ProjectionLayout, TesseractLayout
+
+    if images_folder:
+        files = sorted(get_image_files(images_folder))[:pages]
+        if not files:
+            console.print(f"[red]No images found in {images_folder}")
+            raise typer.Exit(1)
+        images = [(str(file_path.relative_to(images_folder)), Image.open(file_path).convert("RGB")) for file_path in files]
+    else:
+        rng = np.random.default_rng(seed)
+        images = [(f"synthetic_{i:03d}", make_synthetic_page(rng, 0.0, ruled=(i % 3 == 0))) for i in range(pages)]
+
+    engines = [ProjectionLayout]
+    try:
+        ocr.check()
+        engines.insert(0, TesseractLayout)
+    except Exception as e:
+        console.print(f"[yellow]Tesseract engine could not run ({type(e).__name__}: {e}); timing projection only")
+
+    results = {}
+    for engine in engines:
+        timings, counts, cuts, lengths = [], [], [], []
+        for _, image in images:
+            elapsed, segments = time_call(adaptive_segment_image, image, layout_engine=engine)
+            timings.append(elapsed)
+            counts.append(len(segments))
+            cuts.append([segment["top"] for segment in segments[1:]])
+            lengths.append(sum(segment["text_len"] for segment in segments))
+        results[engine.name] = (timings, counts, cuts, lengths)
+
+    table = Table(title=f"Segmentation engines ({len(images)} pages, cut lines agree within {tolerance} px)")
+    table.add_column("Engine")
+    table.add_column("ms/page", justify="right")
+    table.add_column("Segments/page", justify="right")
+    table.add_column("Cuts matching tesseract", justify="right")
+    table.add_column("Tesseract cuts found", justify="right")
+    table.add_column("Text length vs tesseract", justify="right")
+    for name, (timings, counts, cuts, lengths) in results.items():
+        row = [name, f"{np.mean(timings):.0f}", f"{np.mean(counts):.1f}", "-", "-", "-"]
+        if name != "tesseract" and "tesseract" in results:
+            _, _, reference_cuts, reference_lengths = results["tesseract"]
+            matched = sum(match_boundaries(page, reference, tolerance) for page, reference in zip(cuts, reference_cuts))
+            found = sum(match_boundaries(reference, page, tolerance) for page, reference in zip(cuts, reference_cuts))
+            ratios = [length / reference for length, reference in zip(lengths, reference_lengths) if reference]
+            row[3] = f"{matched}/{sum(map(len, cuts))}"
+            row[4] = f"{found}/{sum(map(len, reference_cuts))}"
+            row[5] = f"{np.median(ratios):.2f}x" if ratios else "-"
+        table.add_row(*row)
+    console.print(table)
+
+
+@app.command("ocr")
+def benchmark_ocr(
+    images_folder: Optional[Path] = typer.Argument(None, help="Folder of page images (default: synthetic pages)"),
+    pages: int = typer.Option(5, "--pages", help="Number of pages to OCR"),
+    workers: int = typer.Option(1, "--workers", help="Threads sharing the tesserocr pool"),
+    seed: int = typer.Option(0, "--seed", help="Random seed for the synthetic pages")
+):
+    """Compare word-level OCR through pytesseract subprocesses with the in-process tesserocr pool"""
+    from concurrent.futures import ThreadPoolExecutor
+    from utils.ocr import HAS_TESSEROCR, SubprocessOCR, TesseractPool
+
+    if images_folder:
+        files = sorted(get_image_files(images_folder))[:pages]
+        if not files:
+            console.print(f"[red]No images found in {images_folder}")
+            raise typer.Exit(1)
+        images = [np.array(Image.open(file_path).convert("L")) for file_path in files]
+    else:
+        rng = np.random.default_rng(seed)
+        images = [np.array(make_synthetic_page(rng, 0.0).convert("L")) for _ in range(pages)]
+
+    services = [("pytesseract", SubprocessOCR())]
+    if not HAS_TESSEROCR:
+        console.print("[yellow]tesserocr is not installed (pip install tesserocr); timing pytesseract only")
+    else:
+        services.append(("tesserocr pool", TesseractPool(size=workers)))
+
+    table = Table(title=f"Word-level OCR ({len(images)} pages, {workers} worker(s) for the pool)")
+    table.add_column("Backend")
+    table.add_column("First call ms", justify="right")
+    table.add_column("ms/page", justify="right")
+    table.add_column("Words/page", justify="right")
+    table.add_column("Same words as pytesseract", justify="right")
+    reference_words = None
+    for name, service in services:
+        try:
+            service.check()
+            first_ms, _ = time_call(service.image_to_data, images[0])
+            with ThreadPoolExecutor(max_workers=workers if name != "pytesseract" else 1) as executor:
+                elapsed, results = time_call(lambda: list(executor.map(service.image_to_data, images)))
+        except Exception as e:
+            table.add_row(name, "-", "-", "-", "[red]failed")
+            console.print(f"[yellow]{name} could not run: {type(e).__name__}: {e}")
+            continue
+        finally:
+            service.close()
+        words = [[text.strip() for text in data["text"] if text.strip()] for data in results]
+        same = "-"
+        if reference_words is None:
+            reference_words = words
+        else:
+            matching = sum(a == b for page, reference in zip(words, reference_words) for a, b in zip(page, reference))
+            same = f"{matching}/{sum(map(len, reference_words))}"
+        table.add_row(
+            name,
+            f"{first_ms:.0f}",
+            f"{elapsed / len(images):.0f}",
+            f"{np.mean([len(page) for page in words]):.0f}",
+            same
+        )
+    console.print(table)
+
+
+@app.command("transcribe")
+def benchmark_transcribe(
+    images_folder: Path = typer.Argument(..., help="Folder of segment images"),
+    limit: int = typer.Option(32, "--limit", help="Number of images to transcribe"),
+    batch_sizes: Optional[list[int]] = typer.Option(None, "--batch-size", "-b", help="Batch sizes to compare (default: 1, 4 and 8)"),
+    model_name: str = typer.Option("Qwen/Qwen2-VL-2B-Instruct", "--model", "-m", help="Model to load"),
+    seed: int = typer.Option(0, "--seed", help="Sampling seed for every run")
+):
+    """Compare batched Qwen2-VL transcription with one image per generate call, in segments per minute"""
+    import torch
+    from transcribe_qwen_2b import TranscriptionProcessor, bucket_size
+
+    files = sorted(get_image_files(images_folder))[:limit]
+    if not files:
+        console.print(f"[red]No images found in {images_folder}")
+        raise typer.Exit(1)
+    transcriber = TranscriptionProcessor(model_name=model_name)
+    if transcriber.model is None:
+        console.print(f"[red]Could not load {model_name}")
+        raise typer.Exit(1)
+
+    images, max_new_tokens = [], []
+    for file_path in files:
+        image = Image.open(file_path).convert("RGB")
+        max_new_tokens.append(transcriber.max_new_tokens(transcriber.estimate_text_density(image)))
+        prepared, _ = transcriber.prepare_image(image)
+        images.append(prepared)
+    sizes = [image.size for image in images if image is not None]
+    buckets = {bucket_size(size) for size in sizes}
+    padding = 1 - sum(w * h for w, h in sizes) / sum(np.prod(bucket_size(size)) for size in sizes)
+
+    table = Table(title=f"Qwen2-VL transcription ({len(images)} segments, {len(buckets)} size buckets, {padding:.0%} padding)")
+    table.add_column("Batch size", justify="right")
+    table.add_column("Segments/min", justify="right")
+    table.add_column("Speed-up", justify="right")
+    table.add_column("Non-empty", justify="right")
+    baseline = None
+    for batch_size in batch_sizes or [1, 4, 8]:
+        torch.manual_seed(seed)
+        if batch_size == 1:
+            elapsed, texts = time_call(
+                lambda: [transcriber.process_image(image, tokens, prepared=True) for image, tokens in zip(images, max_new_tokens)]
+            )
+        else:
+            elapsed, texts = time_call(transcriber.process_images, images, max_new_tokens, batch_size, prepared=True)
+        per_minute = len(images) / (elapsed / 60000)
+        baseline = baseline or per_minute
+        table.add_row(
+            str(batch_size),
+            f"{per_minute:.1f}",
+            f"{per_minute / baseline:.2f}x",
+            f"{sum(bool(text) for text in texts)}/{len(texts)}"
+        )
+    console.print(table)
+
+
+@app.command("visual-tokens")
+def benchmark_visual_tokens(
+    images_folder: Path = typer.Argument(..., help="Folder of segment or page images"),
+    min_pixels: Optional[int] = typer.Option(None, "--min-pixels", help="Fewest pixels per image (default: the transcriber's)"),
+    max_pixels: Optional[int] = typer.Option(None, "--max-pixels", help="Most pixels per image (default: the transcriber's)"),
+    show: int = typer.Option(10, "--show", help="Images to list, the most expensive first")
+):
+    """Report the Qwen2-VL visual tokens each image costs with the given pixel limits and with the defaults"""
+    from utils import visual_budget
+
+    files = sorted(get_image_files(images_folder))
+    if not files:
+        console.print(f"[red]No images found in {images_folder}")
+        raise typer.Exit(1)
+    budget = visual_budget.VisualBudget(
+        min_pixels=min_pixels or visual_budget.MIN_PIXELS,
+        max_pixels=max_pixels or visual_budget.MAX_PIXELS
+    )
+    default = visual_budget.VisualBudget()
+
+    rows = []
+    for file_path in files:
+        image = Image.open(file_path)
+        rows.append((str(file_path.relative_to(images_folder)), image.size, budget.plan(image), default.plan(image)["visual_tokens"]))
+
+    table = Table(title=f"Visual tokens per image ({len(rows)} images)")
+    table.add_column("Image")
+    table.add_column("Original", justify="right")
+    table.add_column("Shown at", justify="right")
+    table.add_column("Tokens", justify="right")
+    table.add_column("Default limits", justify="right")
+    for name, original, plan, default_tokens in sorted(rows, key=lambda row: -row[2]["visual_tokens"])[:show]:
+        table.add_row(
+            name,
+            "x".join(map(str, original)),
+            "x".join(map(str, plan["size"])),
+            str(plan["visual_tokens"]),
+            str(default_tokens)
+        )
+    console.print(table)
+
+    tokens = np.array([plan["visual_tokens"] for _, _, plan, _ in rows])
+    default_tokens = np.array([tokens for _, _, _, tokens in rows])
+    console.print(
+        f"{tokens.sum()} tokens (mean {tokens.mean():.0f}, p95 {np.percentile(tokens, 95):.0f}), "
+        f"default limits: {default_tokens.sum()} tokens (mean {default_tokens.mean():.0f}, p95 {np.percentile(default_tokens, 95):.0f})"
+    )
+
+
+def character_error_rate(text: str, reference: str) -> float:
+    """Edit distance between text and reference, per character of reference"""
+    if not reference:
+        return float(bool(text))
+    previous = list(range(len(text) + 1))
+    for i, ref_char in enumerate(reference, 1):
+        current = [i]
+        for j, char in enumerate(text, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != ref_char)))
+        previous = current
+    return previous[-1] / len(reference)
+
+
+@app.command("precision")
+def benchmark_precision(
+    images_folder: Path = typer.Argument(..., help="Folder of segment images"),
+    limit: int = typer.Option(8, "--limit", help="Number of images to transcribe (the first ones by name)"),
+    precisions: Optional[list[str]] = typer.Option(None, "--precision", "-p", help="CPU precisions to compare with fp32 (default: bf16 and int8)"),
+    threads: int = typer.Option(0, "--threads", "-t", help="Intra-op CPU threads (0: torch's default)"),
+    model_name: str = typer.Option("Qwen/Qwen2-VL-2B-Instruct", "--model", "-m", help="Model to load")
+):
+    """Compare load time, generated tokens per second and CER against fp32 of the CPU precisions of transcribe_qwen_2b"""
+    import torch
+    from transcribe_qwen_2b import PRECISIONS, TranscriptionProcessor
+
+    files = sorted(get_image_files(images_folder))[:limit]
+    if not files:
+        console.print(f"[red]No images found in {images_folder}")
+        raise typer.Exit(1)
+    precisions = ["fp32"] + [precision for precision in precisions or ["bf16", "int8"] if precision != "fp32"]
+    for precision in precisions:
+        if precision not in PRECISIONS or precision == "auto":
+            raise typer.BadParameter(f"Unknown CPU precision: {precision} (use fp32, bf16 or int8)")
+
+    table = Table(title=f"Qwen2-VL on the CPU ({len(files)} segments, {threads or torch.get_num_threads()} threads)")
+    table.add_column("Precision")
+    table.add_column("Load (s)", justify="right")
+    table.add_column("Tokens/s", justify="right")
+    table.add_column("Segments/min", justify="right")
+    table.add_column("CER vs fp32", justify="right")
+    images, max_new_tokens, reference = None, None, None
+    for precision in precisions:
+        # One model at a time: the transcriber keeps a single loaded model
+        TranscriptionProcessor.reset()
+        # Greedy decoding, so the CER measures precision rather than sampling
+        load_ms, transcriber = time_call(TranscriptionProcessor, model_name=model_name, precision=precision, threads=threads or None, decoding="greedy")
+        if transcriber.model is None:
+            console.print(f"[red]Could not load {model_name} in {precision}")
+            raise typer.Exit(1)
+        if images is None:
+            images, max_new_tokens = [], []
+            for file_path in files:
+                image = Image.open(file_path).convert("RGB")
+                max_new_tokens.append(transcriber.max_new_tokens(transcriber.estimate_text_density(image)))
+                images.append(transcriber.prepare_image(image)[0])
+
+        elapsed, texts = time_call(
+            lambda: [transcriber.process_image(image, tokens, prepared=True) for image, tokens in zip(images, max_new_tokens)]
+        )
+        generated = sum(transcriber.count_tokens(text) for text in texts)
+        reference = reference or texts
+        cer = np.mean([character_error_rate(text, ref) for text, ref in zip(texts, reference)])
+        table.add_row(
+            precision,
+            f"{load_ms / 1000:.1f}",
+            f"{generated / (elapsed / 1000):.1f}",
+            f"{len(images) / (elapsed / 60000):.1f}",
+            f"{cer:.3f}" if precision != "fp32" else "-"
+        )
+    TranscriptionProcessor.reset()
+    console.print(table)
+
+
+@app.command("decoding")
+def benchmark_decoding(
+    images_folder: Path = typer.Argument(..., help="Folder of segment images"),
+    limit: int = typer.Option(16, "--limit", help="Number of images to transcribe (the first ones by name)"),
+    model_name: str = typer.Option("Qwen/Qwen2-VL-2B-Instruct", "--model", "-m", help="Model to load"),
+    precision: str = typer.Option("auto", "--precision", help="Model precision, as transcribe_qwen_2b --precision"),
+    seed: int = typer.Option(0, "--seed", help="Sampling seed for every run")
+):
+    """Compare sampled and greedy decoding of transcribe_qwen_2b, with and without stopping repetition loops"""
+    import torch
+    from transcribe_qwen_2b import TranscriptionProcessor
+
+    files = sorted(get_image_files(images_folder))[:limit]
+    if not files:
+        console.print(f"[red]No images found in {images_folder}")
+        raise typer.Exit(1)
+    transcriber = TranscriptionProcessor(model_name=model_name, precision=precision)
+    if transcriber.model is None:
+        console.print(f"[red]Could not load {model_name}")
+        raise typer.Exit(1)
+    images, max_new_tokens = [], []
+    for file_path in files:
+        image = Image.open(file_path).convert("RGB")
+        max_new_tokens.append(transcriber.max_new_tokens(transcriber.estimate_text_density(image)))
+        images.append(transcriber.prepare_image(image)[0])
+
+    table = Table(title=f"Qwen2-VL decoding ({len(images)} segments, {sum(max_new_tokens)} tokens allowed)")
+    table.add_column("Decoding")
+    table.add_column("Loop stop")
+    table.add_column("Segments/min", justify="right")
+    table.add_column("Tokens generated", justify="right")
+    table.add_column("Loops stopped", justify="right")
+    table.add_column("Non-empty", justify="right")
+    for decoding, stop_loops in [("sample", False), ("sample", True), ("greedy", False), ("greedy", True)]:
+        transcriber.decoding, transcriber.stop_loops = decoding, stop_loops
+        transcriber.stats = {"generated_tokens": 0, "loops_stopped": 0}
+        torch.manual_seed(seed)
+        elapsed, texts = time_call(
+            lambda: [transcriber.process_image(image, tokens, prepared=True) for image, tokens in zip(images, max_new_tokens)]
+        )
+        table.add_row(
+            decoding,
+            "yes" if stop_loops else "no",
+            f"{len(images) / (elapsed / 60000):.1f}",
+            str(transcriber.stats["generated_tokens"]),
+            str(transcriber.stats["loops_stopped"]) if stop_loops else "-",
+            f"{sum(bool(text) for text in texts)}/{len(texts)}"
+        )
+    console.print(table)
+
+
+@app.command("prefill")
+def benchmark_prefill(
+    images_folder: Path = typer.Argument(..., help="Folder of segment images"),
+    limit: int = typer.Option(16, "--limit", help="Number of images to prefill (the first ones by name)"),
+    model_name: str = typer.Option("Qwen/Qwen2-VL-2B-Instruct", "--model", "-m", help="Model to load"),
+    precision: str = typer.Option("auto", "--precision", help="Model precision, as transcribe_qwen_2b --precision")
+):
+    """Time prompt prefill per segment in full and from the cached prompt prefix, with the image or the prompt first"""
+    import torch
+    from transcribe_qwen_2b import TranscriptionProcessor
+
+    files = sorted(get_image_files(images_folder))[:limit]
+    if not files:
+        console.print(f"[red]No images found in {images_folder}")
+        raise typer.Exit(1)
+    transcriber = TranscriptionProcessor(model_name=model_name, precision=precision)
+    if transcriber.model is None:
+        console.print(f"[red]Could not load {model_name}")
+        raise typer.Exit(1)
+    images = [image for image, _ in (transcriber.prepare_image(Image.open(file_path).convert("RGB")) for file_path in files) if image is not None]
+
+    table = Table(title=f"Qwen2-VL prompt prefill ({len(images)} segments)")
+    table.add_column("Order")
+    table.add_column("Prompt tokens", justify="right")
+    table.add_column("Cached prefix", justify="right")
+    table.add_column("Full (ms)", justify="right")
+    table.add_column("Cached (ms)", justify="right")
+    table.add_column("Same logits", justify="right")
+    for prompt_first in (False, True):
+        transcriber.prompt_first = prompt_first
+        transcriber._prefix = None
+        prompt_tokens, full_ms, cached_ms, same = [], [], [], 0
+        for image in images:
+            inputs = transcriber._inputs([image])
+            with torch.no_grad():
+                elapsed, _ = time_call(transcriber.model, **inputs)
+            full_ms.append(elapsed)
+            if transcriber._prefix is None:
+                transcriber.prefill(inputs)  # The prefix is computed once, outside the timings
+            elapsed, prefilled = time_call(transcriber.prefill, inputs)
+            cached_ms.append(elapsed)
+            same += transcriber._check_prefill(inputs, prefilled)
+            prompt_tokens.append(inputs["input_ids"].shape[1])
+        table.add_row(
+            "prompt, image" if prompt_first else "image, prompt",
+            f"{np.mean(prompt_tokens):.0f}",
+            str(transcriber._prefix[0].shape[1]),
+            f"{np.mean(full_ms):.0f}",
+            f"{np.mean(cached_ms):.0f}",
+            f"{same}/{len(images)}"
+        )
+    console.print(table)
+
+
+@app.command("lmstudio")
+def benchmark_lmstudio(
+    images_folder: Path = typer.Argument(..., help="Folder of segment images"),
+    model_name: str = typer.Option(..., "--model", "-m", help="Model name in LM Studio"),
+    api_url: str = typer.Option("http://localhost:1234", "--api-url", help="LM Studio API URL (without /v1)"),
+    limit: int = typer.Option(16, "--limit", help="Number of images to transcribe (the first ones by name)"),
+    in_flights: Optional[list[int]] = typer.Option(None, "--in-flight", "-j", help="Requests in flight to compare (default: 1, 2 and 4)")
+):
+    """Compare LM Studio transcription one request at a time with several requests in flight, in segments per minute"""
+    from transcribe_lmstudio import LMStudioTranscriber
+
+    files = sorted(get_image_files(images_folder))[:limit]
+    if not files:
+        console.print(f"[red]No images found in {images_folder}")
+        raise typer.Exit(1)
+    if not api_url.endswith("/v1"):
+        api_url = f"{api_url}/v1"
+
+    def load():
+        for file_path in files:
+            yield Image.open(file_path).convert("RGB")
+
+    table = Table(title=f"LM Studio transcription ({len(files)} segments, {model_name})")
+    table.add_column("Requests in flight", justify="right")
+    table.add_column("Segments/min", justify="right")
+    table.add_column("Speed-up", justify="right")
+    table.add_column("Non-empty", justify="right")
+    # One image read, encoded and sent after another, as before requests were pipelined
+    transcriber = LMStudioTranscriber(api_url, model_name)
+    elapsed, texts = time_call(lambda: [transcriber.process_image(image) for image in load()])
+    baseline = len(files) / (elapsed / 60000)
+    table.add_row("1, in turn", f"{baseline:.1f}", "1.00x", f"{sum(bool(text) for text in texts)}/{len(texts)}")
+    for in_flight in in_flights or [1, 2, 4]:
+        transcriber = LMStudioTranscriber(api_url, model_name, in_flight=in_flight)
+        elapsed, results = time_call(lambda: list(transcriber.process_images(load())))
+        per_minute = len(files) / (elapsed / 60000)
+        table.add_row(
+            str(in_flight),
+            f"{per_minute:.1f}",
+            f"{per_minute / baseline:.2f}x",
+            f"{sum(bool(text) for _, text in results)}/{len(results)}"
+        )
+    console.print(table)
+
+
+@app.command("doctype")
+def benchmark_doctype(
+    images_folder: Path = typer.Argument(..., help="Folder of page images to classify"),
+    labels: Optional[Path] = typer.Option(
+        None,
+        "--labels", "-l",
+        help="JSON mapping image path (relative to the folder) to 'typescript' or 'handwritten'"
+    ),
+    ocr: bool = typer.Option(True, "--ocr/--no-ocr", help="Also run the OCR-based decision and report agreement")
+):
+    """Time the layout document-type classifier and compare it with OCR and with labels"""
+    from enhance import DocumentAnalyzer
+
+    expected = srsly.read_json(labels) if labels else {}
+    files = sorted(get_image_files(images_folder))
+    if not files:
+        console.print(f"[red]No images found in {images_folder}")
+        raise typer.Exit(1)
+
+    analyzer = DocumentAnalyzer()
+    rows, timings, ocr_timings = [], [], []
+    ocr_error = None
+    if ocr:
+        from utils.ocr import check
+        try:
+            check()
+        except Exception as e:
+            ocr_error = f"{type(e).__name__}: {e}"
+    for file_path in files:
+        rel_path = str(file_path.relative_to(images_folder))
+        gray = cv2.cvtColor(np.array(Image.open(file_path).convert("RGB")), cv2.COLOR_RGB2GRAY)
+        elapsed, (doc_type, confidence, _) = time_call(analyzer.classify_document_type, gray)
+        timings.append(elapsed)
+
+        ocr_type = None
+        if ocr and ocr_error is None:
+            elapsed, ocr_type = time_call(analyzer._ocr_document_type, gray)
+            ocr_timings.append(elapsed)
+        rows.append((rel_path, doc_type, confidence, ocr_type, expected.get(rel_path)))
+
+    def agreement(pairs):
+        pairs = [(a, b) for a, b in pairs if b is not None]
+        if not pairs:
+            return "-"
+        return f"{sum(a == b for a, b in pairs)}/{len(pairs)}"
+
+    low_confidence = [row for row in rows if row[2] < analyzer.min_confidence]
+    table = Table(title="Document type classification")
+    table.add_column("Pages", justify="right")
+    table.add_column("Classifier ms/page", justify="right")
+    table.add_column("OCR ms/page", justify="right")
+    table.add_column("Agrees with OCR", justify="right")
+    table.add_column("Agrees with labels", justify="right")
+    table.add_column("OCR with labels", justify="right")
+    table.add_column(f"Below {analyzer.min_confidence} confidence", justify="right")
+    table.add_row(
+        str(len(rows)),
+        f"{np.mean(timings):.1f}",
+        f"{np.mean(ocr_timings):.1f}" if ocr_timings else "-",
+        agreement((row[1], row[3]) for row in rows),
+        agreement((row[1], row[4]) for row in rows),
+        agreement((row[3], row[4]) for row in rows if row[3] is not None),
+        str(len(low_confidence))
+    )
+    console.print(table)
+
+    if ocr_error:
+        console.print(f"[yellow]OCR could not run: {ocr_error}")
+    for rel_path, doc_type, confidence, ocr_type, label in rows:
+        if (label and doc_type != label) or (ocr_type and doc_type != ocr_type):
+            console.print(f"[yellow]{rel_path}: classifier {doc_type} ({confidence:.2f}), OCR {ocr_type}, label {label}")
+
+
+if __name__ == "__main__":
+    app()
@@ -13,6 +13,7 @@ import json
 from utils.batch import BatchProcessor
 from utils.processor import process_file
 from utils.segment_handler import SegmentHandler
+from utils.image_io import flatten_alpha, load_image
 from utils.files import ensure_dirs
 
 console = Console()
@@ -106,16 +107,9 @@ def create_spread(doc, image_path, text, filename):
     run = p.add_run()
     
     try:
-        with Image.open(image_path) as img:
-            # Convert to RGB (removing alpha channel)
-            if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
-                bg = Image.new('RGB', img.size, 'white')
-                if img.mode != 'RGBA':
-                    img = img.convert('RGBA')
-                bg.paste(img, mask=img.split()[3])
-                img = bg
-            elif img.mode != 'RGB':
-                img = img.convert('RGB')
+        with load_image(image_path) as img:
+            # Convert to RGB, compositing any alpha (or separate mask) onto white
+            img = flatten_alpha(img)
             
             # Calculate dimensions for page
             available_width = 8.5 - (2 * margin.inches)
@@ -239,7 +233,9 @@ def process_document(file_path: str, output_folder: Path) -> dict:
         file_types={
             '.png': process_fn,
             '.jpg': process_fn,
-            '.jpeg': process_fn
+            '.jpeg': process_fn,
+            '.webp': process_fn,
+            '.npy': process_fn
         }
     )
 
@@ -0,0 +1,54 @@
+import typer
+from pathlib import Path
+from rich.console import Console
+from rich.table import Table
+from utils.token_budget import TokenBudget, heuristic_max_new_tokens, read_pairs
+
+console = Console()
+
+def fit_token_budget(
+    manifests: list[Path] = typer.Argument(..., help="Transcription manifests to learn from (missing ones are skipped)"),
+    output: Path = typer.Option(..., "--output", "-o", help="Where to save the fitted budget (.json)"),
+    quantile: float = typer.Option(0.95, "--quantile", "-q", min=0.5, max=1.0, help="Quantile of transcribed tokens to allow"),
+    headroom: float = typer.Option(1.1, "--headroom", min=1.0, help="Factor on top of the quantile"),
+    min_per_bin: int = typer.Option(20, "--min-per-bin", min=1, help="Fewest images per range of estimates")
+):
+    """
+    Fit the max_new_tokens transcribe_qwen_2b allows from the word estimates
+    and token counts in earlier transcription manifests, and report the
+    generation budget it saves over the fixed rule on those images.
+    """
+    pairs = []
+    for manifest in manifests:
+        # A project may have whole-page transcriptions, segment ones or both
+        if not manifest.exists():
+            console.print(f"[yellow]Skipping missing manifest: {manifest}")
+            continue
+        pairs.extend(read_pairs(manifest))
+    try:
+        budget = TokenBudget.fit(pairs, quantile=quantile, headroom=headroom, min_per_bin=min_per_bin)
+    except ValueError as e:
+        console.print(f"[red]{e}")
+        raise typer.Exit(1)
+    budget.save(output)
+
+    table = Table(title=f"Token budget ({len(pairs)} images, {quantile:.0%} quantile x {headroom})")
+    table.add_column("Estimated words", justify="right")
+    table.add_column("max_new_tokens", justify="right")
+    table.add_column("Fixed rule", justify="right")
+    for words in budget.words:
+        table.add_row(f"{words:.0f}", str(budget.predict(int(words))), str(heuristic_max_new_tokens(int(words))))
+    console.print(table)
+
+    fitted = sum(budget.predict(words) for words, _ in pairs)
+    fixed = sum(heuristic_max_new_tokens(words) for words, _ in pairs)
+    covered = sum(tokens <= budget.predict(words) for words, tokens in pairs)
+    fixed_covered = sum(tokens <= heuristic_max_new_tokens(words) for words, tokens in pairs)
+    console.print(
+        f"Generation budget: {fitted} tokens instead of {fixed} ({1 - fitted / max(fixed, 1):.0%} saved); "
+        f"{covered / len(pairs):.0%} of images fit their budget ({fixed_covered / len(pairs):.0%} with the fixed rule)"
+    )
+    console.print(f"[green]Saved to {output}")
+
+if __name__ == "__main__":
+    typer.run(fit_token_budget)
@@ -7,6 +7,7 @@ from typing import Literal
 
 from utils.batch import BatchProcessor
 from utils.processor import process_file
+from utils.image_io import BACKGROUND_OUTPUTS, intermediate_suffix, load_image, save_background_removed
 
 class BlackBackgroundRemoverMulti:
     """
@@ -16,8 +17,95 @@ class BlackBackgroundRemoverMulti:
     3) Keeps a subset of contours based on heuristic (e.g., biggest or center-located)
     4) Morphologically refine, blur => alpha
     5) Crop final image to bounding box of alpha
+
+    With mask_scale below 1 (the default is 0.25), steps 1-4 run on a
+    reduced copy, with kernels scaled to match. Each edge of the crop box is
+    then placed where the full-resolution mask puts it, computing that mask
+    only in a strip around the edge, and the alpha mask is upsampled smoothly
+    for the crop box only (compare with 1 in benchmark.py background).
     """
 
+    # Side of the square the gray is averaged over before thresholding, in
+    # full-resolution pixels
+    SMOOTH_SIZE = 16
+    # Opening, closing and blur kernels of the mask, in full-resolution pixels
+    OPEN_SIZE = 5
+    CLOSE_SIZE = 7
+    BLUR_SIZE = 21
+    BLACK_THRESH = 80
+
+    def __init__(self, mask_scale: float = 0.25):
+        self.mask_scale = min(max(mask_scale, 0.01), 1.0)
+
+    def _kernel(self, size: int, odd: bool = False) -> int:
+        """A full-resolution kernel size scaled to the mask resolution"""
+        scaled = max(3, int(round(size * self.mask_scale)))
+        if odd and scaled % 2 == 0:
+            scaled += 1
+        return scaled
+
+    def _edge_strip_mask(self, bin_mask: np.ndarray, kept: np.ndarray) -> np.ndarray:
+        """
+        Steps C-E at full resolution on a thresholded strip across a crop box
+        edge, oriented so its last row lies inside the box: the objects that
+        reach that row and lie mostly inside `kept` (the objects kept on the
+        reduced mask, upsampled), opened, closed and blurred. Returns the alpha
+        """
+        n_labels, labels = cv2.connectedComponents(bin_mask, connectivity=8)
+        inside = np.bincount(labels.ravel(), weights=kept.ravel() > 0, minlength=n_labels)
+        inside /= np.maximum(np.bincount(labels.ravel(), minlength=n_labels), 1)
+        keep = np.zeros(n_labels, dtype=bool)
+        keep[labels[-1]] = True
+        keep &= inside > 0.5
+        keep[0] = False
+        doc_mask = keep[labels].astype(np.uint8) * 255
+        doc_mask = cv2.morphologyEx(doc_mask, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (self.OPEN_SIZE,) * 2))
+        doc_mask = cv2.morphologyEx(doc_mask, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (self.CLOSE_SIZE,) * 2))
+        blurred = cv2.GaussianBlur(doc_mask, (self.BLUR_SIZE,) * 2, 0)
+        return (blurred.astype(np.float32) / 255.0 * 0.95 * 255).astype(np.uint8)
+
+    def _refine_box(self, gray: np.ndarray, doc_mask: np.ndarray, box: list) -> list:
+        """
+        Move each edge of a crop box found on the reduced mask to where the
+        full-resolution mask puts it, within a few reduced pixels of it
+        """
+        height, width = gray.shape
+        margin = int(np.ceil(2 / self.mask_scale)) + self.SMOOTH_SIZE + self.BLUR_SIZE
+        # The gray is averaged over a window reaching past each strip, so that
+        # the strip's own borders do not change the threshold
+        pad = self.SMOOTH_SIZE
+        minx, miny, maxx, maxy = box
+        refined = list(box)
+        for index in range(4):
+            vertical = index % 2 == 1
+            edge, size = box[index], height if vertical else width
+            first = index < 2
+            start, end = max(edge - margin + (not first), 0), min(edge + margin + (not first), size)
+            across_lo, across_hi = (minx, maxx) if vertical else (miny, maxy)
+            across_size = width if vertical else height
+            across_start, across_end = max(across_lo - margin, 0), min(across_hi + margin + 1, across_size)
+            lo, hi = max(start - pad, 0), min(end + pad, size)
+            a_lo, a_hi = max(across_start - pad, 0), min(across_end + pad, across_size)
+            window = gray[lo:hi, a_lo:a_hi] if vertical else gray[a_lo:a_hi, lo:hi].T
+            _, bin_mask = cv2.threshold(cv2.blur(window, (self.SMOOTH_SIZE,) * 2), self.BLACK_THRESH, 255, cv2.THRESH_BINARY)
+            bin_mask = bin_mask[start - lo:end - lo, across_start - a_lo:across_end - a_lo]
+            # Reduced mask pixel under each strip pixel
+            along_axis = 0 if vertical else 1
+            rows = np.arange(start, end) * doc_mask.shape[along_axis] // size
+            cols = np.arange(across_start, across_end) * doc_mask.shape[1 - along_axis] // across_size
+            kept = doc_mask[np.ix_(rows, cols)] if vertical else doc_mask[np.ix_(cols, rows)].T
+            if not first:
+                bin_mask, kept = bin_mask[::-1], kept[::-1]
+            found = np.flatnonzero(self._edge_strip_mask(np.ascontiguousarray(bin_mask), kept).any(axis=1))
+            if found.size:
+                refined[index] = start + found[0] if first else end - 1 - found[0]
+        return refined
+
+    def _full_alpha(self, img_array: np.ndarray) -> np.ndarray:
+        rgba = cv2.cvtColor(img_array, cv2.COLOR_RGB2RGBA)
+        rgba[:, :, 3] = 255
+        return rgba
+
     def remove_background(self, img_array: np.ndarray) -> tuple[np.ndarray, dict]:
         """
         Steps:
@@ -26,42 +114,52 @@ class BlackBackgroundRemoverMulti:
         C) Find contours, keep the ones we want (heuristics).
         D) Combine kept contours into a mask
         E) Morph open/close, blur => partial transparency
-        F) Crop to bounding box of alpha
+        F) Crop to bounding box of alpha, upsampling the mask inside it
         G) Return final RGBA + debug params
         """
-
-        # Convert to grayscale
-        gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
+        full_h, full_w = img_array.shape[:2]
+        scale = self.mask_scale
+
+        # Convert to grayscale, averaged down to the mask resolution
+        full_gray = gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
+        if scale < 1.0:
+            gray = cv2.resize(
+                full_gray,
+                (max(1, round(full_w * scale)), max(1, round(full_h * scale))),
+                interpolation=cv2.INTER_AREA
+            )
         h, w = gray.shape
         image_area = h * w
+        # Areas below are measured on the reduced mask; report them at full resolution
+        area_factor = (full_w * full_h) / image_area
 
         # A) Check black coverage (optional):
-        BLACK_THRESH = 80
+        BLACK_THRESH = self.BLACK_THRESH
         black_pixels = np.count_nonzero(gray < BLACK_THRESH)
         black_ratio = black_pixels / float(image_area)
         black_coverage_cutoff = 0.01  # if <1% black, skip removal
         if black_ratio < black_coverage_cutoff:
             # skip => fully opaque
-            rgba_skip = cv2.cvtColor(img_array, cv2.COLOR_RGB2RGBA)
-            rgba_skip[:, :, 3] = 255
-            return rgba_skip, {
+            return self._full_alpha(img_array), {
                 "method": "skipped_almost_no_black",
                 "black_ratio": black_ratio,
                 "black_coverage_cutoff": black_coverage_cutoff,
                 "black_thresh": BLACK_THRESH
             }
 
-        # B) Threshold with a more aggressive black limit
-        _, bin_mask = cv2.threshold(gray, BLACK_THRESH, 255, cv2.THRESH_BINARY)
+        # B) Threshold with a more aggressive black limit. Scanner beds can sit
+        #    close to it, and their noise then chains into the page a different
+        #    way at each resolution; thresholding the gray averaged over
+        #    SMOOTH_SIZE full-resolution pixels keeps the mask the same at any scale
+        smooth = self._kernel(self.SMOOTH_SIZE)
+        _, bin_mask = cv2.threshold(cv2.blur(gray, (smooth, smooth)), BLACK_THRESH, 255, cv2.THRESH_BINARY)
         # bin_mask: 255 => doc/foreground, 0 => black background
 
         # C) Find external contours
         contours, _ = cv2.findContours(bin_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         if not contours:
             # fallback => fully opaque
-            rgba_fallback = cv2.cvtColor(img_array, cv2.COLOR_RGB2RGBA)
-            rgba_fallback[:, :, 3] = 255
-            return rgba_fallback, {
+            return self._full_alpha(img_array), {
                 "method": "no_contour_found_fallback",
                 "black_thresh": BLACK_THRESH
             }
@@ -129,46 +227,64 @@ class BlackBackgroundRemoverMulti:
             cv2.drawContours(doc_mask, [c], -1, color=255, thickness=-1)
 
         # E) Morphological open/close, blur => partial transparency
-        kernel_open = cv2.getStructuringElement(cv2.MORPH_RECT, (5,5))
+        kernel_open = cv2.getStructuringElement(cv2.MORPH_RECT, (self._kernel(self.OPEN_SIZE),) * 2)
         doc_mask_opened = cv2.morphologyEx(doc_mask, cv2.MORPH_OPEN, kernel_open)
 
-        kernel_close = cv2.getStructuringElement(cv2.MORPH_RECT, (7,7))
+        kernel_close = cv2.getStructuringElement(cv2.MORPH_RECT, (self._kernel(self.CLOSE_SIZE),) * 2)
         doc_mask_closed = cv2.morphologyEx(doc_mask_opened, cv2.MORPH_CLOSE, kernel_close)
 
-        blurred_mask = cv2.GaussianBlur(doc_mask_closed, (21, 21), 0)
+        blur_size = self._kernel(self.BLUR_SIZE, odd=True)
+        blurred_mask = cv2.GaussianBlur(doc_mask_closed, (blur_size, blur_size), 0)
         blurred_mask = cv2.normalize(blurred_mask, None, 0, 255, cv2.NORM_MINMAX)
 
         alpha_flt = blurred_mask.astype(np.float32) / 255.0
         alpha_flt *= 0.95
         final_mask = (alpha_flt * 255).astype(np.uint8)
 
-        # Create RGBA
-        rgba = cv2.cvtColor(img_array, cv2.COLOR_RGB2RGBA)
-        rgba[:, :, 3] = final_mask
-
         # F) Crop to bounding box of non-zero alpha (so it's as tight as possible)
         #    Find all coords where alpha > 0
         ys, xs = np.nonzero(final_mask > 0)
         if len(xs) == 0 or len(ys) == 0:
             # if everything got removed, fallback
+            rgba = cv2.cvtColor(img_array, cv2.COLOR_RGB2RGBA)
+            rgba[:, :, 3] = 0
             return rgba, {
                 "method": "empty_alpha_fallback",
                 "black_thresh": BLACK_THRESH
             }
 
-        minx, maxx = xs.min(), xs.max()
-        miny, maxy = ys.min(), ys.max()
-
-        # Crop
-        cropped_rgba = rgba[miny:maxy+1, minx:maxx+1, :]
+        if scale == 1.0:
+            minx, maxx = xs.min(), xs.max()
+            miny, maxy = ys.min(), ys.max()
+            crop_alpha = final_mask[miny:maxy+1, minx:maxx+1]
+        else:
+            # Mask pixel edges mapped to full resolution
+            scale_x, scale_y = full_w / w, full_h / h
+            minx, maxx = int(xs.min() * scale_x), min(int(np.ceil((xs.max() + 1) * scale_x)), full_w) - 1
+            miny, maxy = int(ys.min() * scale_y), min(int(np.ceil((ys.max() + 1) * scale_y)), full_h) - 1
+            minx, miny, maxx, maxy = self._refine_box(full_gray, doc_mask, [minx, miny, maxx, maxy])
+            # Bilinear upsampling of the mask for the crop box only
+            M = np.float32([
+                [1 / scale_x, 0, (minx + 0.5) / scale_x - 0.5],
+                [0, 1 / scale_y, (miny + 0.5) / scale_y - 0.5]
+            ])
+            crop_alpha = cv2.warpAffine(
+                final_mask, M, (int(maxx - minx + 1), int(maxy - miny + 1)),
+                flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE
+            )
+
+        # Create RGBA for the crop only
+        cropped_rgba = cv2.cvtColor(img_array[miny:maxy+1, minx:maxx+1], cv2.COLOR_RGB2RGBA)
+        cropped_rgba[:, :, 3] = crop_alpha
 
         # debug params
         params = {
             "method": "multi_obj_black_bg_removal",
             "black_thresh": BLACK_THRESH,
             "black_ratio": black_ratio,
-            "total_foreground_area": total_foreground_area,
-            "largest_contour_area": largest_contour_area,
+            "mask_scale": scale,
+            "total_foreground_area": total_foreground_area * area_factor,
+            "largest_contour_area": largest_contour_area * area_factor,
             "num_contours_found": len(contours),
             "num_contours_kept": len(keep_contours),
             "crop_bbox": [int(minx), int(miny), int(maxx), int(maxy)]
@@ -176,12 +292,12 @@ class BlackBackgroundRemoverMulti:
         return cropped_rgba, params
 
 
-def remove_background_from_image(image: Image.Image) -> tuple[Image.Image, dict]:
+def remove_background_from_image(image: Image.Image, mask_scale: float = 0.25) -> tuple[Image.Image, dict]:
     """
     Public pipeline: remove black background, keep multiple objects by heuristic, and crop.
     """
     img_array = np.array(image)
-    remover = BlackBackgroundRemoverMulti()
+    remover = BlackBackgroundRemoverMulti(mask_scale)
     cropped_rgba, analysis_params = remover.remove_background(img_array)
 
     # Convert back to PIL
@@ -189,57 +305,62 @@ def remove_background_from_image(image: Image.Image) -> tuple[Image.Image, dict]
     return out_pil, {"analysis": analysis_params}
 
 
-def process_image(file_path: Path, out_path: Path) -> dict:
+def process_image(file_path: Path, out_path: Path, image_format: str = "png", mask_scale: float = 0.25, output: str = "rgba") -> dict:
     """
     Process a single image file with the multi-object black background approach, then crop.
     """
-    img = Image.open(file_path)
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
+    img = load_image(file_path, 'RGB')
 
-    bg_removed, params = remove_background_from_image(img)
+    bg_removed, params = remove_background_from_image(img, mask_scale)
 
     # Get source folder structure from input path
     source_dir = Path(*file_path.parts[file_path.parts.index('documents')+1:])
     
-    # Save as PNG and ensure .png extension
-    out_path = out_path.with_suffix('.png')
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    bg_removed.save(out_path, "PNG")  # Remove quality parameter as it's not used for PNG
+    # Save with alpha, flattened or with a separate mask; with alpha, formats
+    # that cannot keep it (jpeg) fall back to PNG
+    written = save_background_removed(bg_removed, out_path, image_format, output)
     
-    # Ensure output path in manifest also has .png extension
-    rel_path = source_dir.with_suffix('.png')
+    # Ensure output path in manifest has the extension actually written
+    rel_path = source_dir.with_suffix(written[0].suffix)
 
     details = {
         "original_size": list(img.size),
         "bg_removed_size": list(bg_removed.size),
-        "bg_removal_params": params
+        "bg_removal_params": params,
+        "output_mode": output
     }
+    if len(written) > 1:
+        # The mask is found next to the image by load_image; recorded for reference
+        details["mask"] = str(rel_path.parent / written[1].name)
     return {
         "outputs": [str(rel_path)],
         "details": details
     }
 
 
-def process_document(file_path: str, output_folder: Path) -> dict:
+def process_document(file_path: str, output_folder: Path, image_format: str = "png", mask_scale: float = 0.25, output: str = "rgba") -> dict:
     """
     Uses your existing `process_file` from utils.processor.
     """
     file_path = Path(file_path)
 
     def process_fn(f: str, o: Path) -> dict:
-        return process_image(Path(f), o)
+        return process_image(Path(f), o, image_format, mask_scale, output)
 
     return process_file(
         file_path=str(file_path),
         output_folder=output_folder,
         process_fn=process_fn,
+        # With alpha, formats that cannot keep it are written as PNG
+        output_suffix=intermediate_suffix(image_format, "RGBA" if output == "rgba" else "RGB"),
         file_types={
             '.jpg': process_fn,
             '.jpeg': process_fn,
             '.tif': process_fn,
             '.tiff': process_fn,
-            '.png': process_fn
+            '.png': process_fn,
+            '.webp': process_fn,
+            '.npy': process_fn
         }
     )
 
@@ -247,17 +368,35 @@ def process_document(file_path: str, output_folder: Path) -> dict:
 def remove_background(
     rotated_folder: Path = typer.Argument(..., help="Folder with input images"),
     rotated_manifest: Path = typer.Argument(..., help="Manifest file"),
-    bgremoved_folder: Path = typer.Argument(..., help="Output folder")
+    bgremoved_folder: Path = typer.Argument(..., help="Output folder"),
+    image_format: str = typer.Option(
+        "png",
+        "--format",
+        help="Output image format: png, webp (lossless), webp-lossy, npy (raw) or jpeg; with --output rgba, jpeg falls back to png"
+    ),
+    output: str = typer.Option(
+        "rgba",
+        "--output",
+        help="rgba (image with alpha), flat (composited onto white), mask or mask1 (RGB image plus an 8-bit or 1-bit mask file)"
+    ),
+    mask_scale: float = typer.Option(
+        0.25,
+        "--mask-scale",
+        min=0.05, max=1.0,
+        help="Scale of the copy the background mask is computed on; the crop box edges are refined at full resolution (1 computes everything at full resolution; compare with benchmark.py background)"
+    )
 ):
     """
     CLI for multi-object black/dark background removal with bounding box crop.
     """
+    if output not in BACKGROUND_OUTPUTS:
+        raise typer.BadParameter(f"Unknown output: {output} (use one of {', '.join(BACKGROUND_OUTPUTS)})")
     processor = BatchProcessor(
         input_manifest=rotated_manifest,
         output_folder=bgremoved_folder,
         process_name="remove_multi_obj_black_bg",
         base_folder=rotated_folder / "documents",
-        processor_fn=lambda f, o: process_document(f, o)
+        processor_fn=lambda f, o: process_document(f, o, image_format, mask_scale, output)
     )
     processor.process()
 
@@ -3,76 +3,101 @@ from PIL import Image
 from pathlib import Path
 import numpy as np
 import cv2
+import os
+import shutil
 from utils.batch import BatchProcessor
 from utils.processor import process_file
+from utils.image_io import image_size, intermediate_suffix, load_image, save_intermediate
+from utils.deskew import DeskewEngine, ENGINES, HoughEngine, get_engine
 from rich.console import Console
 
 console = Console()
 
-def hough_line_rotate(image: Image.Image, blur_kernel=(5, 5), canny_threshold1=50, canny_threshold2=150) -> tuple[Image.Image, dict]:
+def load_gray(file_path: Path, scale: float = 1.0) -> np.ndarray:
     """
-    Rotate image based on Hough Line Transform.
-    Returns (rotated_image, debug_info)
+    Load a page as grayscale, reduced by scale. JPEGs are decoded directly
+    at the nearest larger DCT scale (draft mode), so a reduced estimate never
+    pays for a full-resolution decode.
     """
-    img_array = np.array(image)
-    img_gray = cv2.cvtColor(img_array, cv2.COLOR_BGR2GRAY)
-    img_blurred = cv2.GaussianBlur(img_gray, blur_kernel, 0)
-    edges = cv2.Canny(img_blurred, canny_threshold1, canny_threshold2)
-    
-    debug_info = {
-        "found_lines": False,
-        "rotation_angle": 0,
-        "num_lines": 0,
-        "edge_points": int(np.sum(edges > 0))
-    }
-    
-    lines = cv2.HoughLinesP(edges, 1, np.pi / 180, threshold=100, minLineLength=100, maxLineGap=10)
-    if lines is not None:
-        angles = []
-        for line in lines:
-            x1, y1, x2, y2 = line[0]
-            angle = np.degrees(np.arctan2(y2 - y1, x2 - x1))
-            if -2 <= angle <= 2:  # Ensure the angle is within a small range
-                angles.append(angle)
-        
-        debug_info["num_lines"] = len(lines)
-        
-        if angles:
-            median_angle = np.median(angles)
-            debug_info["found_lines"] = True
-            debug_info["rotation_angle"] = float(median_angle)
-            debug_info["num_valid_angles"] = len(angles)
-            
-            center = (img_array.shape[1] // 2, img_array.shape[0] // 2)
-            M_rotate = cv2.getRotationMatrix2D(center, median_angle, 1.0)
-            rotated = cv2.warpAffine(img_array, M_rotate, (img_array.shape[1], img_array.shape[0]), borderValue=(255, 255, 255))
-            
-            return Image.fromarray(rotated), debug_info
+    img = load_image(file_path)
+    width, height = img.size
+    target = (max(int(width * scale), 1), max(int(height * scale), 1))
+    if scale < 1.0 and img.format == "JPEG":
+        img.draft('L', target)
+    gray = np.array(img.convert('L'))
+    if gray.shape[::-1] != target:
+        gray = cv2.resize(gray, target, interpolation=cv2.INTER_AREA)
+    return gray
+
+def estimate_skew(file_path: Path, scale: float = 0.25, min_angle: float = 0.1, engine: DeskewEngine = None, max_angle: float = 2.0) -> tuple[float, dict]:
+    """
+    Estimate skew on a copy of the page reduced to scale, in 0.1 degree steps
+    within +/- max_angle. Only when the page may need rotating is the angle
+    refined, on a copy at twice the scale (up to full size) in 0.02 degree
+    steps around the coarse angle. Pages clearly below min_angle are never
+    looked at in more detail.
+    Returns (angle or None, debug_info)
+    """
+    engine = engine or HoughEngine()
+    coarse_step = 0.1
+    angle, debug_info = engine.estimate(load_gray(file_path, scale), span=max_angle, step=coarse_step)
+    debug_info["engine"] = engine.name
+    if angle is None or abs(angle) + coarse_step <= min_angle or scale >= 1.0:
+        return angle, debug_info
     
-    return image, debug_info
+    refined, refined_info = engine.estimate(
+        load_gray(file_path, min(scale * 2, 1.0)),
+        center=angle, span=coarse_step * 2, step=0.02
+    )
+    if refined is None:
+        return angle, debug_info
+    refined_info.update({"engine": engine.name, "coarse_angle": angle})
+    return refined, refined_info
 
-def process_image(file_path: Path, out_path: Path) -> dict:
-    """Process a single image file for rotation"""
-    img = Image.open(file_path)
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
+def rotate_image(image: Image.Image, angle: float) -> Image.Image:
+    """Rotate a page by angle degrees about its center in one full-resolution warp"""
+    img_array = np.array(image)
+    center = (img_array.shape[1] // 2, img_array.shape[0] // 2)
+    M_rotate = cv2.getRotationMatrix2D(center, angle, 1.0)
+    rotated = cv2.warpAffine(img_array, M_rotate, (img_array.shape[1], img_array.shape[0]), borderValue=(255, 255, 255))
+    return Image.fromarray(rotated)
+
+def pass_through(file_path: Path, out_path: Path) -> Path:
+    """Hardlink (or copy) an unrotated page to the output, keeping its bytes and extension"""
+    out_path = out_path.with_suffix(file_path.suffix)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    if out_path.exists():
+        out_path.unlink()
+    try:
+        os.link(file_path, out_path)
+    except OSError:
+        shutil.copy2(file_path, out_path)
+    return out_path
 
+def process_image(file_path: Path, out_path: Path, image_format: str = "jpeg", scale: float = 0.25, min_angle: float = 0.1, engine: DeskewEngine = None, max_angle: float = 2.0) -> dict:
+    """Process a single image file for rotation"""
     # Get source folder structure from input path
     source_dir = Path(file_path).parts[-4:-1]
     
-    # Rotate image and get debug info
-    rotated, debug_info = hough_line_rotate(img)
+    angle, debug_info = estimate_skew(file_path, scale, min_angle, engine, max_angle)
     
-    # Save rotated image
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    rotated.save(out_path, "JPEG", quality=100)
+    if angle is None or abs(angle) < min_angle:
+        # Nothing to straighten: hand the page on untouched
+        debug_info["passed_through"] = True
+        out_path = pass_through(file_path, out_path)
+        original_size = rotated_size = list(image_size(out_path))
+    else:
+        img = load_image(file_path, 'RGB')
+        rotated = rotate_image(img, angle)
+        out_path = save_intermediate(rotated, out_path, image_format)
+        original_size, rotated_size = list(img.size), list(rotated.size)
     
     # Build output path preserving full source hierarchy
     rel_path = Path(*source_dir) / out_path.name
     
     details = {
-        "original_size": list(img.size),
-        "rotated_size": list(rotated.size),
+        "original_size": original_size,
+        "rotated_size": rotated_size,
         "debug": debug_info
     }
     
@@ -81,38 +106,73 @@ def process_image(file_path: Path, out_path: Path) -> dict:
         "details": details
     }
 
-def process_document(file_path: str, output_folder: Path) -> dict:
-    """Process a single document file"""
+def process_document(file_path: str, output_folder: Path, **options) -> dict:
+    """Process a single document file; options are passed on to process_image"""
     file_path = Path(file_path)
     
     def process_fn(f: str, o: Path) -> dict:
-        return process_image(Path(f), o)
+        return process_image(Path(f), o, **options)
     
     return process_file(
         file_path=str(file_path),
         output_folder=output_folder,
         process_fn=process_fn,
+        output_suffix=intermediate_suffix(options.get("image_format", "jpeg")),
         file_types={
             '.jpg': process_fn,
             '.jpeg': process_fn,
             '.tif': process_fn,
             '.tiff': process_fn,
-            '.png': process_fn
+            '.png': process_fn,
+            '.webp': process_fn,
+            '.npy': process_fn
         }
     )
 
 def rotate(
     splits_folder: Path = typer.Argument(..., help="Input splits folder"),
     splits_manifest: Path = typer.Argument(..., help="Input splits manifest file"), 
-    rotated_folder: Path = typer.Argument(..., help="Output folder for rotated images")
+    rotated_folder: Path = typer.Argument(..., help="Output folder for rotated images"),
+    image_format: str = typer.Option(
+        "jpeg",
+        "--format",
+        help="Intermediate image format: jpeg (visually lossless), png, webp (lossless), webp-lossy or npy (raw)"
+    ),
+    scale: float = typer.Option(
+        0.25,
+        "--estimate-scale",
+        min=0.05, max=1.0,
+        help="Estimate skew on a copy reduced to this scale, refining only pages that may need rotating"
+    ),
+    min_angle: float = typer.Option(
+        0.1,
+        "--min-angle",
+        min=0.0,
+        help="Pages skewed by less than this many degrees are passed through unchanged"
+    ),
+    engine_name: str = typer.Option(
+        "hough",
+        "--engine",
+        help=f"Skew estimator: {', '.join(ENGINES)} (compare them with benchmark.py deskew)"
+    ),
+    max_angle: float = typer.Option(
+        2.0,
+        "--max-angle",
+        min=0.1, max=45.0,
+        help="Largest skew in degrees to look for"
+    )
 ):
     """Rotate split document pages"""
+    engine = get_engine(engine_name)
     processor = BatchProcessor(
         input_manifest=splits_manifest,
         output_folder=rotated_folder,
         process_name="rotate",
         base_folder=splits_folder / "documents",  # Add /documents to match split.py's structure
-        processor_fn=lambda f, o: process_document(f, o)
+        processor_fn=lambda f, o: process_document(
+            f, o, image_format=image_format, scale=scale,
+            min_angle=min_angle, engine=engine, max_angle=max_angle
+        )
     )
     processor.process()
 
@@ -6,18 +6,21 @@ from pathlib import Path
 from rich.progress import track
 from rich.console import Console
 import re
-import pytesseract  # Add this import for OCR
 import logging
-from io import BytesIO
 import os
 
 from utils.batch import BatchProcessor
 from utils.processor import process_file
 from utils.segment_handler import SegmentHandler
+from utils.deskew import MinAreaRectEngine, TesseractBaselineEngine
+from utils.page_layout import LAYOUT_ENGINES, TesseractLayout, get_layout_engine
 
 console = Console()
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 
+# How segments are handed to the transcribers, see process_image
+SEGMENT_OUTPUTS = ("files", "virtual")
+
 def natural_sort_key(s):
     return [int(text) if text.isdigit() else text.lower() for text in re.split('([0-9]+)', str(s))]
 
@@ -30,92 +33,58 @@ def get_kernel_size(image: Image.Image):
         return 5
     return 7
 
-def deskew_image(pil_img: Image.Image) -> Image.Image:
+def page_skew_angle(pil_img: Image.Image) -> float:
+    """
+    Angle that deskews the page, from OpenCV's minAreaRect on the largest
+    contour, or 0.0 when there is no real rotation to correct.
+    """
+    cv_img = np.array(pil_img.convert('L'))  # grayscale for processing only
+    angle, _ = MinAreaRectEngine().estimate(cv_img)
+    
+    if angle is None or abs(angle) < 0.1:
+        # No contours or a very small angle => no real deskew needed
+        return 0.0
+    return angle
+
+def deskew_image(pil_img: Image.Image, angle: float = None) -> Image.Image:
     """
     Deskew an image using OpenCV's minAreaRect on the largest contour.
     This approach tries to detect the most prominent rotation in the image
     and rotate the image to correct it.
     If no rotation is found, returns the original image.
     """
-    # Convert PIL to OpenCV, keeping original for final output
-    original_img = pil_img.copy()
-    cv_img = np.array(pil_img.convert('L'))  # grayscale for processing only
-    # Threshold and invert to get text as white on black for better contour detection
-    _, thresh = cv2.threshold(cv_img, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
-
-    # Find contours
-    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    if not contours:
-        return original_img  # No contours => can't deskew
-
-    # Pick the largest contour by area
-    largest_contour = max(contours, key=cv2.contourArea)
-    # Compute minAreaRect
-    rot_rect = cv2.minAreaRect(largest_contour)
-    angle = rot_rect[-1]
-    # minAreaRect angle convention: if text is horizontal, angle ~ 0 or -90
-    # We want to rotate it so angle becomes 0 or 180.
-
-    if angle < -45:
-        angle = 90 + angle
-    elif angle > 45:
-        angle = angle - 90
-
-    if abs(angle) < 0.1:
-        # Very small angle => no real deskew needed
-        return original_img  # Return original colored image
-
-    (h, w) = cv_img.shape
-    center = (w // 2, h // 2)
-    # Compute rotation matrix
-    M = cv2.getRotationMatrix2D(center, angle, 1.0)
-    # Rotate - use negative angle to correct in opposite direction
-    rotated = original_img.rotate(-angle, resample=Image.BICUBIC, expand=False)
-    return rotated
+    if angle is None:
+        angle = page_skew_angle(pil_img)
+    if not angle:
+        return pil_img.copy()  # Return original colored image
+    
+    # Engines return the angle that straightens the page for PIL's rotate
+    return pil_img.rotate(angle, resample=Image.BICUBIC, expand=False)
 
 def get_text_baseline_angle(img: Image.Image) -> float:
     """Calculate text baseline angle using Tesseract word-level bounding boxes."""
     try:
-        # Ensure image is in correct mode for Tesseract
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-            
-        # Use BytesIO to pass image to Tesseract
-        with BytesIO() as bio:
-            # Save as PNG to preserve quality
-            img.save(bio, format='PNG')
-            bio.seek(0)
-            # Convert to numpy array for Tesseract
-            img_array = np.array(Image.open(bio))
-            data = pytesseract.image_to_data(img_array, output_type=pytesseract.Output.DICT)
-        
-        points = []
-        for i in range(len(data['level'])):
-            if data['conf'][i] > 30 and data['text'][i].strip():
-                x = data['left'][i] + data['width'][i]/2
-                y = data['top'][i] + data['height'][i]
-                points.append((x, y))
-        
-        if len(points) < 2:
-            return 0.0  # Return 0 if not enough points
-        
-        x_coords, y_coords = zip(*points)
-        coeffs = np.polyfit(x_coords, y_coords, deg=1)
-        angle = np.degrees(np.arctan(coeffs[0]))
-        
-        # Limit correction to small angles
-        return max(min(angle, 2.0), -2.0)
+        angle, _ = TesseractBaselineEngine().estimate(np.array(img.convert('L')))
+        # Limit correction to small angles; 0 if not enough words
+        return angle if angle is not None else 0.0
     
     except Exception as e:
         logging.warning(f"Error in baseline angle detection: {e}")
         return 0.0  # Return 0 as safe default
 
-def calculate_average_baseline(segments):
-    """Calculate average baseline angle from segments with substantial text."""
+def calculate_average_baseline(segments, layout=None):
+    """
+    Calculate average baseline angle from segments with substantial text.
+    With a page layout the angles come from its words instead of new OCR
+    passes over each segment.
+    """
     angles = []
     for segment in segments:
         if segment["text_len"] > 50:  # Only use segments with significant text
-            angle = get_text_baseline_angle(segment["image"])
+            if layout is not None:
+                angle = layout.baseline_angle(segment["top"], segment["bottom"])
+            else:
+                angle = get_text_baseline_angle(segment["image"])
             angles.append(angle)  # Always append since get_text_baseline_angle now returns 0.0 on error
     
     if not angles:
@@ -194,6 +163,8 @@ def merge_thin_empty_segments(segments, min_height=100, min_text_ratio=0.1):
     1. Merges empty segments with neighbors
     2. Joins segments with very little text
     3. Handles overlaps properly during merging
+    Works on the segments' top, bottom and text_len only; images are cut
+    once the final boundaries are known.
     """
     if len(segments) <= 1:
         return segments
@@ -216,18 +187,6 @@ def merge_thin_empty_segments(segments, min_height=100, min_text_ratio=0.1):
                 prev_segment = very_thin_merged[-1]
                 new_height = current["bottom"] - prev_segment["top"]
                 if new_height < min_height * 4:  # Increased from 3 to 4
-                    # Create new image and preserve colors
-                    new_img = Image.new('RGB', (
-                        prev_segment["image"].width,
-                        new_height
-                    ), color='white')  # Use white background
-                    
-                    # Paste using original images
-                    new_img.paste(prev_segment["image"], (0, 0))
-                    curr_paste_y = prev_segment["bottom"] - prev_segment["top"]
-                    new_img.paste(current["image"], (0, curr_paste_y))
-                    
-                    prev_segment["image"] = new_img
                     prev_segment["bottom"] = current["bottom"]
                     prev_segment["text_len"] += current["text_len"]
                     i += 1
@@ -240,10 +199,6 @@ def merge_thin_empty_segments(segments, min_height=100, min_text_ratio=0.1):
                     # Merge with next segment
                     next_segment["top"] = current["top"]
                     next_segment["text_len"] += current["text_len"]
-                    next_segment["image"] = Image.new('RGB', (
-                        next_segment["image"].width,
-                        next_segment["bottom"] - next_segment["top"]
-                    ))
                     i += 1
                     continue
         very_thin_merged.append(current)
@@ -266,26 +221,9 @@ def merge_thin_empty_segments(segments, min_height=100, min_text_ratio=0.1):
             # Try to merge with previous segment first
             if merged:
                 prev_segment = merged[-1]
-                # Calculate overlap
-                overlap = max(0, prev_segment["bottom"] - current["top"])
                 new_height = current["bottom"] - prev_segment["top"]
                 
                 if new_height < min_height * 4:  # Increased from 3 to 4
-                    # Create new image with white background
-                    new_img = Image.new('RGB', (
-                        prev_segment["image"].width,
-                        new_height
-                    ), color='white')
-                    
-                    # Paste preserving colors
-                    new_img.paste(prev_segment["image"], (0, 0))
-                    if overlap > 0:
-                        curr_img = current["image"].crop((0, overlap, current["image"].width, current["image"].height))
-                        new_img.paste(curr_img, (0, prev_segment["bottom"] - prev_segment["top"] - overlap))
-                    else:
-                        new_img.paste(current["image"], (0, prev_segment["bottom"] - prev_segment["top"]))
-                    
-                    prev_segment["image"] = new_img
                     prev_segment["bottom"] = current["bottom"]
                     prev_segment["text_len"] += current["text_len"]
                     i += 1
@@ -294,22 +232,9 @@ def merge_thin_empty_segments(segments, min_height=100, min_text_ratio=0.1):
             # If couldn't merge with previous, try next segment
             if i < len(very_thin_merged) - 1:
                 next_segment = very_thin_merged[i + 1]
-                # Calculate overlap
-                overlap = max(0, current["bottom"] - next_segment["top"])
                 new_height = next_segment["bottom"] - current["top"]
                 
                 if new_height < min_height * 4:  # Increased from 3 to 4
-                    new_img = Image.new('RGB', (
-                        next_segment["image"].width,
-                        new_height
-                    ), color='white')
-                    # Paste current segment
-                    new_img.paste(current["image"], (0, 0))
-                    # Paste next segment, skipping the overlapped region
-                    next_img = next_segment["image"].crop((0, overlap, next_segment["image"].width, next_segment["image"].height))
-                    new_img.paste(next_img, (0, current["bottom"] - current["top"] - overlap))
-                    
-                    next_segment["image"] = new_img
                     next_segment["top"] = current["top"]
                     next_segment["text_len"] += current["text_len"]
                     i += 1
@@ -354,59 +279,60 @@ def find_safe_cut_point(img: Image.Image, start: int, end: int, margin: int = 20
     
     return best_cut
 
-def adaptive_segment_image(img: Image.Image, min_text_length=10) -> list:
+def adaptive_segment_image(img: Image.Image, min_text_length=10, layout_engine=TesseractLayout, crop=True) -> list:
     """
     Hybrid approach that:
       1. Deskews the image (if needed).
-      2. Collects bounding boxes from Tesseract.
+      2. Collects bounding boxes from a single pass of the layout engine
+         (word-level Tesseract, or OCR-free row projections), which also
+         gives each segment's text length and baseline angle.
       3. Fallback to connected-component lines if Tesseract is sparse.
       4. Merges boxes and covers every vertical region (no data lost).
       5. Subdivides large segments so chunks don't get too big.
-      6. Returns a list of dicts, each with:
-         { "image": cropped_segment, "top": top_px, "bottom": bottom_px, "text_len": length_of_OCR_text }
+      6. Merges thin and empty segments, as intervals.
+      7. Rotates the page once by the deskew and average baseline angles and
+         crops each final segment from it.
+      Returns a list of dicts, each with:
+         { "image": cropped_segment, "top": top_px, "bottom": bottom_px, "text_len": length_of_OCR_text,
+           "angle": baseline_rotation, "page_angle": page_deskew_rotation }
+    The page is analysed once; everything per segment is found by filtering
+    that pass's words or ink rows by their position. The projection engine
+    reports text_len as an estimate from ink density. Rotating the page by
+    page_angle + angle and cropping top to bottom gives the segment again;
+    with crop=False segments come without images.
     """
-    # Set Tesseract to use in-memory mode if available
-    if hasattr(pytesseract, 'set_temp_directory'):
-        pytesseract.set_temp_directory(None)  # Use RAM instead of disk
-
     # Get image dimensions
     width, height = img.size
     
     # Don't segment if image is relatively small
     if height < 2500:  # Increased from 2000 to 2500
-        text_in_img = pytesseract.image_to_string(img).strip()
         return [{
             "image": img,
             "top": 0,
             "bottom": height,
-            "text_len": len(text_in_img)
+            "text_len": layout_engine(img).text_len(0, height),
+            "angle": 0.0,
+            "page_angle": 0.0
         }]
         
     # 1. Deskew the image
-    deskewed_img = deskew_image(img)
+    page_angle = page_skew_angle(img)
+    deskewed_img = deskew_image(img, page_angle)
     width, height = deskewed_img.size
 
-    # 2. Collect Tesseract bounding boxes (word-level).
-    data = pytesseract.image_to_data(deskewed_img, output_type=pytesseract.Output.DICT)
-    tess_boxes = []
-    for i in range(len(data["level"])):
-        text = data["text"][i].strip()
-        if text:  # non-empty recognized text
-            top = data["top"][i]
-            bottom = top + data["height"][i]
-            tess_boxes.append((top, bottom))
-
-    tess_boxes.sort(key=lambda x: x[0])
+    # 2. Collect word or text-row bounding boxes, the only layout pass over the page.
+    layout = layout_engine(deskewed_img)
+    text_boxes = layout.line_boxes()
 
-    # 3. Fallback to connected components if Tesseract found < 3 lines
-    fallback_needed = (len(tess_boxes) < 3)
+    # 3. Fallback to connected components if the layout found < 3 lines
+    fallback_needed = (len(text_boxes) < 3)
     if fallback_needed:
         cc_lines = get_connected_component_lines(deskewed_img, line_threshold=15)  # Increased from 10 to 15
     else:
         cc_lines = []
 
-    # Combine Tesseract boxes + CC lines
-    all_boxes = tess_boxes + cc_lines
+    # Combine layout boxes + CC lines
+    all_boxes = text_boxes + cc_lines
     all_boxes.sort(key=lambda x: x[0])
 
     # Merge boxes that are close
@@ -470,13 +396,15 @@ def adaptive_segment_image(img: Image.Image, min_text_length=10) -> list:
                 else:
                     # Find a safe place to cut
                     target_end = start + MAX_CHUNK_HEIGHT
-                    end = find_safe_cut_point(deskewed_img, target_end - 40, target_end + 40)
+                    end = layout.cut_point(target_end - 40, target_end + 40)
+                    if end is None:
+                        end = find_safe_cut_point(deskewed_img, target_end - 40, target_end + 40)
                 
                 if end - start >= MIN_CHUNK_HEIGHT:
                     subdivided_segments.append((start, end))
                 start = end
 
-    # 6. Crop each segment with a small overlap
+    # 6. Add a small overlap to each segment
     chunk_overlap = 20  # Increased from 15 to 20
     segments = []
     for i, (seg_top, seg_bottom) in enumerate(subdivided_segments):
@@ -488,36 +416,38 @@ def adaptive_segment_image(img: Image.Image, min_text_length=10) -> list:
         if actual_bottom - actual_top < MIN_CHUNK_HEIGHT:
             continue
             
-        # Crop from original colored image
-        roi = deskewed_img.crop((0, actual_top, width, actual_bottom))
-        text_in_segment = pytesseract.image_to_string(roi.convert('L')).strip()  # Convert to grayscale only for OCR
         segments.append({
-            "image": roi,  # Keep original colors
             "top": actual_top,
             "bottom": actual_bottom,
-            "text_len": len(text_in_segment)
+            "text_len": layout.text_len(actual_top, actual_bottom),
+            "page_angle": page_angle
         })
     
     # Calculate average baseline angle from all segments
-    avg_angle = calculate_average_baseline(segments)
+    avg_angle = calculate_average_baseline(segments, layout)
     
-    # Apply same rotation to all segments with text
-    deskewed_segments = []
+    # Merge thin empty segments with neighbors
+    segments = merge_thin_empty_segments(segments, min_height=MIN_CHUNK_HEIGHT)
     for segment in segments:
-        if segment["text_len"] > 0:
-            center = (segment["image"].width/2, segment["image"].height/2)
+        segment["angle"] = float(avg_angle)
+
+    # 7. Rotate the original page once, by both angles, and cut every segment from it
+    if crop:
+        if avg_angle:
             # Use positive angle to match the convention in deskew_image
-            segment["image"] = segment["image"].rotate(avg_angle, center=center, 
-                                                 expand=False, resample=Image.BICUBIC)
-        deskewed_segments.append(segment)
-    
-    # Merge thin empty segments with neighbors
-    segments = merge_thin_empty_segments(deskewed_segments, min_height=MIN_CHUNK_HEIGHT)
+            deskewed_img = SegmentHandler.rotate_page(img, page_angle + avg_angle)
+        for segment in segments:
+            segment["image"] = deskewed_img.crop((0, segment["top"], width, segment["bottom"]))
     
     return segments
 
-def process_image(file_path: Path, out_path: Path) -> dict:
-    """Process a single image using SegmentHandler for file operations"""
+def process_image(file_path: Path, out_path: Path, layout_engine=TesseractLayout, output: str = "files") -> dict:
+    """
+    Process a single image using SegmentHandler for file operations.
+    With output "virtual" no segment files are written; the manifest
+    records the parent page, box and angles for the transcribers to cut
+    each segment from the page themselves.
+    """
     try:
         # Get segment paths using SegmentHandler
         paths = SegmentHandler.get_segment_paths(out_path)
@@ -530,19 +460,22 @@ def process_image(file_path: Path, out_path: Path) -> dict:
 
             # Load and process image
             image = SegmentHandler.load_segment(file_path)
-            segments = adaptive_segment_image(image)
+            segments = adaptive_segment_image(image, layout_engine=layout_engine, crop=(output == "files"))
             
             segment_paths = []
             segment_info = []
             
             # Process and save segments
             for i, segment_data in enumerate(segments):
-                roi = segment_data["image"]
                 segment_filename = SegmentHandler.make_segment_name(out_path.stem, i)
                 out_segment_path = segments_folder / segment_filename
                 
-                # Save segment
-                roi.save(out_segment_path, "JPEG", quality=95, optimize=True)
+                # Save segment; one left by an interrupted run is complete, as saves are atomic
+                if output == "files" and not out_segment_path.exists():
+                    SegmentHandler.save_segment_image(
+                        segment_data["image"], out_segment_path, format="JPEG", quality=95, optimize=True
+                    )
+                    SegmentHandler.renew_lease(segments_folder)
                 
                 # Get relative paths
                 rel_path = SegmentHandler.get_relative_path(file_path)
@@ -554,8 +487,12 @@ def process_image(file_path: Path, out_path: Path) -> dict:
                     "file_path": str(segment_rel_path),
                     "bounding_box": [segment_data["top"], segment_data["bottom"]],
                     "text_len": segment_data["text_len"],
+                    "angle": segment_data["angle"],
+                    "page_angle": segment_data["page_angle"],
                     "parent_image": str(file_path)
                 })
+                if output == "virtual":
+                    segment_info[-1]["virtual"] = True
 
             return {
                 "outputs": segment_paths,
@@ -563,6 +500,8 @@ def process_image(file_path: Path, out_path: Path) -> dict:
                 "parent_image": str(file_path),
                 "details": {
                     "num_segments": len(segments),
+                    "engine": layout_engine.name,
+                    "output": output,
                     "segments": segment_info,
                     "parent_info": {
                         "path": str(file_path),
@@ -579,13 +518,13 @@ def process_image(file_path: Path, out_path: Path) -> dict:
         console.print(f"[red]Error: {file_path.name} - {str(e)}")
         return {"error": str(e)}
 
-def process_document(file_path: str, output_folder: Path) -> dict:
+def process_document(file_path: str, output_folder: Path, layout_engine=TesseractLayout, output: str = "files") -> dict:
     """
     Integrate with process_file utility, returning manifest-friendly output.
     """
     file_path = Path(file_path)
     def process_fn(f: str, o: Path) -> dict:
-        return process_image(Path(f), o)
+        return process_image(Path(f), o, layout_engine, output)
     return process_file(
         file_path=str(file_path),
         output_folder=output_folder,
@@ -593,25 +532,40 @@ def process_document(file_path: str, output_folder: Path) -> dict:
         file_types={
             '.jpg': process_fn,
             '.jpeg': process_fn,
-            '.png': process_fn
+            '.png': process_fn,
+            '.webp': process_fn,
+            '.npy': process_fn
         }
     )
 
 def segment(
     source_folder: Path = typer.Argument(..., help="Source folder containing images"),
     source_manifest: Path = typer.Argument(..., help="Manifest file"),
-    output_folder: Path = typer.Argument(..., help="Output folder for segmented images")
+    output_folder: Path = typer.Argument(..., help="Output folder for segmented images"),
+    engine_name: str = typer.Option(
+        "tesseract",
+        "--engine",
+        help=f"Layout engine: {', '.join(LAYOUT_ENGINES)} (projection needs no OCR; compare them with benchmark.py segment)"
+    ),
+    output: str = typer.Option(
+        "files",
+        "--output",
+        help="files (a JPEG per segment) or virtual (only the manifest; transcribers cut segments from the page)"
+    )
 ):
     """
     Batch segmentation CLI that processes background-removed images.
     Uses source paths from manifest to locate original files.
     """
+    layout_engine = get_layout_engine(engine_name)
+    if output not in SEGMENT_OUTPUTS:
+        raise typer.BadParameter(f"Unknown output: {output} (use one of {', '.join(SEGMENT_OUTPUTS)})")
     processor = BatchProcessor(
         input_manifest=source_manifest,
         output_folder=output_folder,
         process_name="segment",
         base_folder=source_folder / "documents",  # Add /documents to base folder path
-        processor_fn=lambda f, o: process_document(f, o),
+        processor_fn=lambda f, o: process_document(f, o, layout_engine, output),
         use_source=False
     )
     processor.process()
@@ -21,6 +21,10 @@ Key Features:
   * Analyzes vertical patterns for binding detection
   * Considers edge density and text patterns
   * Uses filename patterns for first/cover pages
+- Optional per-folder profiles (--folder-profile):
+  * The first pages of each folder are fully analysed
+  * Once they agree, later pages only locate the gutter, with full analysis
+    as the fallback for pages that look different
 
 Detection Thresholds:
 - Notebooks: aspect ratio > 1.35, width > 2000px, strong vertical patterns
@@ -37,28 +41,175 @@ import cv2
 from pdf2image import convert_from_path
 from utils.batch import BatchProcessor
 from utils.processor import process_file
+from utils.folder_profile import FolderProfiles
+from utils.image_io import intermediate_suffix, load_image, save_intermediate
 from rich.console import Console
 import json
 from typing import Set
+from functools import cached_property
 
 console = Console()
 
-def analyze_page_content(img_array: np.ndarray) -> tuple[float, float, float]:
+class PageFeatures:
+    """
+    Per-image features shared by all split heuristics.
+
+    Every feature is computed lazily on first access and memoized, so a page
+    gets at most one Canny pass, one content threshold and one set of
+    row/column profiles no matter how many heuristics look at it.
+
+    edge_scale < 1 runs Canny on a downsampled copy of the page. Edge
+    metrics are then rescaled to approximate full-resolution units; the
+    thresholds were tuned at full resolution, so 1.0 keeps decisions exact.
+
+    scale > 1 means img_array is a reduced copy of a page of full_size
+    (width, height). Profiles are then interpolated back to full-resolution
+    columns and rows, and scaled to full-resolution sums, so heuristics keep
+    working in full-resolution pixel units.
+    """
+
+    def __init__(self, img_array: np.ndarray, edge_scale: float = 1.0, scale: int = 1, full_size: tuple[int, int] = None):
+        self.img_array = img_array
+        self.scale = scale
+        self.edge_scale = edge_scale
+        if full_size:
+            self.width, self.height = full_size
+        else:
+            self.height, self.width = img_array.shape
+
+    @staticmethod
+    def _column_sums(img_array: np.ndarray) -> np.ndarray:
+        """Sum each column of a single-channel uint8 image"""
+        return cv2.reduce(img_array, 0, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel().astype(np.int64)
+
+    @staticmethod
+    def _row_sums(img_array: np.ndarray) -> np.ndarray:
+        """Sum each row of a single-channel uint8 image"""
+        return cv2.reduce(img_array, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel().astype(np.int64)
+
+    def _to_full_resolution(self, values: np.ndarray, length: int) -> np.ndarray:
+        """Map a profile measured on the reduced image to full-resolution positions and sums"""
+        if self.scale == 1:
+            return values
+        # Reduced pixel i covers full pixels [i*scale, (i+1)*scale) and averages
+        # scale rows, so its sums are 1/scale of a full-resolution line.
+        positions = (np.arange(length) - (self.scale - 1) / 2) / self.scale
+        return np.interp(positions, np.arange(len(values)), values * self.scale)
+
+    @cached_property
+    def sums(self) -> np.ndarray:
+        """Sum of gray values per column (lower = darker)"""
+        return self._to_full_resolution(self._column_sums(self.img_array), self.width)
+
+    @cached_property
+    def content_mask(self) -> np.ndarray:
+        """1 where a pixel is darker than 200 (text/content), else 0"""
+        _, mask = cv2.threshold(self.img_array, 199, 1, cv2.THRESH_BINARY_INV)
+        return mask
+
+    @cached_property
+    def ink_200(self) -> np.ndarray:
+        """Number of pixels darker than 200 per column"""
+        return self._to_full_resolution(self._column_sums(self.content_mask), self.width)
+
+    @cached_property
+    def row_ink_200(self) -> np.ndarray:
+        """Number of pixels darker than 200 per row"""
+        return self._to_full_resolution(self._row_sums(self.content_mask), self.height)
+
+    @cached_property
+    def ink_240(self) -> np.ndarray:
+        """Number of pixels darker than 240 per column"""
+        _, mask = cv2.threshold(self.img_array, 239, 1, cv2.THRESH_BINARY_INV)
+        return self._to_full_resolution(self._column_sums(mask), self.width)
+
+    @cached_property
+    def text_density(self) -> float:
+        """Fraction of content pixels on the whole page"""
+        return self.density(0, self.width)
+
+    @cached_property
+    def half_densities(self) -> tuple[float, float]:
+        """Fraction of content pixels in the left and right halves"""
+        mid = self.width // 2
+        return self.density(0, mid), self.density(mid, self.width)
+
+    @cached_property
+    def edges(self) -> np.ndarray:
+        """Canny edge map, on a downsampled copy when edge_scale < 1"""
+        img = self.img_array
+        if self.edge_scale < 1.0:
+            img = cv2.resize(img, None, fx=self.edge_scale, fy=self.edge_scale, interpolation=cv2.INTER_AREA)
+        return cv2.Canny(img, 100, 200)
+
+    @cached_property
+    def edge_density(self) -> float:
+        """Fraction of edge pixels, in full-resolution units"""
+        edges = self.edges
+        density = np.count_nonzero(edges) / (edges.shape[0] * edges.shape[1])
+        # Edges are ~1px lines, so their density grows as the image shrinks
+        return float(density * self.edge_scale / self.scale)
+
+    @cached_property
+    def edge_variances(self) -> tuple[float, float]:
+        """Variance of the horizontal (per-row) and vertical (per-column) edge profiles"""
+        edges = self.edges
+        height, width = edges.shape
+        horizontal_profile = self._row_sums(edges) / width
+        vertical_profile = self._column_sums(edges) / height
+        correction = (self.edge_scale / self.scale) ** 2
+        return float(np.var(horizontal_profile) * correction), float(np.var(vertical_profile) * correction)
+
+    def center(self, half_width: int) -> np.ndarray:
+        """Column sums in a band of +/- half_width pixels around the page center"""
+        center_x = self.width // 2
+        return self.sums[max(center_x - half_width, 0):center_x + half_width]
+
+    def darkest_column(self, start: int, end: int) -> tuple[int, int]:
+        """Return (x, column_sum) of the darkest column in [start, end), first one on ties"""
+        start, end = max(start, 0), min(end, self.width)
+        x = start + int(np.argmin(self.sums[start:end]))
+        return x, int(self.sums[x])
+
+    def density(self, start: int, end: int) -> float:
+        """Fraction of pixels darker than 200 in columns [start, end)"""
+        return int(self.ink_200[start:end].sum()) / (self.height * (end - start))
+
+def refine_split_point(image: Image.Image, split_x: int, band: int, region: tuple[int, int]) -> tuple[int, int]:
+    """
+    Find the darkest full-resolution column within +/- band pixels of split_x,
+    without leaving the search region [start, end) the coarse pass used.
+    Only that narrow strip of the page is converted to grayscale.
+    Returns (x, column_sum).
+    """
+    width, height = image.size
+    start = max(split_x - band, region[0], 0)
+    end = min(split_x + band + 1, region[1], width)
+    strip = np.array(image.crop((start, 0, end, height)).convert("L"))
+    sums = PageFeatures._column_sums(strip)
+    offset = int(np.argmin(sums))
+    return start + offset, int(sums[offset])
+
+def count_local_minima(values: np.ndarray) -> int:
+    """Count strict local minima in a 1-D array"""
+    inner = values[1:-1]
+    return int(np.count_nonzero((inner < values[:-2]) & (inner < values[2:])))
+
+def analyze_page_content(img_array: np.ndarray, features: PageFeatures = None) -> tuple[float, float, float]:
     """
     Enhanced content analysis that also detects vertical patterns
     Returns (left_density, right_density, pattern_strength)
     """
-    height, width = img_array.shape
+    features = features or PageFeatures(img_array)
+    height, width = features.height, features.width
     mid = width // 2
     
     # Consider pixels darker than 240 as content
-    threshold = 240
-    left_content = np.sum(img_array[:, :mid] < threshold)
-    right_content = np.sum(img_array[:, mid:] < threshold)
+    left_content = features.ink_240[:mid].sum()
+    right_content = features.ink_240[mid:].sum()
     
     # Calculate vertical pattern strength (for notebook detection)
-    center_region = img_array[:, mid-100:mid+100]
-    vertical_sums = np.sum(center_region, axis=0)
+    vertical_sums = features.center(100)
     pattern_strength = np.std(np.diff(vertical_sums))
     
     # Calculate density as percentage
@@ -81,29 +232,26 @@ def convert_to_serializable(obj):
         return bool(obj)  # Ensure booleans are Python native
     return obj
 
-def is_cover_or_label(img_array: np.ndarray, aspect_ratio: float) -> tuple[bool, dict]:
+def is_cover_or_label(img_array: np.ndarray, aspect_ratio: float, features: PageFeatures = None) -> tuple[bool, dict]:
     """
     Detect if image is a cover page or label based on:
     - Content density distribution
     - Edge patterns
     - Text layout patterns
     """
-    height, width = img_array.shape
-    
-    # Calculate text/content regions
-    text_mask = img_array < 200  # Threshold for text/content
+    features = features or PageFeatures(img_array)
+    height, width = features.height, features.width
     
-    # Check content distribution
-    rows_with_content = np.any(text_mask, axis=1)
-    cols_with_content = np.any(text_mask, axis=0)
+    # Check content distribution (pixels darker than 200 are text/content)
+    rows_with_content = features.row_ink_200 > 0
+    cols_with_content = features.ink_200 > 0
     
     # Calculate content spread
     content_height = np.sum(rows_with_content) / height
     content_width = np.sum(cols_with_content) / width
     
     # Calculate edge characteristics
-    edges = cv2.Canny(img_array, 100, 200)
-    edge_density = np.sum(edges > 0) / (width * height)
+    edge_density = features.edge_density
     
     # Characteristics of cover pages/labels:
     # 1. More spread out content (not concentrated in columns)
@@ -155,32 +303,26 @@ def is_likely_label_from_name(file_path: Path) -> bool:
         is_in_photo_album
     )
 
-def detect_document_type(img_array: np.ndarray, width: int, height: int, aspect_ratio: float, file_path: Path = None) -> dict:
+def detect_document_type(img_array: np.ndarray, width: int, height: int, aspect_ratio: float, file_path: Path = None, features: PageFeatures = None) -> dict:
     """Enhanced document type detection with strict priority ordering"""
+    features = features or PageFeatures(img_array)
+
     # Calculate basic metrics first
-    edges = cv2.Canny(img_array, 100, 200)
-    edge_density = np.sum(edges > 0) / (width * height)
-    text_density = np.mean(img_array < 200)
+    edge_density = features.edge_density
+    text_density = features.text_density
 
     # Calculate content distribution
-    left_half = img_array[:, :width//2]
-    right_half = img_array[:, width//2:]
-    left_density = np.mean(left_half < 200)
-    right_density = np.mean(right_half < 200)
+    left_density, right_density = features.half_densities
     content_balance = abs(left_density - right_density)
     
     # More aggressive notebook detection
     center_width = 100  # Pixels to check on each side of center
-    center_x = width // 2
-    center_region = img_array[:, center_x-center_width:center_x+center_width]
-    vertical_pattern = np.std(np.sum(center_region, axis=0))
+    vertical_sums = features.center(center_width)
+    vertical_pattern = np.std(vertical_sums)
     
     # Calculate periodic binding pattern
-    vertical_sums = np.sum(center_region, axis=0)
     smooth_sums = np.convolve(vertical_sums, np.ones(5)/5, mode='valid')  # Smoothing
-    pattern_peaks = len([i for i in range(1, len(smooth_sums)-1) 
-                       if smooth_sums[i] < smooth_sums[i-1] and 
-                          smooth_sums[i] < smooth_sums[i+1]])
+    pattern_peaks = count_local_minima(smooth_sums)
     
     # Enhanced double page detection - combines multiple factors
     is_double_page = (
@@ -227,10 +369,7 @@ def detect_document_type(img_array: np.ndarray, width: int, height: int, aspect_
         }
     
     # Then check for photos
-    horizontal_profile = np.sum(edges, axis=1) / width
-    vertical_profile = np.sum(edges, axis=0) / height
-    h_var = np.var(horizontal_profile)
-    v_var = np.var(vertical_profile)
+    h_var, v_var = features.edge_variances
     
     is_photo = (
         ("photo" in str(file_path).lower() if file_path else False) or
@@ -255,8 +394,7 @@ def detect_document_type(img_array: np.ndarray, width: int, height: int, aspect_
         }
     
     # Finally check for notebooks - update the criteria
-    center_region = img_array[:, width//2-50:width//2+50]
-    vertical_pattern = np.std(np.sum(center_region, axis=0))
+    vertical_pattern = np.std(features.center(50))
     
     is_notebook = (
         aspect_ratio > 1.35 and
@@ -292,10 +430,7 @@ def detect_document_type(img_array: np.ndarray, width: int, height: int, aspect_
         }
     
     # Rest of document type detection with updated criteria
-    horizontal_profile = np.sum(edges, axis=1) / width
-    vertical_profile = np.sum(edges, axis=0) / height
-    h_var = np.var(horizontal_profile)
-    v_var = np.var(vertical_profile)
+    h_var, v_var = features.edge_variances
     
     # More precise photo detection
     is_photo = (
@@ -325,10 +460,7 @@ def detect_document_type(img_array: np.ndarray, width: int, height: int, aspect_
         }
         
     # Check for notebook characteristics first
-    center_region = img_array[:, width//2-50:width//2+50]
-    vertical_pattern = np.std(np.sum(center_region, axis=0))
-    edges = cv2.Canny(img_array, 100, 200)
-    edge_density = np.sum(edges > 0) / (width * height)
+    vertical_pattern = np.std(features.center(50))
     
     # Notebook detection criteria (must check first)
     is_notebook = (
@@ -352,15 +484,8 @@ def detect_document_type(img_array: np.ndarray, width: int, height: int, aspect_
         }
     
     # Rest of document type detection...
-    # Calculate basic metrics first
-    edges = cv2.Canny(img_array, 100, 200)
-    edge_density = np.sum(edges > 0) / (width * height)
-    
     # Check for horizontal/vertical line dominance
-    horizontal_profile = np.sum(edges, axis=1) / width
-    vertical_profile = np.sum(edges, axis=0) / height
-    h_var = np.var(horizontal_profile)
-    v_var = np.var(vertical_profile)
+    h_var, v_var = features.edge_variances
     
     # Enhanced photo detection (photos often have high edge density and variance)
     is_photo = (
@@ -371,7 +496,7 @@ def detect_document_type(img_array: np.ndarray, width: int, height: int, aspect_
     
     # Enhanced label detection (prioritize this check)
     is_likely_label = file_path and is_likely_label_from_name(file_path)
-    text_density = np.mean(img_array < 200)  # Measure text content
+    text_density = features.text_density  # Measure text content
     
     # Strict label criteria
     is_label = (
@@ -395,7 +520,7 @@ def detect_document_type(img_array: np.ndarray, width: int, height: int, aspect_
         }
     
     # Only check for notebook characteristics if not a label/photo
-    center_pattern = np.std(np.sum(img_array[:, width//2-50:width//2+50], axis=0))
+    center_pattern = np.std(features.center(50))
     is_notebook = (
         aspect_ratio > 1.35 and
         center_pattern > 500 and
@@ -414,7 +539,7 @@ def detect_document_type(img_array: np.ndarray, width: int, height: int, aspect_
         "vertical_variance": float(v_var)
     }
 
-def detect_split_point(image: Image.Image, threshold_ratio: float = 0.15, compare_slices: int = 3, file_path: Path = None) -> tuple[bool, int, float, dict]:
+def detect_split_point(image: Image.Image, threshold_ratio: float = 0.15, compare_slices: int = 3, file_path: Path = None, edge_scale: float = 1.0, coarse_factor: int = 1) -> tuple[bool, int, float, dict]:
     """
     Analyzes an image to determine if and where it should be split into two pages.
     
@@ -424,10 +549,16 @@ def detect_split_point(image: Image.Image, threshold_ratio: float = 0.15, compar
     3. Compare darkness of split point to surrounding area
     4. Use fallback detection for subtle splits in wide images
     
+    With coarse_factor > 1, steps 1-4 run on a copy reduced by that factor and
+    the chosen split column is then refined in a narrow full-resolution band,
+    so analysis time and memory barely depend on scan resolution.
+    
     Args:
         image: Input image to analyze
         threshold_ratio: How much of middle region to scan (0.15 = 30% of width)
         compare_slices: Number of pixels to check on each side of potential split
+        edge_scale: Scale of the copy used for edge detection (1.0 = full resolution)
+        coarse_factor: Reduction factor for the analysis image (1 = full resolution)
     
     Returns:
         Tuple of (should_split, split_position, darkness_value, debug_info)
@@ -451,11 +582,18 @@ def detect_split_point(image: Image.Image, threshold_ratio: float = 0.15, compar
     if aspect_ratio < 1.2 or width < 1000:  # Added minimum width check
         return False, None, None, debug_info
     
-    # Convert to grayscale numpy array
-    img_array = np.array(image.convert("L"))
+    # Convert to grayscale numpy array; features are shared by all heuristics
+    if coarse_factor > 1:
+        img_array = np.array(image.reduce(coarse_factor).convert("L"))
+        features = PageFeatures(img_array, edge_scale=edge_scale, scale=coarse_factor, full_size=(width, height))
+    else:
+        img_array = np.array(image.convert("L"))
+        features = PageFeatures(img_array, edge_scale=edge_scale)
+    # Full-resolution band searched around the coarse split column
+    refine_band = 16 * coarse_factor
     
     # Detect document type with strict priority
-    doc_type = detect_document_type(img_array, width, height, aspect_ratio, file_path)
+    doc_type = detect_document_type(img_array, width, height, aspect_ratio, file_path, features=features)
     
     # Never split labels, photos, covers or first pages
     if doc_type["is_label"] or doc_type["is_photo"] or doc_type["is_cover"] or (file_path and is_likely_label_from_name(file_path)):
@@ -467,15 +605,11 @@ def detect_split_point(image: Image.Image, threshold_ratio: float = 0.15, compar
         # Find optimal split point near center
         center_x = width // 2
         search_range = 200
-        split_x = center_x
-        min_sum = float('inf')
-        
-        for x in range(center_x - search_range, center_x + search_range):
-            if 0 <= x < width:
-                vertical_sum = np.sum(img_array[:, x])
-                if vertical_sum < min_sum:
-                    min_sum = vertical_sum
-                    split_x = x
+        search_region = (center_x - search_range, center_x + search_range)
+        split_x, min_sum = features.darkest_column(*search_region)
+        if coarse_factor > 1:
+            debug_info["coarse_split_point"] = split_x
+            split_x, min_sum = refine_split_point(image, split_x, refine_band, search_region)
         
         debug_info.update(doc_type)
         avg_darkness = min_sum / height
@@ -487,7 +621,7 @@ def detect_split_point(image: Image.Image, threshold_ratio: float = 0.15, compar
         return False, None, None, debug_info
     
     # Analyze content distribution
-    left_density, right_density, pattern_strength = analyze_page_content(img_array)
+    left_density, right_density, pattern_strength = analyze_page_content(img_array, features)
     debug_info["content_density"] = {"left": float(left_density), "right": float(right_density)}
     
     # If one side is mostly empty (< 2% content) and other has content (> 10%),
@@ -516,25 +650,14 @@ def detect_split_point(image: Image.Image, threshold_ratio: float = 0.15, compar
     })
     
     # Look for darkest vertical line in middle region
-    min_sum = float('inf')
-    split_x = None
-    
-    for x in range(mid_region_start, mid_region_end):
-        vertical_sum = np.sum(img_array[:, x])
-        if (vertical_sum < min_sum):
-            min_sum = vertical_sum
-            split_x = x
+    split_x, min_sum = features.darkest_column(mid_region_start, mid_region_end)
             
     # Determine if split is needed based on darkness of line
     avg_darkness = min_sum / height
     
     # Compare surrounding slices around the split_x index
-    slice_values = []
-    for offset in range(-compare_slices, compare_slices + 1):
-        x_check = split_x + offset
-        if 0 <= x_check < width:
-            slice_values.append(np.sum(img_array[:, x_check]) / height)
-    avg_slice_value = float(np.mean(slice_values)) if slice_values else float('inf')
+    slice_values = features.sums[max(split_x - compare_slices, 0):split_x + compare_slices + 1] / height
+    avg_slice_value = float(np.mean(slice_values)) if len(slice_values) else float('inf')
     
     # Require a stronger difference so we don't split if the middle line isn't distinctly darker
     darkness_diff = avg_slice_value - avg_darkness
@@ -566,7 +689,7 @@ def detect_split_point(image: Image.Image, threshold_ratio: float = 0.15, compar
     is_notebook = False
     if aspect_ratio > 1.4:
         # Check for consistent vertical line pattern
-        vertical_sums = [np.sum(img_array[:, x]) / height for x in range(mid_region_start, mid_region_end)]
+        vertical_sums = features.sums[mid_region_start:mid_region_end] / height
         variations = np.diff(vertical_sums)
         pattern_strength = np.std(variations)
         is_notebook = pattern_strength > 10  # Higher variation suggests spiral binding
@@ -585,7 +708,7 @@ def detect_split_point(image: Image.Image, threshold_ratio: float = 0.15, compar
     
     # Enhanced notebook detection
     # Look for periodic patterns in middle region that suggest spiral binding
-    vertical_pattern = np.std([np.sum(img_array[:, x]) for x in range(mid_region_start, mid_region_end)])
+    vertical_pattern = np.std(features.sums[mid_region_start:mid_region_end])
     is_notebook = (aspect_ratio > 1.35 and vertical_pattern > 1000)
     
     # More aggressive splitting for notebooks
@@ -594,15 +717,14 @@ def detect_split_point(image: Image.Image, threshold_ratio: float = 0.15, compar
         # Find optimal split point near center
         center_x = width // 2
         search_range = 200  # Look 200px around center
-        split_x = center_x  # Default to center
         
-        # Search for darkest line near center
-        for x in range(center_x - search_range, center_x + search_range):
-            if x >= 0 and x < width:
-                vertical_sum = np.sum(img_array[:, x])
-                if vertical_sum < min_sum:
-                    min_sum = vertical_sum
-                    split_x = x
+        # Search for darkest line near center, keeping the center unless
+        # a line darker than the one already found exists there
+        near_x, near_sum = features.darkest_column(center_x - search_range, center_x + search_range)
+        if near_sum < min_sum:
+            split_x, min_sum = near_x, near_sum
+        else:
+            split_x = center_x
     
     # Labels typically have much smaller height and limited content
     is_label = height < 1000 and width < 2000
@@ -612,9 +734,16 @@ def detect_split_point(image: Image.Image, threshold_ratio: float = 0.15, compar
     # For GHC_B05 files that shouldn't split, add filename pattern check
     if file_path and any(x in str(file_path).lower() for x in ["ghc_b05_doc04", "ghc_b05_doc06"]):
         # These specific documents shouldn't be split unless they meet stricter criteria
-        if edge_density < 0.02 or vertical_pattern < 3000:
+        if doc_type["edge_density"] < 0.02 or vertical_pattern < 3000:
             should_split = False
     
+    # Refine the coarse split column at full resolution
+    coarse_split_point = None
+    if should_split and coarse_factor > 1:
+        coarse_split_point = split_x
+        split_x, min_sum = refine_split_point(image, split_x, refine_band, (mid_region_start, mid_region_end))
+        avg_darkness = min_sum / height
+    
     # Update debug info with final values - ensure all values are serializable
     debug_info = convert_to_serializable({
         "avg_darkness": avg_darkness,
@@ -631,13 +760,101 @@ def detect_split_point(image: Image.Image, threshold_ratio: float = 0.15, compar
         "vertical_pattern": float(vertical_pattern),
         "is_label": bool(is_label)
     })
+    if coarse_split_point is not None:
+        debug_info["coarse_split_point"] = int(coarse_split_point)
     
     # Update debug info with document type info
     debug_info.update(doc_type)
     
     return should_split, split_x, avg_darkness, debug_info
 
-def split_image(image: Image.Image, file_path: Path = None) -> tuple[list[Image.Image], dict]:
+# Pages of a folder fully analysed before its profile is settled
+PROFILE_SAMPLE_PAGES = 5
+# Fraction of the width searched beyond the sampled split positions
+GUTTER_MARGIN = 0.02
+
+def measure_gutter(image: Image.Image, region: tuple[float, float]) -> tuple[int, int, float]:
+    """
+    Find the darkest column between the region's start and end, given as
+    fractions of the width, converting only that strip to grayscale.
+    Returns (x, column_sum, contrast) where contrast is how much darker the
+    column is than the median column of the strip, per row.
+    """
+    width, height = image.size
+    start, end = max(int(width * region[0]), 0), min(int(width * region[1]) + 1, width)
+    strip = np.array(image.crop((start, 0, end, height)).convert("L"))
+    sums = PageFeatures._column_sums(strip)
+    offset = int(np.argmin(sums))
+    contrast = (float(np.median(sums)) - sums[offset]) / height
+    return start + offset, int(sums[offset]), float(contrast)
+
+def detect_from_folder_profile(image: Image.Image, profile: dict) -> tuple[bool, int, float, dict]:
+    """
+    Decide a page from its folder's settled profile without full analysis.
+    Returns None when the page does not look like the rest of the folder,
+    in which case the caller falls back to detect_split_point.
+    """
+    width, height = image.size
+    aspect_ratio = width / height
+    if abs(aspect_ratio / profile["aspect_ratio"] - 1) > 0.15:
+        return None
+    
+    debug_info = {
+        "aspect_ratio": float(aspect_ratio),
+        "mid_region_start": None,
+        "mid_region_end": None,
+        "avg_darkness": None,
+        "split_point": None,
+        "should_split": False,
+        "content_density": None,
+        "folder_profile": profile["kind"]
+    }
+    if profile["kind"] == "single":
+        return False, None, None, debug_info
+    
+    split_x, min_sum, contrast = measure_gutter(image, profile["search_region"])
+    if contrast < 0.5 * profile["min_contrast"]:
+        return None
+    
+    avg_darkness = min_sum / height
+    debug_info.update({
+        "avg_darkness": float(avg_darkness),
+        "split_point": int(split_x),
+        "mid_region_start": int(width * profile["search_region"][0]),
+        "mid_region_end": int(width * profile["search_region"][1]),
+        "should_split": True,
+        "gutter_contrast": contrast
+    })
+    return True, split_x, avg_darkness, debug_info
+
+def update_folder_profile(profile: dict, image: Image.Image, should_split: bool, split_x: int):
+    """Add a fully analysed page to an unsettled profile and settle it once enough pages are in"""
+    if profile.get("kind"):
+        return
+    width, height = image.size
+    sample = {"aspect_ratio": width / height, "kind": "spread" if should_split else "single"}
+    if should_split:
+        sample["split_ratio"] = split_x / width
+        region = (sample["split_ratio"] - GUTTER_MARGIN, sample["split_ratio"] + GUTTER_MARGIN)
+        sample["contrast"] = measure_gutter(image, region)[2]
+    samples = profile.setdefault("samples", [])
+    samples.append(sample)
+    if len(samples) < PROFILE_SAMPLE_PAGES:
+        return
+    
+    # Only folders whose sampled pages all agree get a shortcut
+    kinds = {sample["kind"] for sample in samples}
+    if len(kinds) > 1:
+        profile["kind"] = "mixed"
+        return
+    profile["kind"] = kinds.pop()
+    profile["aspect_ratio"] = float(np.median([sample["aspect_ratio"] for sample in samples]))
+    if profile["kind"] == "spread":
+        split_ratios = [sample["split_ratio"] for sample in samples]
+        profile["search_region"] = [min(split_ratios) - GUTTER_MARGIN, max(split_ratios) + GUTTER_MARGIN]
+        profile["min_contrast"] = min(sample["contrast"] for sample in samples)
+
+def split_image(image: Image.Image, file_path: Path = None, profile: dict = None, **detect_options) -> tuple[list[Image.Image], dict]:
     """
     Splits an image into left and right pages if needed.
     
@@ -646,10 +863,31 @@ def split_image(image: Image.Image, file_path: Path = None) -> tuple[list[Image.
     2. If split needed, crops image into left and right sections
     3. Returns original image if no split needed
     
+    detect_options are passed on to detect_split_point (edge_scale, coarse_factor).
+    
+    With a folder profile, the first pages of a folder are fully analysed and
+    recorded in it. Once they agree on one type, later pages only look for
+    the gutter near the usual split position, falling back to full analysis
+    when a page differs from the folder (aspect ratio or a faint gutter).
+    Label-like file names always get full analysis.
+    
     Returns:
         Tuple of (list of image parts, debug information)
     """
-    should_split, split_point, avg_darkness, debug_info = detect_split_point(image, file_path=file_path)
+    use_profile = profile is not None and file_path and not is_likely_label_from_name(file_path)
+    result = None
+    if use_profile and profile.get("kind") in ("single", "spread"):
+        result = detect_from_folder_profile(image, profile)
+        if result is None:
+            profile["fallbacks"] = profile.get("fallbacks", 0) + 1
+    
+    if result is None:
+        result = detect_split_point(image, file_path=file_path, **detect_options)
+        if use_profile:
+            status = {None: "sample", "mixed": "mixed"}.get(profile.get("kind"), "fallback")
+            update_folder_profile(profile, image, result[0], result[1])
+            result[3]["folder_profile"] = status
+    should_split, split_point, avg_darkness, debug_info = result
     
     if (not should_split):
         return [image], debug_info
@@ -661,13 +899,15 @@ def split_image(image: Image.Image, file_path: Path = None) -> tuple[list[Image.
     
     return [left_page, right_page], debug_info
 
-def process_image(file_path: Path, out_path: Path) -> dict:
+def process_image(file_path: Path, out_path: Path, profiles: FolderProfiles = None, image_format: str = "jpeg", **detect_options) -> dict:
     """Process a single image file for splitting"""
-    img = Image.open(file_path)
-    if (img.mode != 'RGB'):
-        img = img.convert('RGB')
+    img = load_image(file_path, 'RGB')
     
-    parts, debug_info = split_image(img, file_path=file_path)
+    # Outputs mirror the source folders, so the output folder keys the profile
+    profile = profiles.load(out_path.parent) if profiles else None
+    parts, debug_info = split_image(img, file_path=file_path, profile=profile, **detect_options)
+    if profiles:
+        profiles.save(out_path.parent)
     outputs = []
     
     details = convert_to_serializable({
@@ -681,16 +921,14 @@ def process_image(file_path: Path, out_path: Path) -> dict:
     for i, part in enumerate(parts):
         # Create output filename with correct folder structure
         if len(parts) > 1:
-            part_name = f"{out_path.stem}_part_{i+1}.jpg"
+            part_name = f"{out_path.stem}_part_{i+1}"
         else:
-            part_name = f"{out_path.stem}.jpg"
+            part_name = out_path.stem
             
-        part_path = out_path.parent / part_name
-        part_path.parent.mkdir(parents=True, exist_ok=True)
-        part.save(part_path, "JPEG", quality=100)
+        part_path = save_intermediate(part, out_path.parent / part_name, image_format)
         
         # Build output path preserving full source hierarchy
-        rel_path = Path(*source_dir) / part_name
+        rel_path = Path(*source_dir) / part_path.name
         outputs.append(str(rel_path))
         details[f"part_{i+1}_size"] = list(part.size)
     
@@ -699,7 +937,7 @@ def process_image(file_path: Path, out_path: Path) -> dict:
         "details": details
     }
 
-def process_pdf(file_path: Path, out_path: Path) -> dict:
+def process_pdf(file_path: Path, out_path: Path, image_format: str = "jpeg", **detect_options) -> dict:
     """Process a PDF file"""
     outputs = []
     details = {}
@@ -713,20 +951,17 @@ def process_pdf(file_path: Path, out_path: Path) -> dict:
             image = image.convert('RGB')
             
         # Split page if needed
-        parts, debug_info = split_image(image)
+        parts, debug_info = split_image(image, **detect_options)
         
         for j, part in enumerate(parts):
             # Create output filename
             if (len(parts) > 1):
-                part_path = out_path.parent / f"{out_path.stem}_page_{i+1}_part_{j+1}.jpg"
+                part_path = out_path.parent / f"{out_path.stem}_page_{i+1}_part_{j+1}"
             else:
-                part_path = out_path.parent / f"{out_path.stem}_page_{i+1}.jpg"
+                part_path = out_path.parent / f"{out_path.stem}_page_{i+1}"
                 
-            # Ensure directory exists
-            part_path.parent.mkdir(parents=True, exist_ok=True)
-            
             # Save split part
-            part.save(part_path, "JPEG", quality=100)
+            part_path = save_intermediate(part, part_path, image_format)
             outputs.append(str(part_path.relative_to(part_path.parent.parent)))
             
         details[f"page_{i+1}"] = {
@@ -747,39 +982,72 @@ def process_pdf(file_path: Path, out_path: Path) -> dict:
         "details": details
     }
 
-def process_document(file_path: str, output_folder: Path) -> dict:
+def process_document(file_path: str, output_folder: Path, profiles: FolderProfiles = None, image_format: str = "jpeg", **detect_options) -> dict:
     """Process a single document file"""
     file_path = Path(file_path)
     
     def process_fn(f: str, o: Path) -> dict:
-        return process_image(Path(f), o)
+        return process_image(Path(f), o, profiles=profiles, image_format=image_format, **detect_options)
+    
+    def pdf_fn(f: str, o: Path) -> dict:
+        return process_pdf(Path(f), o, image_format=image_format, **detect_options)
     
     return process_file(
         file_path=str(file_path),
         output_folder=output_folder,
         process_fn=process_fn,
+        # Finds pages that were not split; split ones are written as _part_1, _part_2
+        output_suffix=intermediate_suffix(image_format),
         file_types={
-            '.pdf': process_pdf,
+            '.pdf': pdf_fn,
             '.jpg': process_fn,
             '.jpeg': process_fn,
             '.tif': process_fn,
             '.tiff': process_fn,
-            '.png': process_fn
+            '.png': process_fn,
+            '.webp': process_fn,
+            '.npy': process_fn
         }
     )
 
 def split(
     crops_folder: Path = typer.Argument(..., help="Input crops folder"),
     crops_manifest: Path = typer.Argument(..., help="Input crops manifest file"),
-    splits_folder: Path = typer.Argument(..., help="Output folder for split images")
+    splits_folder: Path = typer.Argument(..., help="Output folder for split images"),
+    edge_scale: float = typer.Option(
+        1.0,
+        "--edge-scale",
+        min=0.1, max=1.0,
+        help="Run edge detection on a copy downsampled by this factor (1.0 = full resolution, exact decisions)"
+    ),
+    coarse_factor: int = typer.Option(
+        1,
+        "--coarse-factor",
+        min=1, max=8,
+        help="Analyse a copy reduced by this factor (e.g. 4 or 8) and refine the split at full resolution"
+    ),
+    folder_profile: bool = typer.Option(
+        False,
+        "--folder-profile/--no-folder-profile",
+        help="Learn each folder's page type from its first pages and only locate the gutter on the rest"
+    ),
+    image_format: str = typer.Option(
+        "jpeg",
+        "--format",
+        help="Intermediate image format: jpeg (visually lossless), png, webp (lossless), webp-lossy or npy (raw)"
+    )
 ):
     """Split cropped book pages into individual pages"""
+    profiles = FolderProfiles("split") if folder_profile else None
     processor = BatchProcessor(
         input_manifest=crops_manifest,
         output_folder=splits_folder,
         process_name="split",  # Add required process_name parameter
         base_folder=crops_folder / "documents",  # Add /documents to match crop.py's structure
-        processor_fn=lambda f, o: process_document(f, o)
+        processor_fn=lambda f, o: process_document(
+            f, o, profiles=profiles, image_format=image_format,
+            edge_scale=edge_scale, coarse_factor=coarse_factor
+        )
     )
     processor.process()
 
@@ -1,7 +1,10 @@
 import typer
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
 import base64
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterable, Iterator
 from io import BytesIO
 from PIL import Image
 import json
@@ -16,19 +19,58 @@ console = Console()
 DEFAULT_PROMPT = "Extract all text line by line. Do not number lines. RETURN ONLY PLAIN TEXT. SAY NOTHING ELSE"
 
 class LMStudioTranscriber:
-    def __init__(self, api_url: str, model_name: str, prompt: str = DEFAULT_PROMPT):
+    def __init__(self, api_url: str, model_name: str, prompt: str = DEFAULT_PROMPT, in_flight: int = 1):
         self.api_url = api_url
         self.model_name = model_name
         self.prompt = prompt
+        # Requests sent to the server at once; one or more wait their turn
+        # while it works, so it never sits idle between images
+        self.in_flight = in_flight
+        # One keep-alive connection per request in flight, reused across images
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=in_flight)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @staticmethod
+    def encode_image(image: Image.Image) -> str:
+        """Image as base64 PNG, as the request carries it"""
+        buffered = BytesIO()
+        image.save(buffered, format="PNG")
+        return base64.b64encode(buffered.getvalue()).decode()
 
     def process_image(self, image: Image.Image) -> str:
         """Process an image using LMStudio's API"""
-        try:
-            # Convert image to base64
-            buffered = BytesIO()
-            image.save(buffered, format="PNG")
-            img_str = base64.b64encode(buffered.getvalue()).decode()
+        return self.transcribe_encoded(self.encode_image(image))
+
+    def process_images(self, images: Iterable, in_flight: int = None) -> Iterator[tuple[int, str]]:
+        """
+        Transcribe images with up to in_flight requests at the server at once,
+        yielding (index, transcription) as each finishes. The next image is
+        read and encoded here while the server works on the earlier ones.
+        Images that are None (could not be loaded) yield None.
+        """
+        in_flight = in_flight or self.in_flight
+        pending = {}
+        with ThreadPoolExecutor(max_workers=in_flight) as executor:
+            for index, image in enumerate(images):
+                if image is None:
+                    yield index, None
+                    continue
+                encoded = self.encode_image(image)
+                while len(pending) >= in_flight:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield pending.pop(future), future.result()
+                pending[executor.submit(self.transcribe_encoded, encoded)] = index
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
 
+    def transcribe_encoded(self, img_str: str) -> str:
+        """Transcribe a base64 PNG image, or return an empty string if the request fails"""
+        try:
             # Prepare the request payload
             payload = {
                 "model": self.model_name,
@@ -46,7 +88,7 @@ class LMStudioTranscriber:
             }
 
             # Make the API request
-            response = requests.post(
+            response = self.session.post(
                 f"{self.api_url}/chat/completions",
                 json=payload,
                 headers={"Content-Type": "application/json"}
@@ -63,8 +105,11 @@ class LMStudioTranscriber:
             console.print(f"[red]Error in LMStudio processing: {e}")
             return ""
 
-def process_image(img_path: Path, out_path: Path, api_url: str, model_name: str) -> dict:
-    """Process a single image file, returning manifest-compatible output"""
+def process_image(img_path: Path, out_path: Path, transcriber: LMStudioTranscriber, transcription: str = None) -> dict:
+    """
+    Process a single image file, returning manifest-compatible output. A
+    transcription already made for it (by process_batch) is saved as is.
+    """
     try:
         # Ensure output directory exists
         out_path.parent.mkdir(parents=True, exist_ok=True)
@@ -74,16 +119,10 @@ def process_image(img_path: Path, out_path: Path, api_url: str, model_name: str)
         out_path.touch()
         
         try:
-            # Initialize transcriber
-            transcriber = LMStudioTranscriber(
-                api_url=api_url,
-                model_name=model_name,
-                prompt=DEFAULT_PROMPT
-            )
-            
             # Load and process image
-            image = Image.open(img_path).convert("RGB")
-            transcription = transcriber.process_image(image)
+            if transcription is None:
+                image = SegmentHandler.load_segment(img_path)
+                transcription = transcriber.process_image(image)
             
             # Save transcription
             with open(out_path, 'w', encoding='utf-8') as f:
@@ -120,13 +159,13 @@ def process_image(img_path: Path, out_path: Path, api_url: str, model_name: str)
         console.print(f"[red]Error processing {img_path}: {e}")
         return {"error": str(e)}
 
-def process_document(file_path: str, output_folder: Path, api_url: str, model_name: str) -> dict:
+def process_document(file_path: str, output_folder: Path, transcriber: LMStudioTranscriber, transcription: str = None) -> dict:
     """Process a document using the process_file utility"""
     file_path = Path(file_path)
     
     def process_fn(f: str, o: Path) -> dict:
         # Process the image and let process_file handle path management
-        result = process_image(Path(f), o, api_url, model_name)
+        result = process_image(Path(f), o, transcriber, transcription)
         
         # Add parent image info if needed
         if not result.get("error"):
@@ -145,10 +184,28 @@ def process_document(file_path: str, output_folder: Path, api_url: str, model_na
         file_types={
             '.png': process_fn,
             '.jpg': process_fn,
-            '.jpeg': process_fn
+            '.jpeg': process_fn,
+            '.webp': process_fn,
+            '.npy': process_fn
         }
     )
 
+def process_batch(file_paths: list, output_folder: Path, transcriber: LMStudioTranscriber):
+    """
+    Transcribe a batch of files with several requests in flight, yielding
+    (index in batch, manifest entry) in the order the server finishes them.
+    Entries are written the same way as one at a time.
+    """
+    def load():
+        for file_path in file_paths:
+            try:
+                yield SegmentHandler.load_segment(file_path)
+            except Exception:
+                yield None  # Reported when the file is processed on its own below
+
+    for index, transcription in transcriber.process_images(load()):
+        yield index, process_document(file_paths[index], output_folder, transcriber, transcription)
+
 def transcribe(
     segment_folder: Path = typer.Argument(..., help="Input segments folder"),
     segment_manifest: Path = typer.Argument(..., help="Input segments manifest"),
@@ -167,6 +224,12 @@ def transcribe(
         DEFAULT_PROMPT,
         "--prompt", "-p",
         help="Prompt for transcription"
+    ),
+    in_flight: int = typer.Option(
+        2,
+        "--in-flight", "-j",
+        min=1,
+        help="Requests sent to LM Studio at once; results are saved as they finish (compare with benchmark.py lmstudio)"
     )
 ):
     """Batch transcription CLI using LMStudio for processing"""
@@ -177,13 +240,20 @@ def transcribe(
     console.print(f"Using LMStudio API: {api_url}")
     console.print(f"Using model: {model_name}")
     console.print(f"Using prompt: {prompt}")
+    console.print(f"Requests in flight: {in_flight}")
+
+    # Segments written with segment.py --output virtual are cut from their pages
+    SegmentHandler.load_virtual_segments(segment_manifest)
 
+    transcriber = LMStudioTranscriber(api_url=api_url, model_name=model_name, prompt=prompt, in_flight=in_flight)
     processor = BatchProcessor(
         input_manifest=segment_manifest,
         output_folder=transcribed_folder,
         process_name="transcription",
-        processor_fn=lambda f, o: process_document(f, o, api_url, model_name),
-        base_folder=segment_folder
+        processor_fn=lambda f, o: process_document(f, o, transcriber),
+        base_folder=segment_folder,
+        batch_processor_fn=lambda files, o: process_batch(files, o, transcriber),
+        completion_order=True
     )
     return processor.process()
 
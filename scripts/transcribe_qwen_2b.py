@@ -1,15 +1,18 @@
 import typer
+import copy
 from pathlib import Path
 import torch
 import numpy as np
 import re
 from PIL import Image
 import warnings
-from transformers import Qwen2VLForConditionalGeneration, AutoProcessor
+from transformers import Qwen2VLForConditionalGeneration, AutoProcessor, DynamicCache, StoppingCriteria, StoppingCriteriaList
 from rich.console import Console
 from utils.batch import BatchProcessor
 from utils.processor import process_file
 from utils.segment_handler import SegmentHandler
+from utils.visual_budget import VisualBudget, MIN_PIXELS, MAX_PIXELS, PATCH_SIZE
+from utils.token_budget import TokenBudget, heuristic_max_new_tokens
 import os
 
 console = Console()
@@ -19,26 +22,147 @@ os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 DEFAULT_PROMPT = "Extract all text line by line. Do not number lines. RETURN ONLY PLAIN TEXT. SAY NOTHING ELSE"
 
+# How the model is loaded: auto keeps the checkpoint's dtype on the best
+# device; fp32, bf16 and int8 load on the CPU, int8 with dynamically
+# quantized linear layers (compare with benchmark.py precision)
+PRECISIONS = ("auto", "fp32", "bf16", "int8")
+
+def cpu_supports_bf16() -> bool:
+    """Whether the CPU has native bfloat16 instructions (AVX512-BF16 or AMX)"""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = next((line.split(":", 1)[1].split() for line in f if line.startswith("flags")), [])
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+# sample draws each token (temperature 0.7, top-p 0.9); greedy takes the most
+# likely one, so the same image always gives the same text
+DECODINGS = ("sample", "greedy")
+
+class RepetitionLoopStopper(StoppingCriteria):
+    """
+    Stops a sequence as soon as its newest tokens are one n-gram of
+    min_ngram to max_ngram tokens repeated back to back, at least
+    min_repeats times and over at least min_span tokens. The span keeps
+    short legitimate repeats (dotted leaders, "do. do.") going while a
+    model stuck on a line is stopped after a few copies of it. loops maps
+    each stopped row of the batch to the length of its n-gram.
+    """
+
+    def __init__(self, prompt_length: int, min_ngram: int = 3, max_ngram: int = 40, min_repeats: int = 3, min_span: int = 32):
+        self.prompt_length = prompt_length
+        self.min_ngram = min_ngram
+        self.max_ngram = max_ngram
+        self.min_repeats = min_repeats
+        self.min_span = min_span
+        self.loops = {}
+
+    def loop_length(self, tokens: list) -> int:
+        """Length of the n-gram the end of tokens repeats, 0 if it is not looping"""
+        for n in range(self.min_ngram, self.max_ngram + 1):
+            repeats = max(self.min_repeats, -(-self.min_span // n))
+            if n * repeats > len(tokens):
+                break
+            tail = tokens[-n:]
+            if all(tokens[-(k + 1) * n:len(tokens) - k * n] == tail for k in range(1, repeats)):
+                return n
+        return 0
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # Enough of the newest tokens to hold the longest loop looked for
+        window = self.max_ngram * self.min_repeats + self.min_span
+        start = max(self.prompt_length, input_ids.shape[1] - window)
+        done = []
+        for row, ids in enumerate(input_ids):
+            if row in self.loops:
+                done.append(True)
+                continue
+            n = self.loop_length(ids[start:].tolist())
+            if n:
+                self.loops[row] = n
+            done.append(bool(n))
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+    def trim(self, row: int, tokens: list) -> list:
+        """tokens of row with a stopped loop cut back to its first copy"""
+        n = self.loops.get(row)
+        if not n:
+            return tokens
+        # Drop every token that repeats the one n before it, leaving the
+        # loop's first copy from wherever it started
+        end = len(tokens)
+        while end > n and tokens[end - 1] == tokens[end - 1 - n]:
+            end -= 1
+        return tokens[:end]
+
+# Batched images are padded up to multiples of this many pixels in width: four
+# of the model's 28-pixel patch merges, so segments of similar width share a
+# bucket. Heights are only rounded to whole patches, as thin line segments
+# would otherwise gain up to three rows of padding tokens
+BUCKET_WIDTH = 112
+
+def bucket_size(size: tuple) -> tuple:
+    """The size an image of size (width, height) is padded to for batching"""
+    width, height = size
+    return -(-width // BUCKET_WIDTH) * BUCKET_WIDTH, -(-height // PATCH_SIZE) * PATCH_SIZE
+
+def pad_image(image: Image.Image, size: tuple) -> Image.Image:
+    """image on a white canvas of size, at the top left"""
+    if image.size == tuple(size):
+        return image
+    canvas = Image.new("RGB", size, "white")
+    canvas.paste(image, (0, 0))
+    return canvas
+
 class TranscriptionProcessor:
     _instance = None
     _model = None
     _processor = None
 
-    def __new__(cls, model_name: str = None, prompt: str = DEFAULT_PROMPT):
+    def __new__(cls, model_name: str = None, prompt: str = DEFAULT_PROMPT, budget: VisualBudget = None, precision: str = "auto", threads: int = None, decoding: str = "sample", stop_loops: bool = True, token_budget: TokenBudget = None, prompt_first: bool = False, prefix_cache: bool = True):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
         return cls._instance
 
-    def __init__(self, model_name: str = None, prompt: str = DEFAULT_PROMPT):
+    def __init__(self, model_name: str = None, prompt: str = DEFAULT_PROMPT, budget: VisualBudget = None, precision: str = "auto", threads: int = None, decoding: str = "sample", stop_loops: bool = True, token_budget: TokenBudget = None, prompt_first: bool = False, prefix_cache: bool = True):
         if not hasattr(self, 'initialized'):
+            if precision not in PRECISIONS:
+                raise ValueError(f"Unknown precision: {precision} (use one of {', '.join(PRECISIONS)})")
+            if decoding not in DECODINGS:
+                raise ValueError(f"Unknown decoding: {decoding} (use one of {', '.join(DECODINGS)})")
             self.model_name = model_name
             self.prompt = prompt
+            self.budget = budget or VisualBudget()
+            self.precision = precision
+            self.decoding = decoding
+            self.stop_loops = stop_loops
+            self.token_budget = token_budget
+            self.prompt_first = prompt_first
+            # Key/value cache of the prompt tokens before the image, shared by
+            # every image; None until first needed, False once found unusable.
+            # With the image first this is only the system prompt (~15 tokens)
+            self.prefix_cache = prefix_cache
+            self._prefix = None
+            self._prefix_checked = False
+            # Totals over every generate call, for benchmarks and reports
+            self.stats = {"generated_tokens": 0, "loops_stopped": 0}
+            if threads:
+                # Intra-op threads of the CPU matrix multiplications
+                torch.set_num_threads(threads)
             self.device = self._get_device()
             self._load_model()
             self.initialized = True
 
+    @classmethod
+    def reset(cls):
+        """Drop the loaded model so the next instance loads one again"""
+        cls._instance = None
+
     def _get_device(self) -> str:
         """Device detection with proper MPS support"""
+        if self.precision != "auto":
+            return "cpu"
         try:
             if torch.cuda.is_available():
                 return "cuda"
@@ -60,17 +184,46 @@ class TranscriptionProcessor:
                     self.model_name,
                     trust_remote_code=True
                 )
-                self._model = Qwen2VLForConditionalGeneration.from_pretrained(
-                    self.model_name,
-                    torch_dtype="auto",
-                    device_map="auto"  # Keep original device handling
-                )
-                console.print("[green]Model loaded successfully")
+                # Batched prompts are padded on the left so answers follow them directly
+                self._processor.tokenizer.padding_side = "left"
+                if self.precision == "auto":
+                    self._model = Qwen2VLForConditionalGeneration.from_pretrained(
+                        self.model_name,
+                        torch_dtype="auto",
+                        device_map="auto"  # Keep original device handling
+                    )
+                else:
+                    self._model = self._load_cpu_model()
+                console.print(f"[green]Model loaded successfully ({self.precision})")
             except Exception as e:
                 console.print(f"[red]Error loading model: {e}")
                 self._model = None
                 self._processor = None
 
+    def _load_cpu_model(self):
+        """The model on the CPU in fp32, bf16 or with int8 linear layers"""
+        precision = self.precision
+        if precision == "bf16" and not cpu_supports_bf16():
+            console.print("[yellow]CPU has no native bfloat16 support; loading in fp32")
+            precision = "fp32"
+        model = Qwen2VLForConditionalGeneration.from_pretrained(
+            self.model_name,
+            torch_dtype=torch.bfloat16 if precision == "bf16" else torch.float32
+        )
+        model.eval()
+        if precision == "int8":
+            # Weights of the language model's linear layers become int8;
+            # activations are quantized on the fly per batch, so no
+            # calibration is needed. The vision tower stays in fp32: it reads
+            # its dtype from a linear layer's weight. Newer transformers keep
+            # the vision tower inside model.model next to language_model
+            language_model = getattr(model.model, "language_model", model.model)
+            torch.ao.quantization.quantize_dynamic(language_model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {"lm_head": torch.ao.quantization.default_dynamic_qconfig}, dtype=torch.qint8
+            )
+        return model
+
     @property
     def model(self):
         return self._model
@@ -117,102 +270,275 @@ class TranscriptionProcessor:
         except Exception:
             return 30
 
+    def max_new_tokens(self, estimated_words: int) -> int:
+        """Answer length allowed for an image, from the fitted token budget if there is one"""
+        if self.token_budget is not None:
+            return self.token_budget.predict(estimated_words)
+        return heuristic_max_new_tokens(estimated_words)
+
     def count_tokens(self, text: str) -> int:
         if not self.tokenizer:
             return len(text.split())
         return len(self.tokenizer.encode(text))
 
-    def process_image(self, image: Image.Image, max_new_tokens: int) -> str:
-        """Enhanced image processing with better generation parameters"""
-        if not self.model or not self.processor:
-            raise RuntimeError("Model not loaded")
-
-        try:
-            # Image preprocessing
-            max_size = 1000
-            min_size = 32    # Minimum size to prevent processing errors
-            width, height = image.size
+    def prepare_image(self, image: Image.Image) -> tuple:
+        """
+        Resize to the visual-token budget. Returns the image and its plan
+        (size and visual tokens); the image is None
+        for images too small or thin to read.
+        """
+        min_size = 32    # Minimum size to prevent processing errors
+        width, height = image.size
+        
+        # Skip if image is too small
+        if width < min_size or height < min_size:
+            return None, {"visual_tokens": 0}
             
-            # Skip if image is too small
-            if width < min_size or height < min_size:
-                return ""
-                
-            aspect_ratio = max(width, height) / float(min(width, height))
-            if aspect_ratio > 200:
-                return ""
+        aspect_ratio = max(width, height) / float(min(width, height))
+        if aspect_ratio > 200:
+            return None, {"visual_tokens": 0}
 
-            if width > max_size or height > max_size:
-                if width > height:
-                    new_width = max_size
-                    new_height = int((max_size / width) * height)
-                else:
-                    new_height = max_size
-                    new_width = int((max_size / height) * width)
-                image = image.resize((new_width, new_height), Image.LANCZOS)
-
-            # Model inputs
-            messages = [{"role": "user", "content": [
-                {"type": "image", "image": image},
-                {"type": "text", "text": self.prompt}
-            ]}]
-
-            prompt_text = self.processor.apply_chat_template(
-                messages, tokenize=False, add_generation_prompt=True
-            )
+        return self.budget.resize(image)
+
+    def _clean_output(self, output_text: str) -> str:
+        """Filter non-useful outputs"""
+        if not output_text or output_text.lower() == "blank":
+            return ""
+        if re.match(r"^\(\d+,\d+\),\(\d+,\d+\)$", output_text):
+            return ""
+        if output_text in [
+            "The text is not visible in the image.",
+            "The text on the image is not clear and appears to be a mix of different colors and patterns."
+        ]:
+            return ""
+        return output_text
 
-            inputs = self.processor(
-                text=prompt_text,
-                images=image,
-                return_tensors="pt",
-                max_length=2048,  # Increased for longer contexts
-                truncation=True
+    def _inputs(self, images: list) -> dict:
+        """Model inputs for prepared images, on the model's device"""
+        # With the prompt first, everything up to the image is the same for
+        # every image and its cache can be shared
+        content = [{"type": "image"}, {"type": "text", "text": self.prompt}]
+        if self.prompt_first:
+            content.reverse()
+        prompt_text = self.processor.apply_chat_template(
+            [{"role": "user", "content": content}],
+            tokenize=False, add_generation_prompt=True
+        )
+
+        # No truncation: cutting the prompt would drop visual tokens, and the
+        # budget's max_pixels already keeps images well inside the context
+        inputs = self.processor(
+            text=[prompt_text] * len(images),
+            images=images,
+            return_tensors="pt",
+            padding=True
+        )
+
+        device = next(self.model.parameters()).device
+        return {k: v.to(device) if torch.is_tensor(v) else v for k, v in inputs.items()}
+
+    def _rope(self) -> object:
+        """The module holding get_rope_index and rope_deltas (moved in newer transformers)"""
+        return self.model if hasattr(self.model, "get_rope_index") else self.model.model
+
+    def prefill(self, inputs: dict) -> dict:
+        """
+        Run the prompt through the model up to its last token, reusing the
+        cached prefix before the image, and return the generate arguments
+        that continue from there. Returns {} when the prefix cannot be used:
+        padded batches, where rows' prefixes sit at different positions.
+        """
+        input_ids, attention_mask = inputs["input_ids"], inputs["attention_mask"]
+        if not attention_mask.all():
+            return {}
+        image_positions = (input_ids[0] == self.model.config.image_token_id).nonzero()
+        if len(image_positions) == 0:
+            return {}
+        start, end = int(image_positions[0]), input_ids.shape[1] - 1
+
+        prefix_ids = input_ids[:1, :start]
+        if self._prefix is None or not torch.equal(self._prefix[0], prefix_ids):
+            prefix_cache = DynamicCache()
+            with torch.no_grad():
+                self.model(input_ids=prefix_ids, past_key_values=prefix_cache, use_cache=True)
+            self._prefix = (prefix_ids, prefix_cache)
+        cache = copy.deepcopy(self._prefix[1])
+        if len(input_ids) > 1:
+            cache.batch_repeat_interleave(len(input_ids))
+
+        # Multimodal rotary positions of the whole prompt; text before the
+        # image has the same positions as in the prefix run on its own
+        rope = self._rope()
+        position_ids, rope_deltas = rope.get_rope_index(input_ids, inputs["image_grid_thw"], None, attention_mask)
+        with torch.no_grad():
+            self.model(
+                input_ids=input_ids[:, start:end],
+                pixel_values=inputs["pixel_values"],
+                image_grid_thw=inputs["image_grid_thw"],
+                attention_mask=attention_mask[:, :end],
+                position_ids=position_ids[:, :, start:end],
+                past_key_values=cache,
+                use_cache=True
             )
+        # generate continues from the last prompt token with these offsets
+        rope.rope_deltas = rope_deltas
+        return {"past_key_values": cache, "rope_deltas": rope_deltas, "position_ids": position_ids}
+
+    def _check_prefill(self, inputs: dict, prefilled: dict) -> bool:
+        """Whether the cached prefill gives the same next-token logits as the whole prompt at once"""
+        input_ids, attention_mask = inputs["input_ids"], inputs["attention_mask"]
+        end = input_ids.shape[1] - 1
+        with torch.no_grad():
+            full = self.model(**inputs, position_ids=prefilled["position_ids"]).logits[:, -1].float()
+            cached = self.model(
+                input_ids=input_ids[:, end:],
+                attention_mask=attention_mask,
+                position_ids=prefilled["position_ids"][:, :, end:],
+                past_key_values=copy.deepcopy(prefilled["past_key_values"]),
+                use_cache=True
+            ).logits[:, -1].float()
+        return bool(torch.equal(full.argmax(-1), cached.argmax(-1)) and torch.allclose(full, cached, rtol=1e-2, atol=1e-1))
+
+    def _prefilled(self, inputs: dict) -> dict:
+        """prefill's generate arguments, or {} to prefill the whole prompt in generate"""
+        if not self.prefix_cache:
+            return {}
+        try:
+            prefilled = self.prefill(inputs)
+            if prefilled and not self._prefix_checked:
+                if not self._check_prefill(inputs, prefilled):
+                    raise RuntimeError("cached prefix gives different logits")
+                self._prefix_checked = True
+        except Exception as e:
+            console.print(f"[yellow]Prompt prefix cache unavailable ({e}); prefilling every prompt in full")
+            self.prefix_cache = False
+            self._prefix = None
+            return {}
+        prefilled.pop("position_ids", None)
+        return prefilled
+
+    def _generate(self, images: list, max_new_tokens: int) -> list:
+        """One generate call over prepared images, returning the cleaned text of each"""
+        inputs = self._inputs(images)
+        prefilled = self._prefilled(inputs)
 
-            device = next(self.model.parameters()).device
-            inputs = {k: v.to(device) if torch.is_tensor(v) else v for k, v in inputs.items()}
+        # Prompts are left-padded to the same length, so every answer starts at input_len
+        input_len = inputs["input_ids"].shape[1]
+        if self.decoding == "greedy":
+            decoding = {"do_sample": False}
+        else:
+            decoding = {
+                "do_sample": True,       # Enable sampling
+                "temperature": 0.7,      # Moderate temp for balanced output
+                "top_p": 0.9,            # Adjust for better sampling control
+                "top_k": 50,             # Adjust for better sampling control
+            }
+        generation = dict(
+            max_new_tokens=max_new_tokens,
+            min_new_tokens=10,
+            num_beams=1,          # Reduce beams for faster processing
+            repetition_penalty=1.1,  # Adjust to reduce repetition
+            length_penalty=1.0,
+            remove_invalid_values=True,
+            renormalize_logits=True,  # Help with token distribution
+            **decoding
+        )
 
-            # Improved generation parameters
+        # Improved generation parameters
+        def generate(extra: dict):
+            stopper = RepetitionLoopStopper(input_len) if self.stop_loops else None
             with torch.no_grad():
                 outputs = self.model.generate(
                     **inputs,
-                    max_new_tokens=max_new_tokens,
-                    min_new_tokens=10,
-                    num_beams=1,          # Reduce beams for faster processing
-                    do_sample=True,       # Enable sampling
-                    temperature=0.7,      # Moderate temp for balanced output
-                    repetition_penalty=1.1,  # Adjust to reduce repetition
-                    length_penalty=1.0,
-                    top_p=0.9,            # Adjust for better sampling control
-                    top_k=50,             # Adjust for better sampling control
-                    remove_invalid_values=True,
-                    renormalize_logits=True,  # Help with token distribution
+                    stopping_criteria=StoppingCriteriaList([stopper]) if stopper else None,
+                    **generation,
+                    **extra
                 )
+            return outputs, stopper
+
+        try:
+            outputs, stopper = generate(prefilled)
+        except Exception as e:
+            if not prefilled:
+                raise
+            console.print(f"[yellow]Generating from the cached prompt prefix failed ({e}); prefilling every prompt in full")
+            self.prefix_cache = False
+            self._prefix = None
+            outputs, stopper = generate({})
 
-            input_len = inputs["input_ids"].shape[1]
-            output_text = self.tokenizer.decode(
-                outputs[0][input_len:],
+        texts = []
+        for row, output in enumerate(outputs):
+            tokens = [token for token in output[input_len:].tolist() if token != self.tokenizer.pad_token_id]
+            self.stats["generated_tokens"] += len(tokens)
+            if stopper:
+                tokens = stopper.trim(row, tokens)
+            texts.append(self._clean_output(self.tokenizer.decode(
+                tokens,
                 skip_special_tokens=True,
                 clean_up_tokenization_spaces=True
-            ).strip()
+            ).strip()))
+        if stopper:
+            self.stats["loops_stopped"] += len(stopper.loops)
+        return texts
 
-            # Filter non-useful outputs
-            if not output_text or output_text.lower() == "blank":
-                return ""
-            if re.match(r"^\(\d+,\d+\),\(\d+,\d+\)$", output_text):
-                return ""
-            if output_text in [
-                "The text is not visible in the image.",
-                "The text on the image is not clear and appears to be a mix of different colors and patterns."
-            ]:
+    def process_image(self, image: Image.Image, max_new_tokens: int, prepared: bool = False) -> str:
+        """Transcribe one image; prepared means it has been through prepare_image already"""
+        if not self.model or not self.processor:
+            raise RuntimeError("Model not loaded")
+
+        try:
+            if not prepared:
+                image, _ = self.prepare_image(image)
+            if image is None:
                 return ""
-            return output_text
+            return self._generate([image], max_new_tokens)[0]
 
         except Exception as e:
             console.print(f"[red]Error in vision-language processing: {e}")
             raise
 
-def process_image(img_path: Path, out_path: Path, model_name: str = "Qwen/Qwen2-VL-2B-Instruct") -> dict:
-    """Process a single image file, returning manifest-compatible output"""
+    def process_images(self, images: list, max_new_tokens: list, batch_size: int, prepared: bool = False) -> list:
+        """
+        Transcribe several images with up to batch_size per generate call.
+        Images are bucketed by their prepared size and padded with white to
+        the bucket's size, so the images of a batch give the same number of
+        visual tokens and no prompt needs padding. prepared means the images
+        have been through prepare_image already (None for unreadable ones).
+        Images of a generate call that failed get None, for the caller to
+        transcribe on their own; the other calls' transcriptions are kept.
+        """
+        if not self.model or not self.processor:
+            raise RuntimeError("Model not loaded")
+
+        transcriptions = [""] * len(images)
+        buckets = {}
+        for i, image in enumerate(images):
+            if not prepared and image is not None:
+                image, _ = self.prepare_image(image)
+            if image is not None:
+                buckets.setdefault(bucket_size(image.size), []).append((i, image))
+
+        for size, members in buckets.items():
+            for start in range(0, len(members), batch_size):
+                group = members[start:start + batch_size]
+                padded = [pad_image(image, size) for _, image in group]
+                # Each answer stops at its end token; the longest allowance bounds the batch
+                tokens = max(max_new_tokens[i] for i, _ in group)
+                try:
+                    for (i, _), text in zip(group, self._generate(padded, tokens)):
+                        transcriptions[i] = text
+                except Exception as e:
+                    console.print(f"[yellow]Batch of {len(group)} images failed ({e}); they will be transcribed one at a time")
+                    for i, _ in group:
+                        transcriptions[i] = None
+        return transcriptions
+
+def process_image(img_path: Path, out_path: Path, model_name: str = "Qwen/Qwen2-VL-2B-Instruct", transcribed: tuple = None, budget: VisualBudget = None, precision: str = "auto", threads: int = None, decoding: str = "sample", stop_loops: bool = True, token_budget: TokenBudget = None, prompt_first: bool = False, prefix_cache: bool = True) -> dict:
+    """
+    Process a single image file, returning manifest-compatible output.
+    transcribed is (transcription, estimated_words, max_new_tokens, plan)
+    when process_batch has already transcribed the image.
+    """
     try:
         # Ensure output directory exists
         out_path.parent.mkdir(parents=True, exist_ok=True)
@@ -225,16 +551,28 @@ def process_image(img_path: Path, out_path: Path, model_name: str = "Qwen/Qwen2-
             # Initialize transcriber with model
             transcriber = TranscriptionProcessor(
                 model_name=model_name,
-                prompt=DEFAULT_PROMPT
+                prompt=DEFAULT_PROMPT,
+                budget=budget,
+                precision=precision,
+                threads=threads,
+                decoding=decoding,
+                stop_loops=stop_loops,
+                token_budget=token_budget,
+                prompt_first=prompt_first,
+                prefix_cache=prefix_cache
             )
             
-            # Load and process image
-            image = Image.open(img_path).convert("RGB")
-            
-            # Get actual transcription from LLM with text density estimation
-            estimated_words = transcriber.estimate_text_density(image)
-            max_new_tokens = min(estimated_words * 2, 2048)  # Adjust multiplier as needed
-            transcription = transcriber.process_image(image, max_new_tokens)
+            if transcribed is not None:
+                transcription, estimated_words, max_new_tokens, plan = transcribed
+            else:
+                # Load and process image
+                image = SegmentHandler.load_segment(img_path)
+                
+                # Get actual transcription from LLM with text density estimation
+                estimated_words = transcriber.estimate_text_density(image)
+                max_new_tokens = transcriber.max_new_tokens(estimated_words)
+                image, plan = transcriber.prepare_image(image)
+                transcription = transcriber.process_image(image, max_new_tokens, prepared=True)
             token_count = transcriber.count_tokens(transcription)
             
             # Save transcription
@@ -248,8 +586,12 @@ def process_image(img_path: Path, out_path: Path, model_name: str = "Qwen/Qwen2-
                 "source": str(rel_path),  # Keep original extension in source
                 "details": {
                     "estimated_words": estimated_words,
+                    "max_new_tokens": max_new_tokens,
                     "token_count": token_count,
-                    "has_content": bool(transcription.strip())
+                    "has_content": bool(transcription.strip()),
+                    # Visual-token report: what the image cost and why
+                    "visual_tokens": plan["visual_tokens"],
+                    "image_size": plan.get("size")
                 }
             }
             
@@ -274,13 +616,13 @@ def process_image(img_path: Path, out_path: Path, model_name: str = "Qwen/Qwen2-
         console.print(f"[red]Error processing {img_path}: {e}")
         return {"error": str(e)}
 
-def process_document(file_path: str, output_folder: Path, model_name: str = "Qwen/Qwen2-VL-2B-Instruct") -> dict:
+def process_document(file_path: str, output_folder: Path, model_name: str = "Qwen/Qwen2-VL-2B-Instruct", transcribed: tuple = None, budget: VisualBudget = None, precision: str = "auto", threads: int = None, decoding: str = "sample", stop_loops: bool = True, token_budget: TokenBudget = None, prompt_first: bool = False, prefix_cache: bool = True) -> dict:
     """Process a document using the process_file utility"""
     file_path = Path(file_path)
     
     def process_fn(f: str, o: Path) -> dict:
         # Process the image and let process_file handle path management
-        result = process_image(Path(f), o, model_name)
+        result = process_image(Path(f), o, model_name, transcribed, budget, precision, threads, decoding, stop_loops, token_budget, prompt_first, prefix_cache)
         
         # Add parent image info if needed
         if not result.get("error"):
@@ -299,10 +641,47 @@ def process_document(file_path: str, output_folder: Path, model_name: str = "Qwe
         file_types={
             '.png': process_fn,
             '.jpg': process_fn,
-            '.jpeg': process_fn
+            '.jpeg': process_fn,
+            '.webp': process_fn,
+            '.npy': process_fn
         }
     )
 
+def process_batch(file_paths: list, output_folder: Path, model_name: str = "Qwen/Qwen2-VL-2B-Instruct", batch_size: int = 8, budget: VisualBudget = None, precision: str = "auto", threads: int = None, decoding: str = "sample", stop_loops: bool = True, token_budget: TokenBudget = None, prompt_first: bool = False, prefix_cache: bool = True):
+    """
+    Transcribe a batch of files with batched generation, then yield their
+    manifest entries in order, written the same way as one at a time.
+    """
+    transcriber = TranscriptionProcessor(model_name=model_name, prompt=DEFAULT_PROMPT, budget=budget, precision=precision, threads=threads, decoding=decoding, stop_loops=stop_loops, token_budget=token_budget, prompt_first=prompt_first, prefix_cache=prefix_cache)
+    loaded, images, estimates, plans = [], [], [], []
+    for file_path in file_paths:
+        try:
+            image = SegmentHandler.load_segment(file_path)
+        except Exception:
+            continue  # Reported when the file is processed on its own below
+        loaded.append(file_path)
+        estimates.append(transcriber.estimate_text_density(image))
+        # Keep only the resized copy the model sees
+        prepared, plan = transcriber.prepare_image(image)
+        images.append(prepared)
+        plans.append(plan)
+
+    try:
+        max_new_tokens = [transcriber.max_new_tokens(estimated_words) for estimated_words in estimates]
+        transcriptions = transcriber.process_images(images, max_new_tokens, batch_size, prepared=True)
+        # Images of a failed generate call are transcribed on their own below
+        transcribed = {
+            file_path: result for file_path, result in zip(loaded, zip(transcriptions, estimates, max_new_tokens, plans))
+            if result[0] is not None
+        }
+    except Exception as e:
+        console.print(f"[yellow]Batched transcription failed ({e}); transcribing one at a time")
+        transcribed = {}
+    del images
+
+    for file_path in file_paths:
+        yield process_document(file_path, output_folder, model_name, transcribed.get(file_path), budget, precision, threads, decoding, stop_loops, token_budget, prompt_first, prefix_cache)
+
 def transcribe(
     segment_folder: Path = typer.Argument(..., help="Input segments folder"),
     segment_manifest: Path = typer.Argument(..., help="Input segments manifest"),
@@ -316,18 +695,88 @@ def transcribe(
         DEFAULT_PROMPT,
         "--prompt", "-p",
         help="Prompt for transcription"
+    ),
+    batch_size: int = typer.Option(
+        1,
+        "--batch-size", "-b",
+        min=1,
+        help="Images per generate call; similar-sized images are batched together (compare with benchmark.py transcribe)"
+    ),
+    min_pixels: int = typer.Option(
+        MIN_PIXELS,
+        "--min-pixels",
+        min=28 * 28,
+        help="Fewest pixels an image is shown at (28x28 pixels per visual token)"
+    ),
+    max_pixels: int = typer.Option(
+        MAX_PIXELS,
+        "--max-pixels",
+        min=28 * 28,
+        help="Most pixels an image is shown at (28x28 pixels per visual token; compare with benchmark.py visual-tokens)"
+    ),
+    precision: str = typer.Option(
+        "auto",
+        "--precision",
+        help=f"Model precision: {', '.join(PRECISIONS)}; fp32, bf16 and int8 run on the CPU (compare with benchmark.py precision)"
+    ),
+    threads: int = typer.Option(
+        0,
+        "--threads", "-t",
+        min=0,
+        help="Intra-op CPU threads for the model (0: torch's default)"
+    ),
+    decoding: str = typer.Option(
+        "sample",
+        "--decoding",
+        help=f"Token choice: {', '.join(DECODINGS)}; greedy gives the same text for the same image (compare with benchmark.py decoding)"
+    ),
+    stop_loops: bool = typer.Option(
+        True,
+        "--stop-loops/--no-stop-loops",
+        help="Stop generating when the output repeats the same phrase over and over, keeping one copy"
+    ),
+    token_budget_file: Path = typer.Option(
+        None,
+        "--token-budget",
+        help="max_new_tokens fitted by fit_token_budget.py; without it, or if the file does not exist yet, twice the word estimate"
+    ),
+    prompt_first: bool = typer.Option(
+        False,
+        "--prompt-first/--image-first",
+        help="Put the prompt before the image so its cached prefix covers the prompt too; the default image-first order caches only the system prompt. Changes what the model sees, so check CER before switching"
+    ),
+    prefix_cache: bool = typer.Option(
+        True,
+        "--prefix-cache/--no-prefix-cache",
+        help="Compute the prompt tokens before the image once and reuse them for every image"
     )
 ):
     """Batch transcription CLI using utils for processing"""
     console.print(f"Using model: {model_name}")
     console.print(f"Using prompt: {prompt}")
 
+    if precision not in PRECISIONS:
+        raise typer.BadParameter(f"Unknown precision: {precision} (use one of {', '.join(PRECISIONS)})")
+    if decoding not in DECODINGS:
+        raise typer.BadParameter(f"Unknown decoding: {decoding} (use one of {', '.join(DECODINGS)})")
+    if min_pixels > max_pixels:
+        raise typer.BadParameter(f"--min-pixels ({min_pixels}) is larger than --max-pixels ({max_pixels})")
+    budget = VisualBudget(min_pixels=min_pixels, max_pixels=max_pixels)
+    token_budget = None
+    if token_budget_file and token_budget_file.exists():
+        token_budget = TokenBudget.load(token_budget_file)
+        console.print(f"Using token budget fitted on {token_budget.samples} images: {token_budget_file}")
+
+    # Segments written with segment.py --output virtual are cut from their pages
+    SegmentHandler.load_virtual_segments(segment_manifest)
+
     processor = BatchProcessor(
         input_manifest=segment_manifest,
         output_folder=transcribed_folder,
         process_name="transcription",
-        processor_fn=lambda f, o: process_document(f, o, model_name),  # Pass model_name to process_document
-        base_folder=segment_folder
+        processor_fn=lambda f, o: process_document(f, o, model_name, None, budget, precision, threads, decoding, stop_loops, token_budget, prompt_first, prefix_cache),  # Pass model_name to process_document
+        base_folder=segment_folder,
+        batch_processor_fn=(lambda files, o: process_batch(files, o, model_name, batch_size, budget, precision, threads, decoding, stop_loops, token_budget, prompt_first, prefix_cache)) if batch_size > 1 else None
     )
     return processor.process()
 
@@ -52,7 +52,7 @@ def process_image(file_path: Path, out_path: Path) -> dict:
             print(f"[cyan]Processing image: {file_path}")
             
             # Load and process image
-            image = Image.open(file_path).convert("RGB")
+            image = SegmentHandler.load_segment(file_path)
             
             # Encode image for API
             base64_image = encode_image(image)
@@ -143,7 +143,9 @@ def process_document(file_path: str, output_folder: Path) -> dict:
         file_types={
             '.png': process_fn,
             '.jpg': process_fn,
-            '.jpeg': process_fn
+            '.jpeg': process_fn,
+            '.webp': process_fn,
+            '.npy': process_fn
         }
     )
 
@@ -163,6 +165,9 @@ def transcribe(
         print("[red]Error: DASHSCOPE_API_KEY environment variable not set")
         return
 
+    # Segments written with segment.py --output virtual are cut from their pages
+    SegmentHandler.load_virtual_segments(background_removed_manifest)
+
     processor = BatchProcessor(
         input_manifest=background_removed_manifest,
         output_folder=transcribed_folder,
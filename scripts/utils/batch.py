@@ -1,9 +1,10 @@
 from pathlib import Path
-from typing import Callable, Dict, List, Optional
+from typing import Callable, Dict, Iterable, List, Optional
 from rich.console import Console
 from .manifest import ManifestProcessor
 from .progress import ProgressTracker
 import sys
+import time
 
 console = Console()
 
@@ -18,13 +19,26 @@ class BatchProcessor:
         processor_fn: Callable,
         batch_size: int = 100,
         base_folder: Path = None,
-        use_source: bool = False
+        use_source: bool = False,
+        batch_processor_fn: Callable[[List[str], Path], Iterable[dict]] = None,
+        completion_order: bool = False,
+        retry_wait: float = 5.0
     ):
         self.input_manifest = Path(input_manifest)
         self.output_folder = Path(output_folder)
         self.base_folder = Path(base_folder) if base_folder else None
         self.process_name = process_name
         self.processor_fn = processor_fn
+        # Optional: takes a batch of paths and yields one result per path, in
+        # order, for stages that work faster on several files at once
+        self.batch_processor_fn = batch_processor_fn
+        # batch_processor_fn yields (index in batch, result) as files finish
+        # instead of results in order
+        self.completion_order = completion_order
+        # Files whose result asked for a retry (another worker holds them) are
+        # not recorded; they are tried again after the rest, retry_wait apart
+        self.retry_wait = retry_wait
+        self.deferred = []
         self.batch_size = batch_size
         self.use_source = use_source
         
@@ -113,6 +127,14 @@ class BatchProcessor:
                 if current_batch:
                     self._process_batch(current_batch, stats, progress, tracker.task)
 
+                # Files other workers held; they finish or their leases go stale
+                while self.deferred:
+                    deferred, self.deferred = self.deferred, []
+                    console.print(f"[yellow]Waiting for {len(deferred)} files held by other workers...")
+                    time.sleep(self.retry_wait)
+                    self._process_batch(deferred, stats, progress, tracker.task)
+                    self.output_proc.write_progress(stats)
+
             # Ensure final manifest is saved after all processing
             self.output_proc._write_manifest(self.manifest_file)
             self.output_proc.write_progress(stats)
@@ -129,58 +151,87 @@ class BatchProcessor:
             self.output_proc.write_progress(stats)
             raise
 
+    def _full_path(self, path: Path) -> Path:
+        """Input file of a manifest path"""
+        # Ensure consistent path handling with documents/ prefix
+        if self.base_folder:
+            if 'documents' in str(self.base_folder):
+                # Base folder already has documents/
+                full_path = self.base_folder / path
+            else:
+                # Add documents/ prefix
+                full_path = self.base_folder / 'documents' / path
+        else:
+            # No base folder, treat path as relative to workspace
+            if 'documents' in path.parts:
+                full_path = path
+            else:
+                full_path = Path('documents') / path
+
+        # Ensure extension is preserved
+        if path.suffix:
+            full_path = full_path.with_suffix(path.suffix)
+        return full_path
+
+    def _save_result(self, result: dict, path: Path, stats: dict, progress, task):
+        """Record one file's result in the manifest and the statistics"""
+        if result.get("retry"):
+            self.deferred.append({"path": str(path)})
+            return
+        # Preserve source path in result
+        if not result.get("source"):
+            # Store relative path from documents/
+            if 'documents' in path.parts:
+                rel_path = Path(*path.parts[path.parts.index('documents')+1:])
+            else:
+                rel_path = path
+            result["source"] = str(rel_path)
+            
+        self.output_proc.save_entry(result)
+        
+        if result.get("skipped"):
+            stats["skipped"] += 1
+        elif result.get("error"):
+            stats["failed"] += 1
+        else:
+            stats["processed"] += 1
+            
+        progress.update(task, advance=1, **stats)
+
     def _process_batch(self, batch: List[dict], stats: dict, progress, task):
         """Process a batch of files"""
+        if self.batch_processor_fn:
+            self._process_batch_at_once(batch, stats, progress, task)
+            return
         for doc in batch:
             try:
                 path = Path(doc["path"])
-                
-                # Ensure consistent path handling with documents/ prefix
-                if self.base_folder:
-                    if 'documents' in str(self.base_folder):
-                        # Base folder already has documents/
-                        full_path = self.base_folder / path
-                    else:
-                        # Add documents/ prefix
-                        full_path = self.base_folder / 'documents' / path
-                else:
-                    # No base folder, treat path as relative to workspace
-                    if 'documents' in path.parts:
-                        full_path = path
-                    else:
-                        full_path = Path('documents') / path
-
-                # Ensure extension is preserved
-                if path.suffix:
-                    full_path = full_path.with_suffix(path.suffix)
-                
-                result = self.processor_fn(str(full_path), self.output_folder)
-                
-                # Preserve source path in result
-                if not result.get("source"):
-                    # Store relative path from documents/
-                    if 'documents' in path.parts:
-                        rel_path = Path(*path.parts[path.parts.index('documents')+1:])
-                    else:
-                        rel_path = path
-                    result["source"] = str(rel_path)
-                    
-                self.output_proc.save_entry(result)
-                
-                if result.get("skipped"):
-                    stats["skipped"] += 1
-                elif result.get("error"):
-                    stats["failed"] += 1
-                else:
-                    stats["processed"] += 1
-                    
-                progress.update(task, advance=1, **stats)
+                result = self.processor_fn(str(self._full_path(path)), self.output_folder)
+                self._save_result(result, path, stats, progress, task)
                 
             except Exception as e:
                 console.print(f"[red]Error processing {doc['path']}: {e}")
                 stats["failed"] += 1
                 progress.update(task, advance=1, **stats)
 
+    def _process_batch_at_once(self, batch: List[dict], stats: dict, progress, task):
+        """Hand the whole batch to batch_processor_fn, saving results as they come"""
+        paths = [Path(doc["path"]) for doc in batch]
+        done = set()
+        try:
+            results = self.batch_processor_fn([str(self._full_path(path)) for path in paths], self.output_folder)
+            if not self.completion_order:
+                results = enumerate(results)
+            for index, result in results:
+                self._save_result(result, paths[index], stats, progress, task)
+                done.add(index)
+        except Exception as e:
+            console.print(f"[red]Error processing batch after {len(done)} of {len(batch)} files: {e}")
+        # Files the batch did not get to count as failed
+        for _ in range(len(paths) - len(done)):
+            stats["failed"] += 1
+            progress.update(task, advance=1, **stats)
+
     def _print_stats(self, stats: dict):
         """Print final statistics"""
         console.print(f"\n[green]Processing completed. Final statistics:")
@@ -0,0 +1,198 @@
+"""
+Skew estimation engines.
+
+Every engine takes a grayscale page (possibly reduced) and returns the angle
+in degrees that straightens it when passed to cv2.getRotationMatrix2D or
+PIL's Image.rotate, i.e. positive when text lines slope down to the right.
+
+Engines search center +/- span degrees in step-degree increments where the
+method allows it, so callers can run a coarse pass on a small copy of the
+page and refine around its result on a larger one.
+"""
+
+from abc import ABC, abstractmethod
+
+import numpy as np
+import cv2
+
+class DeskewEngine(ABC):
+    """Base class for skew estimators"""
+
+    name = ""
+
+    @abstractmethod
+    def estimate(self, gray: np.ndarray, center: float = 0.0, span: float = 2.0, step: float = 0.1) -> tuple[float, dict]:
+        """Return (angle in degrees or None if the page gives no evidence, debug_info)"""
+
+class HoughEngine(DeskewEngine):
+    """
+    Median angle of the strongest near-horizontal lines in the Hough transform
+    of the page's edge map. Only angles within the search window are voted
+    for, in step-degree bins, so a small edge map still resolves fractions of
+    a degree. Lines need votes from a fifth of the width.
+    """
+
+    name = "hough"
+
+    def __init__(self, canny_threshold1: int = 50, canny_threshold2: int = 150, top_lines: int = 30):
+        self.canny_threshold1 = canny_threshold1
+        self.canny_threshold2 = canny_threshold2
+        self.top_lines = top_lines
+
+    def estimate(self, gray, center=0.0, span=2.0, step=0.1):
+        img_blurred = cv2.GaussianBlur(gray, (3, 3), 0)
+        edges = cv2.Canny(img_blurred, self.canny_threshold1, self.canny_threshold2)
+
+        debug_info = {
+            "found_lines": False,
+            "rotation_angle": 0,
+            "num_lines": 0,
+            "edge_points": int(np.count_nonzero(edges)),
+            "image_size": [int(gray.shape[1]), int(gray.shape[0])]
+        }
+
+        lines = cv2.HoughLines(
+            edges, 1, np.radians(step),
+            threshold=max(gray.shape[1] // 5, 10),
+            min_theta=np.radians(90 + center - span),
+            max_theta=np.radians(90 + center + span)
+        )
+        if lines is None:
+            return None, debug_info
+
+        # Lines come sorted by votes; theta is the angle of the line's normal
+        angles = np.degrees(lines[:self.top_lines, 0, 1]) - 90
+        median_angle = float(np.median(angles))
+        debug_info.update({
+            "found_lines": True,
+            "rotation_angle": median_angle,
+            "num_lines": len(lines)
+        })
+        return median_angle, debug_info
+
+class MinAreaRectEngine(DeskewEngine):
+    """
+    Angle of the minimum-area rectangle around the largest dark contour
+    (Otsu threshold), folded into +/- 45 degrees. Works when the page has one
+    dominant straight-edged object; ignores the search window.
+    """
+
+    name = "minarea"
+
+    def estimate(self, gray, center=0.0, span=2.0, step=0.1):
+        # Threshold and invert to get text as white on black for contour detection
+        _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        debug_info = {"num_contours": len(contours)}
+        if not contours:
+            return None, debug_info
+
+        largest_contour = max(contours, key=cv2.contourArea)
+        angle = cv2.minAreaRect(largest_contour)[-1]
+        # A horizontal rectangle reports ~0 or ~90 depending on its side order
+        if angle < -45:
+            angle = 90 + angle
+        elif angle > 45:
+            angle = angle - 90
+        debug_info["rotation_angle"] = float(angle)
+        return float(angle), debug_info
+
+class TesseractBaselineEngine(DeskewEngine):
+    """
+    Slope of a line fitted through the bottom centers of the words Tesseract
+    finds, limited to +/- span degrees. Needs Tesseract (see utils/ocr.py);
+    by far the slowest engine.
+    """
+
+    name = "tesseract"
+
+    def __init__(self, min_confidence: float = 30):
+        self.min_confidence = min_confidence
+
+    def estimate(self, gray, center=0.0, span=2.0, step=0.1):
+        from .ocr import image_to_data
+
+        return self.angle_from_words(image_to_data(gray), center, span)
+
+    def angle_from_words(self, data: dict, center: float = 0.0, span: float = 2.0) -> tuple[float, dict]:
+        """The estimate for word boxes already found, as returned by utils.ocr.image_to_data"""
+        points = [
+            (data['left'][i] + data['width'][i] / 2, data['top'][i] + data['height'][i])
+            for i in range(len(data['text']))
+            if float(data['conf'][i]) > self.min_confidence and data['text'][i].strip()
+        ]
+        debug_info = {"num_words": len(points)}
+        if len(points) < 2:
+            return None, debug_info
+
+        x_coords, y_coords = zip(*points)
+        slope = np.polyfit(x_coords, y_coords, deg=1)[0]
+        angle = float(np.clip(np.degrees(np.arctan(slope)), center - span, center + span))
+        debug_info["rotation_angle"] = angle
+        return angle, debug_info
+
+class ProjectionEngine(DeskewEngine):
+    """
+    Projection-profile search. Ink pixels (adaptive threshold, so dark
+    backgrounds do not count) are projected onto rows after shearing by each
+    candidate angle, all angles at once with a single bincount. Text lines
+    give the sharpest row profile, measured as the sum of squared row counts,
+    when the shear matches their slope. The best angle is refined between
+    its neighbours with a parabola.
+    """
+
+    name = "projection"
+
+    def __init__(self, max_points: int = 50_000):
+        self.max_points = max_points
+
+    def estimate(self, gray, center=0.0, span=2.0, step=0.1):
+        height, width = gray.shape
+        block_size = max(int(min(height, width) / 40) | 1, 3)
+        ink = cv2.adaptiveThreshold(gray, 1, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, block_size, 10)
+        return self.angle_from_ink(ink, center, span, step)
+
+    def angle_from_ink(self, ink: np.ndarray, center: float = 0.0, span: float = 2.0, step: float = 0.1) -> tuple[float, dict]:
+        """The estimate for an ink map already made (non-zero where there is ink)"""
+        height, width = ink.shape
+        ys, xs = np.nonzero(ink)
+        debug_info = {"ink_points": int(len(xs)), "image_size": [int(width), int(height)]}
+        if len(xs) < 100:
+            return None, debug_info
+
+        # An evenly spaced subset keeps the (angles x points) arrays small
+        if len(xs) > self.max_points:
+            keep = np.linspace(0, len(xs) - 1, self.max_points).astype(np.int64)
+            ys, xs = ys[keep], xs[keep]
+
+        angles = np.arange(center - span, center + span + step / 2, step)
+        slopes = np.tan(np.radians(angles)).astype(np.float32)
+        x_centered = (xs - width / 2).astype(np.float32)
+        rows = np.rint(ys.astype(np.float32)[None, :] - slopes[:, None] * x_centered[None, :]).astype(np.int64)
+        rows -= rows.min()
+        n_rows = int(rows.max()) + 1
+
+        flat = (np.arange(len(angles))[:, None] * n_rows + rows).ravel()
+        profiles = np.bincount(flat, minlength=len(angles) * n_rows).reshape(len(angles), n_rows)
+        scores = np.square(profiles, dtype=np.float64).sum(axis=1)
+
+        best = int(np.argmax(scores))
+        angle = float(angles[best])
+        if 0 < best < len(angles) - 1:
+            left, mid, right = scores[best - 1:best + 2]
+            curvature = left - 2 * mid + right
+            if curvature < 0:
+                angle += float(step * 0.5 * (left - right) / curvature)
+        debug_info["rotation_angle"] = angle
+        return angle, debug_info
+
+ENGINES = {
+    engine.name: engine
+    for engine in (HoughEngine, MinAreaRectEngine, TesseractBaselineEngine, ProjectionEngine)
+}
+
+def get_engine(name: str) -> DeskewEngine:
+    """Create the deskew engine registered under name"""
+    if name not in ENGINES:
+        raise ValueError(f"Unknown deskew engine: {name} (use one of {', '.join(ENGINES)})")
+    return ENGINES[name]()
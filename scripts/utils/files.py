@@ -14,11 +14,11 @@ def ensure_dirs(path: Path):
     """Ensure all parent directories exist"""
     path.parent.mkdir(parents=True, exist_ok=True)
 
-def get_image_files(folder: Path, patterns: List[str] = ["*.jpg", "*.jpeg", "*.tif", "*.tiff", "*.png"]) -> List[Path]:
-    """Get all image files in a folder and subfolders"""
+def get_image_files(folder: Path, patterns: List[str] = ["*.jpg", "*.jpeg", "*.tif", "*.tiff", "*.png", "*.webp", "*.npy"]) -> List[Path]:
+    """Get all image files in a folder and subfolders, leaving out the mask files some stages write next to images"""
     files = []
     for pattern in patterns:
-        files.extend(folder.glob(f"**/{pattern}"))
+        files.extend(path for path in folder.glob(f"**/{pattern}") if not path.name.endswith(".mask.png"))
     return files
 
 def get_skip_files() -> List[str]:
@@ -0,0 +1,44 @@
+import srsly
+from pathlib import Path
+from rich.console import Console
+
+console = Console()
+
+class FolderProfiles:
+    """
+    Per-folder profiles for stages that can reuse what they learned from the
+    first pages of an archival folder on the rest of it.
+
+    A profile is a plain dict owned by the calling stage. It is kept in memory
+    for the run and persisted as a small JSON file in the output folder, so an
+    interrupted run picks up where it left off.
+    """
+
+    def __init__(self, name: str):
+        self.filename = f".{name}_profile.json"
+        self.profiles = {}
+
+    def load(self, folder: Path) -> dict:
+        """Return the profile for folder, reading it from disk on first use"""
+        folder = Path(folder)
+        if folder not in self.profiles:
+            profile_path = folder / self.filename
+            profile = {}
+            if profile_path.exists():
+                try:
+                    profile = srsly.read_json(profile_path)
+                except Exception as e:
+                    console.print(f"[yellow]Warning: Could not read {profile_path}: {e}")
+            self.profiles[folder] = profile
+        return self.profiles[folder]
+
+    def save(self, folder: Path):
+        """Write the profile for folder atomically"""
+        folder = Path(folder)
+        if folder not in self.profiles:
+            return
+        folder.mkdir(parents=True, exist_ok=True)
+        profile_path = folder / self.filename
+        temp_path = profile_path.with_suffix('.tmp')
+        srsly.write_json(temp_path, self.profiles[folder])
+        temp_path.replace(profile_path)
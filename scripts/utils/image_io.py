@@ -0,0 +1,117 @@
+from pathlib import Path
+from typing import Union
+import numpy as np
+from PIL import Image
+
+# Intermediate formats: extension, PIL save arguments and whether alpha is kept
+INTERMEDIATE_FORMATS = {
+    # Quality 100, as the stages saved JPEG before the format was configurable
+    "jpeg": (".jpg", {"format": "JPEG", "quality": 100}, False),
+    # Lossless, fastest zlib level
+    "png": (".png", {"format": "PNG", "compress_level": 1}, True),
+    # Lossless WebP at its fastest effort
+    "webp": (".webp", {"format": "WEBP", "lossless": True, "quality": 0, "method": 0}, True),
+    # Lossy WebP, smaller than JPEG and able to keep alpha; methods below 2 overflow on large pages
+    "webp-lossy": (".webp", {"format": "WEBP", "quality": 90, "method": 2}, True),
+    # Raw numpy array, no encoding at all
+    "npy": (".npy", None, True),
+}
+
+def intermediate_suffix(fmt: str, mode: str = "RGB") -> str:
+    """File extension save_intermediate uses for fmt and an image of this mode"""
+    suffix, _, keeps_alpha = INTERMEDIATE_FORMATS[fmt]
+    if mode in ("RGBA", "LA") and not keeps_alpha:
+        return INTERMEDIATE_FORMATS["png"][0]
+    return suffix
+
+def save_intermediate(image: Image.Image, out_path: Path, fmt: str = "jpeg") -> Path:
+    """
+    Save an intermediate image in fmt, replacing out_path's extension.
+    Images with alpha are saved as PNG when fmt cannot keep it.
+    Returns the path actually written.
+    """
+    if fmt not in INTERMEDIATE_FORMATS:
+        raise ValueError(f"Unknown intermediate format: {fmt} (use one of {', '.join(INTERMEDIATE_FORMATS)})")
+    if image.mode in ("RGBA", "LA") and not INTERMEDIATE_FORMATS[fmt][2]:
+        fmt = "png"
+    suffix, save_args, _ = INTERMEDIATE_FORMATS[fmt]
+
+    out_path = Path(out_path).with_suffix(suffix)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    if save_args is None:
+        np.save(out_path, np.asarray(image))
+    else:
+        image.save(out_path, **save_args)
+    return out_path
+
+# How remove_background writes a page whose background has been cut away:
+#   rgba  - the image with its alpha channel (formats without alpha fall back to PNG)
+#   flat  - composited onto white, no alpha
+#   mask  - RGB image plus an 8-bit mask file next to it
+#   mask1 - RGB image plus a 1-bit mask file next to it
+BACKGROUND_OUTPUTS = ("rgba", "flat", "mask", "mask1")
+# Mask files sit next to their image: page.jpg -> page.mask.png
+MASK_SUFFIX = ".mask.png"
+
+def mask_path(path: Union[str, Path]) -> Path:
+    """The mask file that belongs to an image written with a separate mask"""
+    path = Path(path)
+    return path.with_name(path.stem + MASK_SUFFIX)
+
+def flatten_alpha(image: Image.Image, background: tuple = (255, 255, 255)) -> Image.Image:
+    """Composite an image with alpha onto a plain background; other images are converted to RGB"""
+    if image.mode == 'P' and 'transparency' in image.info:
+        image = image.convert('RGBA')
+    if image.mode not in ('RGBA', 'LA'):
+        return image if image.mode == 'RGB' else image.convert('RGB')
+    if image.mode == 'LA':
+        image = image.convert('RGBA')
+    flat = Image.new('RGB', image.size, background)
+    flat.paste(image, mask=image.getchannel('A'))
+    return flat
+
+def save_background_removed(image: Image.Image, out_path: Path, fmt: str = "png", output: str = "rgba") -> list[Path]:
+    """
+    Save a background-removed RGBA page in one of BACKGROUND_OUTPUTS.
+    Returns the paths written, the image first.
+    """
+    if output not in BACKGROUND_OUTPUTS:
+        raise ValueError(f"Unknown background output: {output} (use one of {', '.join(BACKGROUND_OUTPUTS)})")
+    if output == "rgba" or image.mode != 'RGBA':
+        return [save_intermediate(image, out_path, fmt)]
+    if output == "flat":
+        return [save_intermediate(flatten_alpha(image), out_path, fmt)]
+
+    image_path = save_intermediate(image.convert('RGB'), out_path, fmt)
+    alpha = image.getchannel('A')
+    if output == "mask1":
+        alpha = alpha.point(lambda value: 255 if value >= 128 else 0).convert('1')
+    alpha_path = mask_path(image_path)
+    alpha.save(alpha_path, format="PNG", compress_level=1)
+    return [image_path, alpha_path]
+
+def image_size(path: Union[str, Path]) -> tuple[int, int]:
+    """(width, height) of an image file, read from its header without decoding pixels"""
+    path = Path(path)
+    if path.suffix.lower() == ".npy":
+        shape = np.load(path, mmap_mode="r").shape
+        return shape[1], shape[0]
+    with Image.open(path) as img:
+        return img.size
+
+def load_image(path: Union[str, Path], mode: str = None) -> Image.Image:
+    """
+    Open any image a stage may have written, including .npy arrays, optionally converting to mode.
+    A separate mask file is attached as alpha unless mode asks for no alpha.
+    """
+    path = Path(path)
+    if path.suffix.lower() == ".npy":
+        img = Image.fromarray(np.load(path))
+    else:
+        img = Image.open(path)
+    if mode not in ('RGB', 'L') and mask_path(path).exists():
+        img = img.convert('RGB')
+        img.putalpha(Image.open(mask_path(path)).convert('L'))
+    if mode and img.mode != mode:
+        img = img.convert(mode)
+    return img
@@ -0,0 +1,217 @@
+"""
+OCR service shared by the stages that call Tesseract.
+
+pytesseract starts a tesseract process for every call, writes the image to
+a temporary file and loads the language model again each time. With
+tesserocr (the binding to Tesseract's C API) installed, this module keeps
+a pool of initialised API instances instead and hands them numpy buffers
+directly; without it, calls go through pytesseract as before.
+
+Both backends return word data in pytesseract's Output.DICT layout, so
+callers do not care which one ran. When a backend is created, Tesseract's
+own OpenMP threads are limited to OMP_THREAD_LIMIT (1 unless already set),
+since pages are already processed one per worker.
+
+tesserocr is optional (`pip install -r requirements-ocr.txt`; it builds against the
+installed Tesseract; conda-forge has binary builds).
+"""
+
+import importlib
+import importlib.util
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+# Whether the tesserocr backend can be used; it is imported when a pool is
+# created, after OMP_THREAD_LIMIT is set
+HAS_TESSEROCR = importlib.util.find_spec("tesserocr") is not None
+
+class OCRError(RuntimeError):
+    """Tesseract is not available or failed on an image"""
+
+def to_buffer(image) -> np.ndarray:
+    """A C-contiguous 8-bit grayscale or RGB array of a PIL image or array"""
+    if isinstance(image, Image.Image):
+        image = np.asarray(image if image.mode in ("L", "RGB") else image.convert("RGB"))
+    if image.ndim == 3 and image.shape[2] == 4:
+        image = image[:, :, :3]
+    return np.ascontiguousarray(image, dtype=np.uint8)
+
+def limit_omp_threads():
+    """
+    Limit Tesseract's OpenMP threads for this process and the tesseract
+    processes it starts. Must run before the tesseract library is loaded.
+    """
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+class TesseractPool:
+    """
+    Up to size initialised tesserocr API instances, created as they are
+    first needed and shared by threads through a queue. One pool per
+    process; each worker thread borrows an instance for one call.
+    """
+
+    def __init__(self, size: int = None, lang: str = "eng"):
+        limit_omp_threads()
+        try:
+            self.tesserocr = importlib.import_module("tesserocr")
+        except ImportError as e:
+            raise OCRError(f"tesserocr is not installed: {e}") from e
+        self.size = size or os.cpu_count() or 1
+        self.lang = lang
+        self._idle = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def check(self):
+        """Raise OCRError if Tesseract cannot be initialised"""
+        with self.api():
+            pass
+
+    @contextmanager
+    def api(self):
+        """Borrow an API instance, creating one if none is idle and the pool is not full"""
+        try:
+            api = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    api = self.tesserocr.PyTessBaseAPI(lang=self.lang)
+                except RuntimeError as e:
+                    with self._lock:
+                        self._created -= 1
+                    raise OCRError(f"Could not initialise Tesseract: {e}") from e
+            else:
+                api = self._idle.get()
+        try:
+            yield api
+        finally:
+            api.Clear()
+            self._idle.put(api)
+
+    def _set_image(self, api, image):
+        buffer = to_buffer(image)
+        height, width = buffer.shape[:2]
+        channels = 1 if buffer.ndim == 2 else buffer.shape[2]
+        api.SetImageBytes(buffer.tobytes(), width, height, channels, width * channels)
+
+    def image_to_data(self, image) -> dict:
+        """Word boxes, confidences and text in pytesseract's Output.DICT layout"""
+        with self.api() as api:
+            try:
+                return self._words(api, image)
+            except RuntimeError as e:
+                raise OCRError(f"Tesseract failed on the image: {e}") from e
+
+    def _words(self, api, image) -> dict:
+        data = {key: [] for key in ("level", "left", "top", "width", "height", "conf", "text")}
+        self._set_image(api, image)
+        api.Recognize()
+        iterator = api.GetIterator()
+        if iterator is None:
+            return data
+        level = self.tesserocr.RIL.WORD
+        for word in self.tesserocr.iterate_level(iterator, level):
+            box = word.BoundingBox(level)
+            if box is None:
+                continue
+            left, top, right, bottom = box
+            data["level"].append(5)
+            data["left"].append(left)
+            data["top"].append(top)
+            data["width"].append(right - left)
+            data["height"].append(bottom - top)
+            data["conf"].append(word.Confidence(level))
+            data["text"].append(word.GetUTF8Text(level) or "")
+        return data
+
+    def image_to_string(self, image) -> str:
+        with self.api() as api:
+            try:
+                self._set_image(api, image)
+                return api.GetUTF8Text()
+            except RuntimeError as e:
+                raise OCRError(f"Tesseract failed on the image: {e}") from e
+
+    def close(self):
+        """End the idle instances; borrowed ones go back to the pool as usual"""
+        while True:
+            try:
+                self._idle.get_nowait().End()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._created -= 1
+
+class SubprocessOCR:
+    """pytesseract: one tesseract process per call"""
+
+    def __init__(self):
+        limit_omp_threads()
+
+    def check(self):
+        """Raise OCRError if the tesseract binary cannot be run"""
+        import pytesseract
+        try:
+            pytesseract.get_tesseract_version()
+        except (pytesseract.TesseractError, pytesseract.TesseractNotFoundError) as e:
+            raise OCRError(str(e)) from e
+
+    def image_to_data(self, image) -> dict:
+        import pytesseract
+        try:
+            return pytesseract.image_to_data(to_buffer(image), output_type=pytesseract.Output.DICT)
+        except (pytesseract.TesseractError, pytesseract.TesseractNotFoundError) as e:
+            raise OCRError(str(e)) from e
+
+    def image_to_string(self, image) -> str:
+        import pytesseract
+        try:
+            return pytesseract.image_to_string(to_buffer(image))
+        except (pytesseract.TesseractError, pytesseract.TesseractNotFoundError) as e:
+            raise OCRError(str(e)) from e
+
+    def close(self):
+        pass
+
+_service = None
+_service_lock = threading.Lock()
+
+def get_ocr():
+    """
+    This process's OCR service: a TesseractPool when tesserocr is installed
+    (`pip install -r requirements-ocr.txt`), else pytesseract.
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            try:
+                _service = TesseractPool() if HAS_TESSEROCR else SubprocessOCR()
+            except OCRError:
+                # Installed but not importable, e.g. built against another Tesseract
+                _service = SubprocessOCR()
+        return _service
+
+def backend() -> str:
+    """Name of the backend get_ocr uses"""
+    return "tesserocr" if isinstance(get_ocr(), TesseractPool) else "pytesseract"
+
+def check():
+    """Raise OCRError if the OCR backend cannot run"""
+    get_ocr().check()
+
+def image_to_data(image) -> dict:
+    """Word-level OCR of a PIL image or numpy array, as pytesseract.Output.DICT"""
+    return get_ocr().image_to_data(image)
+
+def image_to_string(image) -> str:
+    """OCR text of a PIL image or numpy array"""
+    return get_ocr().image_to_string(image)
@@ -0,0 +1,167 @@
+"""
+Page layout engines for segmentation.
+
+An engine looks at a whole page once and then answers the questions
+segment.py asks about horizontal bands of it: where the text lines are,
+how much text a band holds and how its baselines slope. Bands are given
+as (top, bottom) rows in page coordinates.
+"""
+
+from abc import ABC, abstractmethod
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from .deskew import ProjectionEngine, TesseractBaselineEngine
+from .ocr import image_to_data
+
+class PageLayout(ABC):
+    """Base class for page layout engines"""
+
+    name = ""
+
+    def __init__(self, img: Image.Image):
+        self.width, self.height = img.size
+
+    @abstractmethod
+    def line_boxes(self) -> list[tuple[int, int]]:
+        """(top, bottom) of each detected text box or line, sorted by top"""
+
+    @abstractmethod
+    def text_len(self, top: int, bottom: int) -> int:
+        """Amount of text in the band, in characters or an estimate of them"""
+
+    @abstractmethod
+    def baseline_angle(self, top: int, bottom: int) -> float:
+        """Baseline slope of the text in the band in degrees, 0.0 without enough evidence"""
+
+    def cut_point(self, start: int, end: int) -> int:
+        """Row between start and end to cut at, or None to let the caller search the image"""
+        return None
+
+class TesseractLayout(PageLayout):
+    """
+    One word-level Tesseract pass over the page. Text lengths, line boxes
+    and baseline angles of bands all come from the words whose vertical
+    centre falls in the band.
+    """
+
+    name = "tesseract"
+
+    def __init__(self, img: Image.Image):
+        super().__init__(img)
+        data = image_to_data(img)
+        # Keep recognised words only; the other rows are blocks, paragraphs and lines
+        keep = [i for i, text in enumerate(data["text"]) if text.strip()]
+        self.words = {key: [data[key][i] for i in keep] for key in ("left", "top", "width", "height", "conf", "text")}
+        self.words["text"] = [text.strip() for text in self.words["text"]]
+        top = np.array(self.words["top"], dtype=np.int64)
+        height = np.array(self.words["height"], dtype=np.int64)
+        self.tops = top
+        self.bottoms = top + height
+        self.centers = top + height / 2
+        self.lengths = np.array([len(text) for text in self.words["text"]], dtype=np.int64)
+        self.baseline_engine = TesseractBaselineEngine()
+
+    def _in_band(self, top: int, bottom: int) -> np.ndarray:
+        return np.nonzero((self.centers >= top) & (self.centers < bottom))[0]
+
+    def line_boxes(self):
+        return sorted(zip(self.tops.tolist(), self.bottoms.tolist()))
+
+    def text_len(self, top, bottom):
+        index = self._in_band(top, bottom)
+        if len(index) == 0:
+            return 0
+        # Characters plus one separator between words, as image_to_string would give
+        return int(self.lengths[index].sum() + len(index) - 1)
+
+    def baseline_angle(self, top, bottom):
+        index = self._in_band(top, bottom)
+        words = {key: [values[i] for i in index] for key, values in self.words.items()}
+        angle, _ = self.baseline_engine.angle_from_words(words)
+        return angle if angle is not None else 0.0
+
+class ProjectionLayout(PageLayout):
+    """
+    No OCR. The page is reduced to work_width, binarised with an adaptive
+    threshold and summed into a row ink profile. Runs of rows with more
+    than min_row_ink of the width inked are text bands; text lengths are
+    the band's ink divided by the ink of a typical character, which scales
+    with the square of the median band height.
+    """
+
+    name = "projection"
+
+    # Ink pixels per character as a fraction of the squared line height,
+    # measured on typed and handwritten pages
+    INK_PER_CHAR = 0.2
+
+    def __init__(self, img: Image.Image, work_width: int = 1200, min_row_ink: float = 0.01, close_rows: int = 2):
+        super().__init__(img)
+        gray = np.asarray(img.convert("L"))
+        self.scale = min(1.0, work_width / self.width)
+        if self.scale < 1.0:
+            gray = cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        block_size = max(int(min(gray.shape) / 40) | 1, 3)
+        self.ink = cv2.adaptiveThreshold(gray, 1, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, block_size, 10)
+        self.profile = self.ink.sum(axis=1, dtype=np.int64)
+
+        # Ruled margins, page edges and dirt add a slowly varying floor to the
+        # profile; measure rows against the emptiest row near them
+        floor_rows = max(int(self.scale * self.height / 30), 3)
+        floor = cv2.erode(self.profile.astype(np.float32)[:, None], np.ones((floor_rows, 1), np.uint8)).ravel()
+        text_ink = np.maximum(self.profile - floor, 0)
+        self.cumulative = np.concatenate(([0], np.cumsum(text_ink)))
+        text_rows = text_ink > min_row_ink * gray.shape[1]
+        # Text rows, with gaps of up to close_rows inside a line filled in
+        edges = np.diff(np.concatenate(([0], text_rows.astype(np.int8), [0])))
+        starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+        if len(starts) > 1:
+            keep = np.concatenate(([True], starts[1:] - ends[:-1] > close_rows))
+            starts, ends = starts[keep], np.concatenate((ends[:-1][keep[1:]], ends[-1:]))
+        # Bands of a row or two are specks and rules, not text
+        tall = ends - starts > close_rows
+        self.bands = list(zip(starts[tall].tolist(), ends[tall].tolist()))
+        line_height = float(np.median(ends[tall] - starts[tall])) if tall.any() else 0.0
+        self.ink_per_char = max(self.INK_PER_CHAR * line_height ** 2, 1.0)
+        self.baseline_engine = ProjectionEngine()
+
+    def _rows(self, top: int, bottom: int) -> tuple[int, int]:
+        """Page rows to rows of the reduced ink map"""
+        n_rows = len(self.profile)
+        return min(int(top * self.scale), n_rows), min(int(np.ceil(bottom * self.scale)), n_rows)
+
+    def line_boxes(self):
+        return [(int(top / self.scale), int(np.ceil(bottom / self.scale))) for top, bottom in self.bands]
+
+    def text_len(self, top, bottom):
+        top, bottom = self._rows(top, bottom)
+        return int((self.cumulative[bottom] - self.cumulative[top]) / self.ink_per_char)
+
+    def baseline_angle(self, top, bottom):
+        top, bottom = self._rows(top, bottom)
+        angle, _ = self.baseline_engine.angle_from_ink(self.ink[top:bottom])
+        return angle if angle is not None else 0.0
+
+    def cut_point(self, start, end):
+        """The emptiest five-row window in the middle third, as find_safe_cut_point looks for"""
+        top, bottom = self._rows(start, end)
+        if bottom - top < 6:
+            return (start + end) // 2
+        window = np.convolve(self.profile[top:bottom], np.ones(5, dtype=np.int64), mode="same")
+        third = (bottom - top) // 3
+        best = top + third + int(np.argmin(window[third:bottom - top - third]))
+        return min(max(int(round(best / self.scale)), start), end)
+
+LAYOUT_ENGINES = {
+    engine.name: engine
+    for engine in (TesseractLayout, ProjectionLayout)
+}
+
+def get_layout_engine(name: str) -> type:
+    """The page layout engine class registered under name"""
+    if name not in LAYOUT_ENGINES:
+        raise ValueError(f"Unknown segmentation engine: {name} (use one of {', '.join(LAYOUT_ENGINES)})")
+    return LAYOUT_ENGINES[name]
@@ -2,6 +2,7 @@ from pathlib import Path
 from datetime import datetime
 from typing import Callable, Any
 from rich.console import Console
+from .segment_handler import SegmentHandler
 
 console = Console()
 
@@ -9,9 +10,14 @@ def process_file(
     file_path: str,
     output_folder: Path,
     process_fn: Callable[[Path, Path], Any],
-    file_types: dict = None
+    file_types: dict = None,
+    output_suffix: str = None
 ) -> dict:
-    """Generic file processor with robust error handling"""
+    """
+    Generic file processor with robust error handling. output_suffix is the
+    extension the stage writes when it is not the source's (see
+    image_io.intermediate_suffix), so existing outputs are found on reruns.
+    """
     file_path = Path(file_path)  # Ensure file_path is a Path object
     
     # Always preserve the input path structure but remove any 'documents' prefix
@@ -33,18 +39,22 @@ def process_file(
     }
     
     try:
-        if not file_path.exists():
+        # Virtual segments have no file of their own; they are cut from their page
+        if not file_path.exists() and not SegmentHandler.is_virtual(file_path):
             raise FileNotFoundError(f"File not found: {file_path}")
             
         # Accept common image formats
-        if file_types and file_path.suffix.lower() not in ['.jpg', '.jpeg', '.png', '.tif', '.tiff']:
+        if file_types and file_path.suffix.lower() not in ['.jpg', '.jpeg', '.png', '.tif', '.tiff', '.webp', '.npy']:
             raise ValueError(f"Unsupported file type: {file_path.suffix}")
         
         out_path.parent.mkdir(parents=True, exist_ok=True)
         
         # For skipped files, keep the expected output path
+        if output_suffix and not out_path.exists() and out_path.with_suffix(output_suffix).exists():
+            out_path = out_path.with_suffix(output_suffix)
         if out_path.exists():
             manifest_entry.update({
+                "outputs": [str(rel_path.with_suffix(out_path.suffix))],
                 "success": True,
                 "skipped": True
             })
@@ -1,16 +1,31 @@
 from pathlib import Path
 from PIL import Image
+import numpy as np
+import cv2
 from typing import Dict, Union
-import shutil
 import os
 import json
 import tempfile
+import socket
+import time
+import srsly
 from rich.console import Console  # Add this import
+from .image_io import load_image
 
 console = Console()
 
+# A worker holding a segments folder renews its lease while it works; a
+# lease not renewed for this long is taken over
+LEASE_FILE = ".lease"
+LEASE_STALE_SECONDS = 600
+
 class SegmentHandler:
     """Handles loading, saving, and path management for image segments"""
+
+    # Virtual segments (no file of their own) by path relative to documents/
+    _virtual_segments = {}
+    # The rotated page virtual segments were last cut from: (path, rotation, image)
+    _virtual_page = None
     
     @staticmethod
     def exists(path: Union[str, Path], base_folder: Path = None) -> bool:
@@ -39,16 +54,70 @@ class SegmentHandler:
                 full_path = Path(segment_path)
                 
             if not full_path.exists():
-                raise FileNotFoundError(f"Segment not found: {full_path}")
+                spec = SegmentHandler._virtual_segments.get(str(SegmentHandler.get_relative_path(full_path)))
+                if spec is None:
+                    raise FileNotFoundError(f"Segment not found: {full_path}")
+                return SegmentHandler.load_virtual_segment(spec)
                 
-            img = Image.open(full_path)
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            return img
+            return load_image(full_path, 'RGB')
             
         except Exception as e:
             raise Exception(f"Error loading segment {segment_path}: {str(e)}")
 
+    @staticmethod
+    def rotate_page(page: Image.Image, angle: float) -> Image.Image:
+        """
+        Rotate a page counter-clockwise by angle degrees about its centre,
+        keeping its size, like PIL's rotate with BICUBIC but several times faster
+        """
+        if not angle:
+            return page
+        img_array = np.asarray(page)
+        height, width = img_array.shape[:2]
+        M = cv2.getRotationMatrix2D(((width - 1) / 2, (height - 1) / 2), angle, 1.0)
+        return Image.fromarray(cv2.warpAffine(img_array, M, (width, height), flags=cv2.INTER_CUBIC))
+
+    @staticmethod
+    def crop_segment(page: Image.Image, bounding_box) -> Image.Image:
+        """Cut rows top to bottom out of a deskewed page"""
+        top, bottom = bounding_box
+        return page.crop((0, top, page.width, bottom))
+
+    @staticmethod
+    def load_virtual_segments(manifest_path: Path) -> int:
+        """
+        Register the virtual segments listed in a segment manifest, so that
+        load_segment cuts them from their parent page. Returns their number.
+        """
+        manifest_path = Path(manifest_path)
+        if not manifest_path.exists():
+            return 0
+        for entry in srsly.read_jsonl(manifest_path):
+            for segment in entry.get("details", {}).get("segments", []):
+                if segment.get("virtual"):
+                    SegmentHandler._virtual_segments[segment["file_path"]] = segment
+        return len(SegmentHandler._virtual_segments)
+
+    @staticmethod
+    def is_virtual(path: Union[str, Path]) -> bool:
+        """Whether path is a registered virtual segment"""
+        return str(SegmentHandler.get_relative_path(Path(path))) in SegmentHandler._virtual_segments
+
+    @staticmethod
+    def load_virtual_segment(spec: dict) -> Image.Image:
+        """
+        Cut a virtual segment from its parent page. Segments of one page
+        follow each other in the manifest, so the last deskewed page is
+        kept and each page is decoded and rotated once.
+        """
+        # Segments are cut from the page rotated by its deskew and baseline angles together
+        page_key = (spec["parent_image"], spec.get("page_angle", 0.0) + spec.get("angle", 0.0))
+        cached = SegmentHandler._virtual_page
+        if cached is None or cached[:2] != page_key:
+            page = SegmentHandler.rotate_page(load_image(Path(spec["parent_image"]), 'RGB'), page_key[1])
+            SegmentHandler._virtual_page = cached = (*page_key, page)
+        return SegmentHandler.crop_segment(cached[2], spec["bounding_box"])
+
     @staticmethod
     def save_segment_output(
         output: str,
@@ -109,74 +178,187 @@ class SegmentHandler:
         return f"{stem}_segment_{segment_index}.jpg"
 
     @staticmethod
-    def is_processing(folder: Path) -> bool:
-        """Check if a folder is currently being processed"""
-        lock_file = folder / ".processing"
-        return lock_file.exists()
+    def _owner() -> dict:
+        """This worker, as recorded in the leases it holds"""
+        return {"host": socket.gethostname(), "pid": os.getpid()}
 
     @staticmethod
-    def start_processing(folder: Path) -> None:
-        """Mark folder as being processed"""
-        # Ensure folder exists before creating lock file
+    def read_lease(folder: Path) -> dict:
+        """Owner of a folder's lease plus its heartbeat (the file's mtime), or None if there is none"""
+        lease_file = folder / LEASE_FILE
+        try:
+            with open(lease_file) as f:
+                lease = json.load(f)
+            lease["heartbeat"] = lease_file.stat().st_mtime
+            return lease
+        except (FileNotFoundError, json.JSONDecodeError):
+            # Gone, or caught between creation and its first write
+            return None
+
+    @staticmethod
+    def lease_is_stale(lease: dict, stale_after: float = LEASE_STALE_SECONDS) -> bool:
+        """A lease whose owner stopped renewing it, or died on this host"""
+        if time.time() - lease["heartbeat"] > stale_after:
+            return True
+        if lease.get("host") == socket.gethostname() and lease.get("pid") != os.getpid():
+            try:
+                os.kill(lease["pid"], 0)
+            except ProcessLookupError:
+                return True
+            except (PermissionError, KeyError, TypeError):
+                pass
+        return False
+
+    @staticmethod
+    def acquire_lease(folder: Path, stale_after: float = LEASE_STALE_SECONDS) -> bool:
+        """
+        Take a folder's lease, creating it with O_EXCL so exactly one worker
+        gets it, or taking it over when its owner is gone. Safe between
+        processes and hosts sharing the folder.
+        """
         folder.mkdir(parents=True, exist_ok=True)
-        lock_file = folder / ".processing"
-        lock_file.touch()
+        lease_file = folder / LEASE_FILE
+        try:
+            fd = os.open(lease_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return SegmentHandler._take_over_lease(folder, stale_after)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(SegmentHandler._owner(), f)
+        return True
 
     @staticmethod
-    def finish_processing(folder: Path) -> None:
-        """Mark folder as finished processing"""
-        lock_file = folder / ".processing"
-        if lock_file.exists():
-            lock_file.unlink()
+    def _take_over_lease(folder: Path, stale_after: float) -> bool:
+        """Replace a stale lease; workers racing for it serialise on a takeover file"""
+        takeover_file = folder / f"{LEASE_FILE}.takeover"
+        try:
+            os.close(os.open(takeover_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+        except FileExistsError:
+            # Another worker is taking over, or died doing so long ago
+            try:
+                if time.time() - takeover_file.stat().st_mtime > stale_after:
+                    takeover_file.unlink()
+            except FileNotFoundError:
+                pass
+            return False
+        try:
+            # Check again now that no one else can be taking over
+            lease = SegmentHandler.read_lease(folder)
+            if lease is not None and not SegmentHandler.lease_is_stale(lease, stale_after):
+                return False
+            SegmentHandler.atomic_write_text(folder / LEASE_FILE, json.dumps(SegmentHandler._owner()))
+            if lease is not None:
+                console.print(f"[yellow]Taking over stale lease of {lease.get('host')}:{lease.get('pid')} on {folder}")
+            return True
+        finally:
+            takeover_file.unlink(missing_ok=True)
+
+    @staticmethod
+    def renew_lease(folder: Path) -> None:
+        """Heartbeat: show the lease is still in use"""
+        try:
+            os.utime(folder / LEASE_FILE)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def release_lease(folder: Path) -> None:
+        """Give up a lease this worker holds"""
+        lease = SegmentHandler.read_lease(folder)
+        owner = SegmentHandler._owner()
+        if lease is not None and lease.get("host") == owner["host"] and lease.get("pid") == owner["pid"]:
+            (folder / LEASE_FILE).unlink(missing_ok=True)
+
+    @staticmethod
+    def is_processing(folder: Path) -> bool:
+        """Check if a folder is currently being processed, i.e. holds a live lease"""
+        lease = SegmentHandler.read_lease(folder)
+        return lease is not None and not SegmentHandler.lease_is_stale(lease)
+
+    @staticmethod
+    def _temp_path(path: Path) -> Path:
+        """A hidden name next to path that no other worker writes to"""
+        return path.with_name(f".{path.name}.{socket.gethostname()}.{os.getpid()}.tmp")
+
+    @staticmethod
+    def atomic_write_text(path: Path, text: str) -> None:
+        """Write a file so that readers see either the old or the complete new content"""
+        temp_path = SegmentHandler._temp_path(path)
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def save_segment_image(image: Image.Image, path: Path, **save_args) -> None:
+        """Save a segment through a temporary file, so a segment file that exists is complete"""
+        temp_path = SegmentHandler._temp_path(path)
+        try:
+            image.save(temp_path, **save_args)
+            os.replace(temp_path, path)
+        finally:
+            temp_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def remove_partial_files(folder: Path) -> int:
+        """Delete temporary files an interrupted worker left behind; returns their number"""
+        partial = list(folder.glob(".*.tmp"))
+        for path in partial:
+            path.unlink(missing_ok=True)
+        return len(partial)
 
     @staticmethod
     def is_complete(folder: Path) -> bool:
         """Check if a folder was completely processed"""
-        done_file = folder / ".done"
-        return done_file.exists() and not SegmentHandler.is_processing(folder)
+        return (folder / ".done").exists()
 
     @staticmethod
     def mark_complete(folder: Path, metadata: dict = None) -> None:
         """Mark folder as completely processed"""
-        done_file = folder / ".done"
-        if metadata:
-            with open(done_file, 'w') as f:
-                json.dump(metadata, f)
-        else:
-            done_file.touch()
+        SegmentHandler.atomic_write_text(folder / ".done", json.dumps(metadata or {}))
 
     @staticmethod
-    def process_safely(folder: Path, process_fn, metadata: dict = None):
-        """Process a folder with safety checks"""
+    def completed_result(folder: Path):
+        """The result a completed folder recorded, or True if it recorded none"""
         try:
-            # Create folder first
-            folder.mkdir(parents=True, exist_ok=True)
+            with open(folder / ".done") as f:
+                return json.load(f).get("result", True)
+        except (json.JSONDecodeError, AttributeError):
+            return True
+
+    @staticmethod
+    def process_safely(folder: Path, process_fn, metadata: dict = None):
+        """
+        Process a folder under its lease. Completed folders are skipped. A
+        folder another live worker holds gives {"retry": True}, which
+        BatchProcessor does not record but tries again once the rest is done,
+        when the other worker's result can be read. After an interruption,
+        the segment files already written are kept (they are written
+        atomically) and only temporary files are removed.
+        """
+        folder.mkdir(parents=True, exist_ok=True)
 
-            # If already complete and not processing, skip
+        # If already complete, skip
+        if SegmentHandler.is_complete(folder):
+            console.print(f"[yellow]Skipping completed folder: {folder}")
+            return SegmentHandler.completed_result(folder)
+
+        if not SegmentHandler.acquire_lease(folder):
+            lease = SegmentHandler.read_lease(folder) or {}
+            console.print(f"[yellow]Deferring folder leased by {lease.get('host')}:{lease.get('pid')}: {folder}")
+            return {"retry": True, "details": {"leased_by": lease}}
+
+        try:
+            # Another worker may have finished it between the check and the lease
             if SegmentHandler.is_complete(folder):
-                console.print(f"[yellow]Skipping completed folder: {folder}")
-                return True
+                return SegmentHandler.completed_result(folder)
 
-            # If interrupted mid-processing, clean up folder contents but keep folder
-            if SegmentHandler.is_processing(folder):
-                console.print(f"[yellow]Cleaning up interrupted processing: {folder}")
-                for item in folder.glob("*"):
-                    if item.is_file():
-                        item.unlink()
-                    elif item.is_dir():
-                        shutil.rmtree(item)
-
-            # Start processing
-            SegmentHandler.start_processing(folder)
-            try:
-                result = process_fn()
-                SegmentHandler.mark_complete(folder, metadata)
-                return result
-            finally:
-                SegmentHandler.finish_processing(folder)
+            if SegmentHandler.remove_partial_files(folder):
+                console.print(f"[yellow]Resuming interrupted processing: {folder}")
+
+            result = process_fn()
+            SegmentHandler.mark_complete(folder, {**(metadata or {}), "result": result})
+            return result
         except Exception as e:
             console.print(f"[red]Error in process_safely: {e}")
-            # Don't delete folder on error, but remove processing flag
-            if folder.exists() and SegmentHandler.is_processing(folder):
-                SegmentHandler.finish_processing(folder)
             raise
+        finally:
+            SegmentHandler.release_lease(folder)
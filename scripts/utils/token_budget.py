@@ -0,0 +1,104 @@
+"""
+Calibrated max_new_tokens for transcription.
+
+transcribe_qwen_2b turns its dark-pixel word estimate into max_new_tokens
+with a fixed rule (twice the estimate, at most 2048). Its manifests record
+the estimate and the tokens actually transcribed for every image, so a
+project's own history says how many tokens an estimate really needs.
+TokenBudget fits an upper quantile of the transcribed tokens for ranges of
+the estimate and predicts max_new_tokens from it; fit_token_budget.py
+fits one per project and reports the budget saved.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import srsly
+
+# Longest answer generate is ever asked for
+MAX_NEW_TOKENS = 2048
+
+# Shortest allowance a prediction is raised to
+MIN_NEW_TOKENS = 16
+
+def heuristic_max_new_tokens(estimated_words: int) -> int:
+    """max_new_tokens without a fitted budget"""
+    return min(estimated_words * 2, MAX_NEW_TOKENS)
+
+def read_pairs(manifest_path: Path) -> list[tuple[int, int]]:
+    """
+    (estimated_words, token_count) of each transcribed image in a
+    transcription manifest. Images that used up their max_new_tokens may
+    have been cut short, so they count as needing the heuristic's allowance.
+    """
+    pairs = []
+    for entry in srsly.read_jsonl(manifest_path):
+        details = entry.get("details") or {}
+        if entry.get("error") or entry.get("skipped") or "estimated_words" not in details or "token_count" not in details:
+            continue
+        estimated_words, token_count = int(details["estimated_words"]), int(details["token_count"])
+        allowed = details.get("max_new_tokens")
+        if allowed and token_count >= 0.95 * allowed:
+            token_count = max(token_count, heuristic_max_new_tokens(estimated_words))
+        pairs.append((estimated_words, token_count))
+    return pairs
+
+class TokenBudget:
+    """
+    Piecewise-linear map from estimated words to max_new_tokens. The
+    estimates are split into bins of at least min_per_bin images; each
+    bin's point is its median estimate and the quantile of its token
+    counts times headroom, made non-decreasing across bins. Estimates
+    beyond the last bin scale its point proportionally.
+    """
+
+    def __init__(self, words: list, tokens: list, quantile: float, headroom: float, samples: int = 0):
+        self.words = np.asarray(words, dtype=np.float64)
+        self.tokens = np.asarray(tokens, dtype=np.float64)
+        self.quantile = quantile
+        self.headroom = headroom
+        self.samples = samples
+
+    @classmethod
+    def fit(cls, pairs: list, quantile: float = 0.95, headroom: float = 1.1, min_per_bin: int = 20, max_bins: int = 10) -> "TokenBudget":
+        """Fit from (estimated_words, token_count) pairs"""
+        if len(pairs) < min_per_bin:
+            raise ValueError(f"Need at least {min_per_bin} transcribed images to fit a token budget, got {len(pairs)}")
+        pairs = np.array(sorted(pairs), dtype=np.float64)
+        n_bins = max(min(max_bins, len(pairs) // min_per_bin), 1)
+        words, tokens = [], []
+        for chunk in np.array_split(pairs, n_bins):
+            words.append(float(np.median(chunk[:, 0])))
+            tokens.append(float(np.quantile(chunk[:, 1], quantile)) * headroom)
+        # Estimates are mostly multiples of eight with floors at 80 and 160, so
+        # neighbouring bins often share a median; such bins get their largest allowance
+        words, group = np.unique(words, return_inverse=True)
+        grouped = np.zeros(len(words))
+        np.maximum.at(grouped, group, tokens)
+        tokens = np.maximum.accumulate(grouped)
+        return cls(words, tokens, quantile, headroom, len(pairs))
+
+    def predict(self, estimated_words: int) -> int:
+        """max_new_tokens for an image with this word estimate"""
+        if estimated_words > self.words[-1] > 0:
+            tokens = self.tokens[-1] * estimated_words / self.words[-1]
+        else:
+            tokens = np.interp(estimated_words, self.words, self.tokens)
+        return int(min(max(np.ceil(tokens), MIN_NEW_TOKENS), MAX_NEW_TOKENS))
+
+    def to_dict(self) -> dict:
+        return {
+            "words": self.words.tolist(),
+            "tokens": self.tokens.tolist(),
+            "quantile": self.quantile,
+            "headroom": self.headroom,
+            "samples": self.samples
+        }
+
+    def save(self, path: Path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        srsly.write_json(path, self.to_dict())
+
+    @classmethod
+    def load(cls, path: Path) -> "TokenBudget":
+        return cls(**srsly.read_json(path))
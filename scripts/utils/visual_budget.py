@@ -0,0 +1,78 @@
+"""
+Visual-token budget for Qwen2-VL inputs.
+
+Qwen2-VL cuts an image into 14-pixel patches and merges each 2x2 group
+into one visual token, so an image costs (width / 28) * (height / 28)
+tokens. VisualBudget shrinks images to the 1000-pixel cap the transcriber
+has always used and then keeps them between min_pixels and max_pixels, so
+the cost of every image is bounded and reported rather than left to the
+processor's defaults and truncation. Sizing by measured line height was
+tried and dropped: the row ink profile merges neighbouring lines of dense
+handwriting, and on the demo segments text at the cap is already only 6 to
+9 pixels tall, so no measurement here could safely shrink an image.
+"""
+
+from PIL import Image
+
+# Pixels per side of one visual token
+PATCH_SIZE = 28
+
+# 32 to 1280 visual tokens; the upper bound is the top of Qwen's
+# recommended range for documents and leaves room for the prompt in 2048
+MIN_PIXELS = 32 * PATCH_SIZE * PATCH_SIZE
+MAX_PIXELS = 1280 * PATCH_SIZE * PATCH_SIZE
+
+def visual_tokens(size: tuple) -> int:
+    """Visual tokens Qwen2-VL spends on an image of size (width, height)"""
+    width, height = size
+    return max(round(width / PATCH_SIZE), 1) * max(round(height / PATCH_SIZE), 1)
+
+def patch_size(size: tuple, min_pixels: int = MIN_PIXELS, max_pixels: int = MAX_PIXELS) -> tuple:
+    """
+    size rounded to whole patches and scaled into [min_pixels, max_pixels],
+    keeping the aspect ratio, as Qwen2-VL's smart_resize does
+    """
+    width, height = size
+    scale = 1.0
+    if width * height > max_pixels:
+        scale = (max_pixels / (width * height)) ** 0.5
+    elif width * height < min_pixels:
+        scale = (min_pixels / (width * height)) ** 0.5
+    width = max(round(width * scale / PATCH_SIZE), 1) * PATCH_SIZE
+    height = max(round(height * scale / PATCH_SIZE), 1) * PATCH_SIZE
+    # Rounding may overshoot the bounds by a row or column of patches
+    while width * height > max_pixels and max(width, height) > PATCH_SIZE:
+        if width >= height:
+            width -= PATCH_SIZE
+        else:
+            height -= PATCH_SIZE
+    return width, height
+
+class VisualBudget:
+    """
+    Picks the size each image is shown to the model at: shrunk so the
+    longer side is at most max_size, never enlarged, then fitted to the
+    pixel range.
+    """
+
+    def __init__(self, min_pixels: int = MIN_PIXELS, max_pixels: int = MAX_PIXELS, max_size: int = 1000):
+        if min_pixels > max_pixels:
+            raise ValueError(f"min_pixels ({min_pixels}) is larger than max_pixels ({max_pixels})")
+        self.min_pixels = min_pixels
+        self.max_pixels = max_pixels
+        self.max_size = max_size
+
+    def plan(self, image: Image.Image) -> dict:
+        """Target size and visual tokens of image"""
+        width, height = image.size
+        scale = min(1.0, self.max_size / max(width, height))
+        size = patch_size((width * scale, height * scale), self.min_pixels, self.max_pixels)
+        return {"size": list(size), "visual_tokens": visual_tokens(size)}
+
+    def resize(self, image: Image.Image) -> tuple[Image.Image, dict]:
+        """image at its planned size, and the plan"""
+        plan = self.plan(image)
+        size = tuple(plan["size"])
+        if image.size != size:
+            image = image.resize(size, Image.LANCZOS)
+        return image, plan